@@ -0,0 +1,143 @@
+"""
+Benchmark of the error alerts of the flows during an outage
+
+Processes standing for concurrent flow runs (a backfill, the hourly flows) all fail
+repeatedly with errors differing only in numbers and addresses, as when an upstream
+service is down, and report them as the flows do (utils/alerts.py) to the local SMTP
+stand-in of bench/standins.py:
+    immediate:  alert_window 0, every error emailed when it happens
+    digest:     errors spooled and deduplicated, then the digest sent (as alert_digest
+                does once the window is over)
+The emails, SMTP connections and seconds spent reporting are compared, and the emails
+saved in the maildir can be read.
+
+    python bench/alert_bench.py --failures 60 --flows 6 --processes 4
+
+Exits with 1 if the digest is not one email listing every flow.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FLOWS_DIR = os.path.join(os.path.dirname(BENCH_DIR), "flows")
+
+
+def get_settings(port, window, spool):
+    """Railcron settings sending mail to the stand-in"""
+    sys.path.insert(0, FLOWS_DIR)
+    from utils.blocks import RailcronBlock
+
+    return RailcronBlock(MAIL_FROM="railcron@localhost", MAIL_TO="ops@localhost", MAIL_SRV="127.0.0.1",
+                         MAIL_PORT=port, MAIL_TYPE="INSECURE", MAIL_LOGIN="bench", MAIL_PWD="bench",
+                         alert_window=window, alert_spool=spool)
+
+
+def make_error(rng, flow_name):
+    """Traceback of a failed fetch, as the flows format them"""
+    return '<br/>'.join([
+        "Traceback (most recent call last):",
+        f'  File "/opt/railcron/flows/{flow_name}.py", line {rng.randint(40, 200)}, in infunc',
+        "requests.exceptions.ConnectionError: HTTPSConnectionPool(host='upstream', port=443): Max retries "
+        f"exceeded (Caused by NewConnectionError('<urllib3.connection.HTTPSConnection object at "
+        f"0x7f{rng.getrandbits(40):010x}>: Failed to establish a new connection: [Errno 111] Connection refused'))"])
+
+
+def report_failures(port, window, spool, failures, seed):
+    """Reports the failures of (flow name) in this process like the flows do
+
+       Returns: seconds spent reporting
+    """
+    sys.path.insert(0, FLOWS_DIR)
+    from utils.alerts import close_smtp, flush_alerts, queue_alert, send_email
+
+    settings = get_settings(port, window, spool)
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    for flow_name in failures:
+        subject = f"Error in Prefect Flow {flow_name}"
+        msg = make_error(rng, flow_name)
+        if not window:
+            send_email(settings, subject, msg)
+        else:
+            queue_alert(settings, subject, msg)
+            flush_alerts(settings)
+    seconds = time.perf_counter() - started
+    close_smtp()
+    return seconds
+
+
+def run_scenario(name, args, window, workdir):
+    """Runs the failures of a scenario against a fresh SMTP stand-in
+
+       Returns: dict of emails, connections and seconds
+    """
+    sys.path.insert(0, BENCH_DIR)
+    sys.path.insert(0, FLOWS_DIR)
+    import standins
+    from utils.alerts import close_smtp, flush_alerts
+
+    server = standins.make_smtp_server(os.path.join(workdir, name))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    spool = os.path.join(workdir, f"{name}.db")
+    flows = [f"flow_{x}" for x in range(args.flows)]
+    failures = [flows[x % len(flows)] for x in range(args.failures)]
+    shares = [failures[x::args.processes] for x in range(args.processes)]
+    try:
+        with ProcessPoolExecutor(args.processes) as pool:
+            seconds = sum(pool.map(report_failures, [port] * args.processes, [window] * args.processes,
+                                   [spool] * args.processes, shares, range(args.processes)))
+        if window:
+            # the window is over: what alert_digest does
+            started = time.perf_counter()
+            flush_alerts(get_settings(port, window, spool), force=True)
+            close_smtp()
+            seconds += time.perf_counter() - started
+        # let the last session end
+        time.sleep(0.2)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {'emails': len(server.messages), 'connections': server.connections, 'seconds': seconds,
+            'maildir': server.maildir}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Error alerts of the flows during an outage")
+    parser.add_argument("--failures", type=int, default=60, help="failed flow runs")
+    parser.add_argument("--flows", type=int, default=6, help="distinct flows failing")
+    parser.add_argument("--processes", type=int, default=4, help="concurrent flow runs")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "railcron-alerts"),
+                        help="where the spools and the received emails are kept")
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    results = {'immediate': run_scenario("immediate", args, 0, args.workdir),
+               'digest': run_scenario("digest", args, 60, args.workdir)}
+    print(f"{args.failures} failures of {args.flows} flows in {args.processes} processes")
+    print(f"{'':12}{'emails':>8}{'connections':>13}{'seconds':>10}")
+    for name, result in results.items():
+        print(f"{name:12}{result['emails']:>8}{result['connections']:>13}{result['seconds']:>10.3f}"
+              f"  {result['maildir']}")
+
+    digest = results['digest']
+    if digest['emails'] != 1:
+        print(f"\nFailed: the digest was sent as {digest['emails']} emails")
+        return 1
+    with open(os.path.join(digest['maildir'], "1.eml"), encoding='utf8', errors='replace') as fd:
+        text = fd.read()
+    missing = [x for x in range(args.flows) if f"flow_{x}" not in text]
+    if missing:
+        print(f"\nFailed: the digest does not list flows {missing}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
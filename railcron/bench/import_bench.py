@@ -0,0 +1,171 @@
+"""
+Cold start benchmark of the flows
+
+What the Prefect agent pays before a deployment of a flow does anything: each flow is
+looked up the way a deployment does (import of its module, then getattr of the flow) in
+fresh interpreters, and the median of:
+    startup:  the interpreter starting (python -c pass)
+    prefect:  import prefect (it also imports the installed collections, prefect_aws...)
+    module:   import of the module of the flow, on top of prefect
+    flow:     lookup of the flow (making it, reading the config file)
+    total:    wall time of the whole process
+is reported with the heavy optional packages that the module itself imported.
+
+The names of the flows are those of master_railcron.yml, nothing is run.
+
+    python bench/import_bench.py --repeat 10 --output /tmp/cold.json
+    python bench/import_bench.py --baseline /tmp/cold.json
+
+Exits with 1 when the module + flow time of a flow regressed against the baseline.
+"""
+import argparse
+import importlib
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FLOWS_DIR = os.path.join(os.path.dirname(BENCH_DIR), "flows")
+
+# flow -> module defining it
+flow_modules = {
+    'incidents': 'opendata',
+    'atoc_timetable': 'opendata',
+    'hda_data': 'hda_data',
+    'nrdp_logs': 'nrdp_data',
+    'a51_trust': 'a51_archive',
+    'data_corpus': 'singlefile',
+    'archive_pack': 'pack',
+    'upstream_poller': 'poller',
+}
+# packages that only some flows (or only failing runs) need
+heavy = ['boto3', 'botocore', 's3transfer', 'prefect_aws', 'prefect_email', 'cProfile', 'pstats']
+# seconds of module + flow increase below which a regression is noise
+MIN_DELTA = 0.01
+
+
+def measure(flow_name, module_name):
+    """Imports a flow in this (fresh) process
+
+       Returns: dict of seconds of prefect/module/flow and heavy packages imported
+    """
+    started = time.perf_counter()
+    import prefect     # noqa: F401
+    imported_prefect = time.perf_counter()
+    before = set(sys.modules)
+    module = importlib.import_module(module_name)
+    imported_module = time.perf_counter()
+    getattr(module, flow_name)
+    looked_up = time.perf_counter()
+    return {'prefect': imported_prefect - started,
+            'module': imported_module - imported_prefect,
+            'flow': looked_up - imported_module,
+            'by_prefect': [x for x in heavy if x in before],
+            'by_module': [x for x in heavy if x in sys.modules and x not in before]}
+
+
+def run_flow(flow_name, repeat, env):
+    """Median measurements of repeated cold starts of a flow"""
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "worker", flow_name],
+                             cwd=FLOWS_DIR, env=env, check=True, capture_output=True, text=True)
+        run = json.loads(out.stdout.strip().splitlines()[-1])
+        run['total'] = time.perf_counter() - started
+        runs.append(run)
+    result = {key: round(statistics.median(run[key] for run in runs), 4)
+              for key in ('prefect', 'module', 'flow', 'total')}
+    result['by_prefect'] = runs[-1]['by_prefect']
+    result['by_module'] = runs[-1]['by_module']
+    return result
+
+
+def get_startup(repeat):
+    """Median seconds of an interpreter doing nothing"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        times.append(time.perf_counter() - started)
+    return round(statistics.median(times), 4)
+
+
+def compare(results, baseline, threshold):
+    """Flows whose module + flow time grew over the threshold (percent) against the baseline"""
+    regressed = []
+    for flow_name, result in results['flows'].items():
+        old = baseline['flows'].get(flow_name)
+        if old is None:
+            continue
+        new_seconds = result['module'] + result['flow']
+        old_seconds = old['module'] + old['flow']
+        if new_seconds - old_seconds > MIN_DELTA and new_seconds > old_seconds * (1 + threshold / 100):
+            regressed.append(f"{flow_name}: {old_seconds * 1000:.0f} ms -> {new_seconds * 1000:.0f} ms")
+    return regressed
+
+
+def run_bench(args):
+    flows = args.flows.split(',') if args.flows else list(flow_modules.keys())
+    unknown = [x for x in flows if x not in flow_modules]
+    if unknown:
+        raise SystemExit(f"Unknown flows: {', '.join(unknown)}")
+    cfg_dir = tempfile.mkdtemp(prefix="railcron-import-")
+    try:
+        shutil.copyfile(os.path.join(os.path.dirname(BENCH_DIR), "master_railcron.yml"),
+                        os.path.join(cfg_dir, "railcron.yml"))
+        env = dict(os.environ, RAILCRON_CFG=cfg_dir)
+        results = {'startup': get_startup(args.repeat), 'flows': {}}
+        print(f"Interpreter startup {results['startup'] * 1000:.0f} ms")
+        print(f"{'flow':16}{'prefect':>9}{'module':>9}{'flow':>9}{'total':>9}  heavy imports")
+        for flow_name in flows:
+            result = run_flow(flow_name, args.repeat, env)
+            results['flows'][flow_name] = result
+            times = "".join(f"{result[x] * 1000:>9.0f}" for x in ('prefect', 'module', 'flow', 'total'))
+            print(f"{flow_name:16}{times}  {', '.join(result['by_module']) or '-'}")
+        loaded = sorted({x for result in results['flows'].values() for x in result['by_prefect']})
+        if loaded:
+            print(f"\nAlready imported by prefect itself: {', '.join(loaded)}")
+    finally:
+        shutil.rmtree(cfg_dir)
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fd:
+            json.dump(results, fd, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf8') as fd:
+            regressed = compare(results, json.load(fd), args.threshold)
+        if regressed:
+            print(f"\nRegressions over {args.threshold:.0f}%:\n  " + "\n  ".join(regressed))
+            return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start time of the Railcron flows")
+    commands = parser.add_subparsers(dest="command")
+
+    worker = commands.add_parser("worker")
+    worker.add_argument("flow")
+
+    parser.add_argument("--flows", default="", help="comma separated flows (default all): "
+                        + ", ".join(flow_modules.keys()))
+    parser.add_argument("--repeat", type=int, default=5, help="cold starts of each flow (median is kept)")
+    parser.add_argument("--output", help="file to save the results to")
+    parser.add_argument("--baseline", help="results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=20, help="percent increase flagged")
+
+    args = parser.parse_args()
+    if args.command == "worker":
+        sys.path.insert(0, FLOWS_DIR)
+        print(json.dumps(measure(args.flow, flow_modules[args.flow])))
+    else:
+        sys.exit(run_bench(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""
+Peak memory regression harness of the archive and hashing paths
+
+Each path that handles whole files (downloading and archiving, hashing, recompression)
+is run on synthetic inputs from 1 MB to several GB, each run in its own process, and the
+peak of its anonymous memory (RssAnon, so pages of files mapped or cached are not
+counted) above what it used before the run is measured. A path fails when its peak is
+over the ceiling or grows with the size of the input, i.e. when some code reads a whole
+file, response or S3 object into memory instead of streaming it.
+
+Downloads are made from the stand-ins of bench/standins.py, commands run by the paths
+(gzip, xz...) and the bzip2 decompression workers are not measured.
+
+tests/test_memory.py checks every path on small inputs with pytest. This runs the same
+check on larger ones:
+
+    python bench/memory_bench.py --sizes 1,64,512,4096 --paths s3_download,digests
+
+Exits with 1 when a path is over its ceiling.
+"""
+import argparse
+import bz2
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FLOWS_DIR = os.path.join(os.path.dirname(BENCH_DIR), "flows")
+
+# path -> input it is run on
+paths = {
+    'http_download': 'gz',
+    's3_download': 'gz',
+    'incidents': 'gz',
+    'file_changed': 'gz',
+    'digests': 'gz',
+    'recompress': 'gz',
+    'bunzip2': 'bz2',
+}
+# seconds between samples of the memory of a run
+SAMPLE_INTERVAL = 0.002
+# MB a path may use above its baseline, and may grow by from the smallest to the largest input
+CEILING = 64
+GROWTH = 16
+
+
+def get_anon_rss():
+    """Anonymous resident memory of this process in bytes (peak RSS where /proc is missing)"""
+    try:
+        with open("/proc/self/status", encoding='ascii') as fd:
+            for line in fd:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakSampler:
+    """Highest memory of this process seen while it is running"""
+
+    def __init__(self):
+        self.peak = get_anon_rss()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopping.wait(SAMPLE_INTERVAL):
+            self.peak = max(self.peak, get_anon_rss())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopping.set()
+        self.thread.join()
+        self.peak = max(self.peak, get_anon_rss())
+
+
+def make_input(kind, size, workdir):
+    """Input file of about size bytes: concatenated gzip members or bzip2 streams of text
+
+       Repeating one compressed chunk keeps generating GBs fast and the file valid
+    """
+    sys.path.insert(0, BENCH_DIR)
+    from payloads import gzip_data, make_text, pushport_line
+
+    filepath = os.path.join(workdir, f"input-{size}.{kind}")
+    if os.path.exists(filepath):
+        return filepath
+    text = make_text(pushport_line, 1024*1024, 1)
+    chunk = gzip_data(text) if kind == 'gz' else bz2.compress(text, 9)
+    written = 0
+    with open(filepath + ".tmp", 'wb') as fd:
+        while written < size:
+            fd.write(chunk)
+            written += len(chunk)
+    os.replace(filepath + ".tmp", filepath)
+    return filepath
+
+
+def get_manifest(inputs):
+    """Stand-in routes of the inputs (see payloads.build_payloads())"""
+    sys.path.insert(0, FLOWS_DIR)
+    from utils.manifest import get_file_digests
+
+    manifest = []
+    for filepath in inputs:
+        digests = get_file_digests(filepath)
+        name = os.path.basename(filepath)
+        for flow, route in [('nrdp_logs', f"/nrdp-v16-logs/mem/{name}"),
+                            ('singlefile', f"/ntrod/s3/mem/{name}"),
+                            ('incidents', f"/api/staticfeeds/mem/{name}")]:
+            manifest.append({'flow': flow, 'route': route, 'path': filepath,
+                             'size': digests['size'], 'md5': digests['md5']})
+    return manifest
+
+
+def run_path(path, filepath, base_url, workdir):
+    """Runs a path on an input in this process
+
+       Returns: dict of the peak memory above the baseline (MB) and seconds of the run
+    """
+    sys.path.insert(0, BENCH_DIR)
+    sys.path.insert(0, FLOWS_DIR)
+    from prefect.blocks.system import JSON
+    import requests
+
+    import standins
+    from utils.blocks import Nrdfs3Block, OpendataBlock, RailcronBlock
+    from utils.bzip2 import decompress_file
+    from utils.files import archive_data_to_file, file_changed, recompress
+    from utils.manifest import get_file_digests
+
+    name = os.path.basename(filepath)
+    archive_path = os.path.join(workdir, "archive")
+    os.makedirs(archive_path, exist_ok=True)
+    settings = RailcronBlock(recompress='gzip')
+
+    if path == 'http_download':
+        def run():
+            resp = requests.get(f"{base_url}/ntrod/s3/mem/{name}", stream=True)
+            archive_data_to_file(resp, archive_path, name, archive_path=archive_path)
+    elif path == 's3_download':
+        nrdf = Nrdfs3Block(aws_access_key_id="bench", aws_secret_access_key="bench",
+                           region_name="eu-west-2", bucket="nrdp-v16-logs", key="mem/",
+                           date_in_key=False, archive_path=archive_path, filetype="gz",
+                           endpoint_url=base_url)
+        size = os.path.getsize(filepath)
+
+        def run():
+            body = nrdf.get_object_stream(f"mem/{name}")
+            archive_data_to_file(body, archive_path, name, expected={'size': size},
+                                 archive_path=archive_path)
+    elif path == 'incidents':
+        opendata = OpendataBlock(username=standins.USERNAME, password=standins.PASSWORD,
+                                 data_url=f"{base_url}/api/staticfeeds/mem/{name}",
+                                 archive_path=archive_path, filetype="gz")
+
+        def run():
+            data = opendata.get_file({'token': standins.TOKEN}, streaming=True)
+            opendata.archive_incidents(data, "00")
+    elif path == 'file_changed':
+        # same hash as the file, so the block is not saved
+        file_hash = JSON(value={"last_hash": get_file_digests(filepath)['md5']})
+
+        def run():
+            file_changed("data_mem", filepath, file_hash)
+    elif path == 'digests':
+        def run():
+            get_file_digests(filepath)
+    elif path == 'recompress':
+        cfg = Nrdfs3Block(aws_access_key_id="bench", aws_secret_access_key="bench",
+                          region_name="eu-west-2", bucket="nrdp-v16-logs", key="mem/",
+                          date_in_key=False, archive_path=archive_path, filetype="gz")
+        cfg.settings = settings
+        copy = os.path.join(archive_path, name)
+        shutil.copyfile(filepath, copy)
+
+        def run():
+            recompress(cfg, copy)
+    elif path == 'bunzip2':
+        def run():
+            decompress_file(filepath, os.path.join(archive_path, name + ".out"))
+    else:
+        raise Exception(f"Unknown path {path}")
+
+    baseline = get_anon_rss()
+    started = time.monotonic()
+    with PeakSampler() as sampler:
+        run()
+    return {'peak_mb': round((sampler.peak - baseline) / 1024**2, 1),
+            'baseline_mb': round(baseline / 1024**2, 1),
+            'seconds': round(time.monotonic() - started, 2)}
+
+
+def check(results, sizes, ceiling, growth):
+    """Paths whose peak is over the ceiling or grows with the size of the input"""
+    failures = []
+    for path, runs in results.items():
+        peaks = [runs[size]['peak_mb'] for size in sizes if size in runs]
+        if max(peaks) > ceiling:
+            failures.append(f"{path}: peak {max(peaks)} MB over the ceiling of {ceiling} MB")
+        if len(peaks) > 1 and peaks[-1] - peaks[0] > growth:
+            failures.append(f"{path}: peak grows from {peaks[0]} MB to {peaks[-1]} MB "
+                            f"with the input ({sizes[0]} MB to {sizes[-1]} MB)")
+    return failures
+
+
+def make_inputs(wanted, sizes, input_dir):
+    """Inputs of each kind needed by the paths, of each size (MB)
+
+       Returns: dict of (kind, size) -> path of the input
+    """
+    os.makedirs(input_dir, exist_ok=True)
+    return {(kind, size): make_input(kind, size * 1024**2, input_dir)
+            for kind in {paths[x] for x in wanted} for size in sizes}
+
+
+def start_standins(inputs):
+    """Starts the stand-ins serving the inputs
+
+       Returns: (process, base URL of the stand-ins)
+    """
+    sys.path.insert(0, BENCH_DIR)
+    import standins
+
+    return standins.start_standins(get_manifest(inputs.values()), (2022, 7, 21))
+
+
+def measure(path, filepath, base_url):
+    """Runs a path on an input in a process of its own (see run_path())"""
+    with tempfile.TemporaryDirectory() as workdir:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "worker", path, filepath,
+                              "--url", base_url, "--workdir", workdir],
+                             cwd=FLOWS_DIR, check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def run_bench(args):
+    """Measures the paths on inputs of all sizes, the same as tests/test_memory.py but larger"""
+    sizes = sorted(int(x) for x in args.sizes.split(','))
+    wanted = [x for x in args.paths.split(',') if x] or list(paths.keys())
+    unknown = set(wanted) - set(paths.keys())
+    if unknown:
+        raise SystemExit(f"Unknown paths: {', '.join(sorted(unknown))}")
+    print(f"Generating inputs of {', '.join(str(x) for x in sizes)} MB in {args.input_dir}")
+    inputs = make_inputs(wanted, sizes, args.input_dir)
+    proc, base_url = start_standins(inputs)
+    results = {}
+    try:
+        for path in wanted:
+            results[path] = {}
+            for size in sizes:
+                results[path][size] = measure(path, inputs[(paths[path], size)], base_url)
+                print(f"{path:15} {size:>7} MB  peak +{results[path][size]['peak_mb']:>7.1f} MB"
+                      f"  {results[path][size]['seconds']:>8.2f}s")
+    finally:
+        proc.terminate()
+    failures = check(results, sizes, args.ceiling, args.growth)
+    if failures:
+        print("\nFailed:\n  " + "\n  ".join(failures))
+        return 1
+    print(f"\nAll paths under {args.ceiling} MB, growth under {args.growth} MB")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak memory of the archive and hashing paths")
+    commands = parser.add_subparsers(dest="command")
+
+    worker = commands.add_parser("worker")
+    worker.add_argument("path")
+    worker.add_argument("input")
+    worker.add_argument("--url")
+    worker.add_argument("--workdir")
+
+    parser.add_argument("--sizes", default="1,64,512", help="comma separated sizes of the inputs in MB")
+    parser.add_argument("--paths", default="", help="comma separated paths (default all): "
+                        + ", ".join(paths.keys()))
+    parser.add_argument("--ceiling", type=float, default=CEILING, help="MB a path may use above its baseline")
+    parser.add_argument("--growth", type=float, default=GROWTH,
+                        help="MB the peak may grow from the smallest to the largest input")
+    parser.add_argument("--input-dir", default=os.path.join(tempfile.gettempdir(), "railcron-memory"),
+                        help="where generated inputs are kept")
+
+    args = parser.parse_args()
+    if args.command == "worker":
+        print(json.dumps(run_path(args.path, args.input, args.url, args.workdir)))
+    else:
+        sys.exit(run_bench(args))
+
+
+if __name__ == "__main__":
+    main()
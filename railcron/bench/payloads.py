@@ -0,0 +1,393 @@
+"""
+Synthetic payloads served by the stand-in servers of the benchmarks
+
+Each flow type gets files shaped like the real ones (names, codecs, object counts) and,
+at scale 1, of roughly their real sizes. The contents are lines resembling the feeds
+(TRUST/TD JSON, Push Port XML, CIF schedules and records, CSV) drawn from a seeded random generator,
+so the files are identical from one run to the next and compress about as well as the
+real data. Generated files are kept in a directory and reused by later runs.
+"""
+import bz2
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import tarfile
+import time
+import zipfile
+
+
+# uncompressed bytes of each file at scale 1
+sizes = {
+    'nrdp_logs': 12 * 1024**2,      # 96 Push Port logs a day
+    'a51_trust': 25 * 1024**2,      # 24 hourly files in each day's .tbz2
+    'a51_darwin': 24 * 1024**2,     # 24 hourly .xml.gz a day
+    'atoc_timetable': 300 * 1024**2,
+    'incidents': 300 * 1024,
+    'data_corpus': 15 * 1024**2,
+    'sched_full_json': 400 * 1024**2,
+    'hda_data': 40 * 1024**2,       # 24 zipped CSVs
+}
+counts = {'nrdp_logs': 96, 'a51_trust': 24, 'a51_darwin': 24, 'hda_data': 24}
+
+
+# locations and operators of the synthetic TRUST movements
+trust_stanoxes = [str(x) for x in random.Random(49).sample(range(10000, 89999), 400)]
+trust_tocs = ["20", "23", "25", "29", "61", "71", "79", "88"]
+
+
+def trust_movement(rng, ts):
+    """TRUST train movement message (0003)"""
+    spread = rng.random()
+    variation = rng.randint(-2, 2) if spread < 0.7 else rng.randint(1, 15) if spread < 0.95 else rng.randint(15, 90)
+    planned = ts // 60000 * 60000 - rng.randint(1, 60) * 60000
+    off_route = rng.random() < 0.03
+    status = "OFF ROUTE" if off_route else "ON TIME" if variation == 0 else "LATE" if variation > 0 else "EARLY"
+    return {"header": {"msg_type": "0003", "source_system_id": "TRUST", "msg_queue_timestamp": str(ts)},
+            "body": {"event_type": rng.choice(["ARRIVAL", "DEPARTURE"]),
+                     "planned_timestamp": "" if off_route else str(planned),
+                     "actual_timestamp": str(planned + variation * 60000 + rng.randint(0, 59) * 1000),
+                     "loc_stanox": rng.choice(trust_stanoxes),
+                     "train_id": f"{rng.randint(10, 99)}{rng.choice('12345')}"
+                                 f"{rng.choice('ABCDEFGHJ')}{rng.randint(10, 99)}"
+                                 f"M{rng.randint(10, 31)}",
+                     "toc_id": rng.choice(trust_tocs),
+                     "timetable_variation": "0" if off_route else str(abs(variation)),
+                     "variation_status": status,
+                     "platform": str(rng.randint(1, 12))}}
+
+
+def trust_line(rng, ts):
+    """TRUST messages as sent by the feed: an array of movements with a few activations (0001)"""
+    messages = []
+    for _ in range(rng.randint(1, 4)):
+        if rng.random() < 0.05:
+            messages.append({"header": {"msg_type": "0001", "source_system_id": "TRUST",
+                                        "msg_queue_timestamp": str(ts)},
+                             "body": {"train_id": f"{rng.randint(10, 99)}1A{rng.randint(10, 99)}M{rng.randint(10, 31)}",
+                                      "schedule_source": "C", "tp_origin_timestamp": "2022-07-21"}})
+        else:
+            messages.append(trust_movement(rng, ts))
+    return json.dumps(messages)
+
+
+# trains of the synthetic TD messages: headcode, area and where along its berths it starts
+td_areas = ["SK", "D3", "M1", "EK", "WY", "Q1"]
+td_trains = [(f"{rng.randint(1, 9)}{rng.choice('ABCDEFHJKLMNPRSTUVWY')}{rng.randint(10, 99)}", rng.choice(td_areas),
+              rng.randint(0, 399)) for rng in [random.Random(50)] for _ in range(600)]
+
+
+def td_line(rng, ts):
+    """TD messages as sent by the feed: an array of berth steps, cancels, interposes and S-class updates"""
+    messages = []
+    for _ in range(rng.randint(1, 5)):
+        kind = rng.random()
+        if kind < 0.35:
+            messages.append({"SF_MSG": {"time": str(ts), "area_id": rng.choice(td_areas), "msg_type": "SF",
+                                        "address": f"{rng.randint(0, 255):02X}", "data": f"{rng.randint(0, 255):02X}"}})
+            continue
+        headcode, area, start = td_trains[int(rng.random() ** 2 * len(td_trains))]
+        # trains move a berth a minute along even numbered berths
+        berth = f"{(ts // 60000 + start) % 400 * 2 + 2:04d}"
+        if kind < 0.9:
+            body = {"time": str(ts), "area_id": area, "msg_type": "CA",
+                    "from": f"{(ts // 60000 + start) % 400 * 2:04d}", "to": berth, "descr": headcode}
+        elif kind < 0.95:
+            body = {"time": str(ts), "area_id": area, "msg_type": "CB", "from": berth, "descr": headcode}
+        else:
+            body = {"time": str(ts), "area_id": area, "msg_type": "CC", "to": berth, "descr": headcode}
+        messages.append({f"{body['msg_type']}_MSG": body})
+    # compact, as the feed sends them
+    return json.dumps(messages, separators=(",", ":"))
+
+
+PP_NS = ('xmlns="http://www.thalesgroup.com/rtti/PushPort/v16" '
+         'xmlns:ns2="http://www.thalesgroup.com/rtti/PushPort/Schedules/v3" '
+         'xmlns:ns3="http://www.thalesgroup.com/rtti/PushPort/Forecasts/v3"')
+pp_tiplocs = ["KNGX", "EUSTON", "PADTON", "LEEDS", "YORK", "CRDFCEN", "MNCRPIC", "BHAMNWS"]
+
+
+def pp_time(mins):
+    return f"{mins // 60 % 24:02d}:{mins % 60:02d}"
+
+
+def pushport_line(rng, ts):
+    """DARWIN Push Port message: mostly forecasts (TS), some schedules and deactivations"""
+    stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ts / 1000 + 3600)) + f".{ts % 1000:03d}0000+01:00"
+    rid = f"2022072{rng.randint(1000000, 9999999)}"
+    uid = f"{rng.choice('CGLPW')}{rng.randint(10000, 99999)}"
+    mins = rng.randint(0, 1439)
+    kind = rng.random()
+    if kind < 0.9:
+        locations = []
+        for _ in range(rng.randint(1, 3)):
+            tpl = rng.choice(pp_tiplocs)
+            late = rng.randint(0, 9)
+            locations.append(f'<ns3:Location tpl="{tpl}" wta="{pp_time(mins)}" wtd="{pp_time(mins + 1)}" '
+                             f'pta="{pp_time(mins)}" ptd="{pp_time(mins + 1)}"><ns3:arr '
+                             f'{rng.choice(["et", "at"])}="{pp_time(mins + late)}" src="TD"/><ns3:dep '
+                             f'et="{pp_time(mins + late + 1)}" src="Darwin"/><ns3:plat>{rng.randint(1, 12)}'
+                             f'</ns3:plat></ns3:Location>')
+            mins += rng.randint(2, 15)
+        body = f'<uR updateOrigin="TD"><TS rid="{rid}" uid="{uid}" ssd="2022-07-21">{"".join(locations)}</TS></uR>'
+    elif kind < 0.97:
+        route = rng.sample(pp_tiplocs, rng.randint(2, 5))
+        points = [f'<ns2:OR tpl="{route[0]}" act="TB" ptd="{pp_time(mins)}" wtd="{pp_time(mins)}"/>']
+        for tpl in route[1:-1]:
+            mins += rng.randint(5, 40)
+            points.append(f'<ns2:IP tpl="{tpl}" act="T " pta="{pp_time(mins)}" ptd="{pp_time(mins + 1)}" '
+                          f'wta="{pp_time(mins)}" wtd="{pp_time(mins + 1)}"/>')
+        mins += rng.randint(5, 40)
+        points.append(f'<ns2:DT tpl="{route[-1]}" act="TF" pta="{pp_time(mins)}" wta="{pp_time(mins)}"/>')
+        body = (f'<uR updateOrigin="CIS" requestSource="at20"><schedule rid="{rid}" uid="{uid}" '
+                f'trainId="{rng.randint(1, 9)}{rng.choice("ACDEFHJKLMNPRSTUVWY")}{rng.randint(10, 99)}" '
+                f'ssd="2022-07-21" toc="{rng.choice(["GR", "VT", "GW", "XC", "TP"])}">{"".join(points)}</schedule></uR>')
+    else:
+        body = f'<uR updateOrigin="Darwin"><deactivated rid="{rid}"/></uR>'
+    return f'<?xml version="1.0" encoding="UTF-8"?><Pport {PP_NS} ts="{stamp}" version="16.1">{body}</Pport>'
+
+
+def cif_line(rng, _ts):
+    """CIF timetable record (80 characters)"""
+    kind = rng.choice(["BS", "LO", "LI", "LI", "LI", "LT"])
+    tiploc = rng.choice(["KNGX", "EUSTON", "PADTON", "LEEDS", "YORK", "CRDFCEN", "MNCRPIC"])
+    body = f"{kind}N{rng.choice('CGLPW')}{rng.randint(10000, 99999)}2205222212100000001 P" \
+        if kind == "BS" else f"{kind}{tiploc:<8}{rng.randint(0, 2359):04d}H {rng.randint(1, 9)}"
+    return f"{body:<80}"[:80]
+
+
+# hubs shared by the routes of the synthetic CIF timetable, as in the real one
+cif_hubs = ["KNGX", "EUSTON", "PADTON", "LEEDS", "YORK", "CRDFCEN", "MNCRPIC", "BHAMNWS"]
+
+
+def get_cif_routes(count=60):
+    """TIPLOCs of the routes of the synthetic CIF timetable, each from a hub to another"""
+    rng = random.Random(7)
+    routes = []
+    for idx in range(count):
+        stops = [f"T{idx:02d}{x:03d}" for x in range(rng.randint(10, 40))]
+        stops[0], stops[-1] = rng.sample(cif_hubs, 2)
+        routes.append(stops)
+    return routes
+
+
+cif_routes = get_cif_routes()
+
+
+def cif_time(secs, half=True):
+    """HHMM[H] time of a CIF location record"""
+    mins = secs // 60 % 1440
+    return f"{mins // 60:02d}{mins % 60:02d}" + (("H" if secs % 60 else " ") if half else "")
+
+
+def cif_schedule(rng, _ts):
+    """CIF schedule: BS, BX and its LO, LI and LT records (or a lone BS of a cancellation)"""
+    uid = f"{rng.choice('CGLPWY')}{rng.randint(10000, 99999)}"
+    stp = rng.choices("PONC", [85, 8, 4, 3])[0]
+    if stp == 'P':
+        dates = "220522221210"
+    else:
+        start = rng.randint(1, 25)
+        dates = f"2207{start:02d}2207{start + rng.randint(0, 6):02d}"
+    days = rng.choice(["1111100", "1111100", "0000010", "0000001", "1111110", "1000000"])
+    bs = f"BSN{uid}{dates}{days} P{rng.choice(['OO', 'XX', 'EE'])}{rng.randint(1, 9)}" \
+         f"{rng.choice('ACDEFHJKLMNPRSTUVWY')}{rng.randint(10, 99)}    1{rng.randint(10000000, 99999999)}"
+    lines = [f"{bs:<79}{stp}"]
+    if stp == 'C':
+        return lines[0]
+    lines.append(f"{'BX':<11}{rng.choice(['GR', 'VT', 'GW', 'XC', 'TP', 'NT', 'SW'])}".ljust(80))
+    route = rng.choice(cif_routes)
+    if rng.random() < 0.5:
+        route = route[::-1]
+    secs = rng.randint(300, 1380) * 60 + rng.choice([0, 30])
+    lines.append(f"LO{route[0]:<8}{cif_time(secs)}{cif_time(secs, False)}{rng.randint(1, 12):<3}"
+                 f"{'FL':<3}{'':4}{'TB':<12}".ljust(80))
+    for tiploc in route[1:-1]:
+        secs += rng.randint(2, 8) * 60 + rng.choice([0, 30])
+        if rng.random() < 0.3:
+            lines.append(f"LI{tiploc:<8}{'':10}{cif_time(secs)}00000000{'':3}{'':6}".ljust(80))
+        else:
+            dep = secs + rng.choice([30, 60, 120])
+            lines.append(f"LI{tiploc:<8}{cif_time(secs)}{cif_time(dep)}{'':5}{cif_time(secs, False)}"
+                         f"{cif_time(dep, False)}{rng.randint(1, 6):<3}{'':6}{'T':<12}".ljust(80))
+            secs = dep
+    secs += rng.randint(2, 8) * 60
+    lines.append(f"LT{route[-1]:<8}{cif_time(secs)}{cif_time(secs, False)}{rng.randint(1, 12):<3}"
+                 f"{'':3}{'TF':<12}".ljust(80))
+    return "\n".join(lines)
+
+
+def make_cif(size, seed):
+    """CIF timetable (.MCA) of about size bytes: header, TIPLOCs, associations, schedules"""
+    rng = random.Random(seed)
+    tiplocs = sorted({x for route in cif_routes for x in route})
+    lines = [f"{'HDTPS.UCFCATE.PD220721':<80}"]
+    for idx, tiploc in enumerate(tiplocs):
+        crs = tiploc[:3] if tiploc in cif_hubs else "   "
+        lines.append(f"TI{tiploc:<7}00{100000 + idx:06d} {tiploc.title():<26}{10000 + idx:05d}0000{crs}".ljust(80))
+    for _ in range(200):
+        lines.append(f"AAN{rng.choice('CGLPW')}{rng.randint(10000, 99999)}{rng.choice('CGLPW')}"
+                     f"{rng.randint(10000, 99999)}2205222212101111100JJS{rng.choice(cif_hubs):<7}  TP".ljust(79) + "P")
+    header = ("\n".join(lines) + "\n").encode('ascii')
+    return header + make_text(cif_schedule, size - len(header), seed) + f"{'ZZ':<80}\n".encode('ascii')
+
+
+def schedule_line(rng, _ts):
+    """JSON schedule (and CORPUS like reference) record"""
+    return json.dumps({"JsonScheduleV1": {"CIF_train_uid": f"C{rng.randint(10000, 99999)}",
+                                          "schedule_start_date": "2022-05-22",
+                                          "schedule_days_runs": "".join(rng.choice("01") for _ in range(7)),
+                                          "atoc_code": rng.choice(["GR", "VT", "GW", "XC", "TP"]),
+                                          "schedule_segment": {"signalling_id": f"1A{rng.randint(10, 99)}",
+                                                               "CIF_speed": str(rng.choice([75, 100, 125]))}}})
+
+
+def incident_line(rng, _ts):
+    """Element of the incidents XML"""
+    return (f"<PtIncident><IncidentNumber>{rng.getrandbits(64):016X}</IncidentNumber>"
+            f"<Summary>Disruption between stations {rng.randint(1, 999)}</Summary>"
+            f"<Planned>{rng.choice(['true', 'false'])}</Planned></PtIncident>")
+
+
+def hda_line(rng, _ts):
+    """Row of a Historic Delay Attribution CSV"""
+    return ",".join([str(rng.randint(1, 13)), f"{rng.randint(10000, 89999)}",
+                     rng.choice(["IA", "TG", "XA", "JH", "M8"]), str(rng.randint(1, 120)),
+                     f"{rng.randint(1, 9)}{rng.choice('ABCDEFGH')}{rng.randint(10, 99)}",
+                     rng.choice(["ED", "EK", "HA", "HB"]), str(rng.randint(0, 400))])
+
+
+def make_text(kind, size, seed):
+    """Lines of a kind of data totalling about size bytes"""
+    rng = random.Random(seed)
+    ts = 1658361600000 + seed % 1000 * 3600000
+    out = io.StringIO()
+    written = 0
+    while written < size:
+        line = kind(rng, ts) + "\n"
+        ts += rng.randint(1, 200)
+        written += len(line)
+        out.write(line)
+    return out.getvalue().encode('utf8')
+
+
+def write_file(filepath, data):
+    """Writes the data of a payload"""
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath + ".tmp", 'wb') as fd:
+        fd.write(data)
+    os.replace(filepath + ".tmp", filepath)
+
+
+def gzip_data(data):
+    """gzip compressed data (fixed mtime so the payload does not change between runs)"""
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+
+def make_zip(members):
+    """ZIP archive of (name, data)"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zfile:
+        for name, data in members:
+            zfile.writestr(zipfile.ZipInfo(name, date_time=(2022, 7, 21, 0, 0, 0)), data,
+                           compress_type=zipfile.ZIP_DEFLATED)
+    return buf.getvalue()
+
+
+def make_tbz2(members):
+    """bzip2 compressed tar of (name, data)"""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = 1658361600
+            tar.addfile(info, io.BytesIO(data))
+    return bz2.compress(buf.getvalue(), 9)
+
+
+def get_objects(date):
+    """What each stand-in serves for a benchmark day
+
+       Args:
+           date: [year, mon, day] (ints) of the day the flows fetch
+
+       Returns: list of dict of flow, route (URL path of the object) and
+                make (function returning its data given the scale)
+    """
+    year, mon, day = date
+    ymd = f"{year}{mon:02d}{day:02d}"
+    objects = []
+
+    def add(flow, route, make, **extra):
+        objects.append(dict(flow=flow, route=route, make=make, **extra))
+
+    for idx in range(counts['nrdp_logs']):
+        hhmm = f"{idx * 15 // 60:02d}{idx * 15 % 60:02d}"
+        add('nrdp_logs', f"/nrdp-v16-logs/logs/{year}/{year}{mon:02d}/{ymd}{hhmm}001_PP.txt.gz",
+            lambda scale, idx=idx: gzip_data(make_text(pushport_line, int(sizes['nrdp_logs'] * scale), idx)))
+    # every day of the month is listed, only the benchmark day is downloaded
+    for other in range(1, 29):
+        add('a51_trust', f"/cdn.area51.onl/archive/rail/trust/{year}/{mon}/{other}.tbz2",
+            (lambda scale: make_tbz2([(f"{hour:02d}.json", make_text(trust_line, int(sizes['a51_trust'] * scale), hour))
+                                      for hour in range(counts['a51_trust'])]))
+            if other == day else None)
+    for hour in range(counts['a51_darwin']):
+        add('a51_darwin', f"/cdn.area51.onl/archive/rail/darwin/{year}/{mon}/{ymd}{hour:02d}_pPort.xml.gz",
+            lambda scale, hour=hour: gzip_data(make_text(pushport_line, int(sizes['a51_darwin'] * scale), 100 + hour)))
+    add('atoc_timetable', "/api/staticfeeds/3.0/timetable",
+        lambda scale: make_zip([(f"RJTTF{day:03d}.MCA", make_cif(int(sizes['atoc_timetable'] * scale * 0.85), 200))]
+                               + [(f"RJTTF{day:03d}.{ext}", make_text(cif_line, int(sizes['atoc_timetable'] * scale * part), 200 + idx))
+                                  for idx, (ext, part) in enumerate([('MSN', 0.05), ('ALF', 0.04), ('FLF', 0.02),
+                                                                     ('TSI', 0.02), ('ZTR', 0.02)], 1)]),
+        disposition=f'attachment; filename="RJTTF{day:03d}.ZIP"')
+    add('incidents', "/api/staticfeeds/5.0/incidents",
+        lambda scale: b"<?xml version='1.0'?><Incidents>" + make_text(incident_line, int(sizes['incidents'] * scale), 300)
+        + b"</Incidents>")
+    add('data_corpus', "/ntrod/s3/CORPUSExtract.json.gz",
+        lambda scale: gzip_data(make_text(schedule_line, int(sizes['data_corpus'] * scale), 400)),
+        params={'type': 'CORPUS'})
+    add('sched_full_json', "/ntrod/s3/toc-full.json.gz",
+        lambda scale: gzip_data(make_text(schedule_line, int(sizes['sched_full_json'] * scale), 500)),
+        params={'type': 'CIF_ALL_FULL_DAILY', 'day': 'toc-full'})
+    for idx in range(counts['hda_data']):
+        add('hda_data', f"/historic-delay-attribution/Transparency_{idx // 13 + 20}-{idx // 13 + 21}/P{idx % 13 + 1:02d}.zip",
+            lambda scale, idx=idx: make_zip([(f"Transparency_P{idx % 13 + 1:02d}.csv",
+                                             make_text(hda_line, int(sizes['hda_data'] * scale), 600 + idx))]))
+    return objects
+
+
+def build_payloads(payload_dir, date, scale, flows=None):
+    """Generates (once) the files served by the stand-ins
+
+       Args:
+           payload_dir: Directory where to keep the generated files
+           date: [year, mon, day] the flows fetch
+           scale: Fraction of the real sizes of the files
+           flows: Names of the flows to generate files for (default all)
+
+       Returns: list of dict of route, path, size, md5 (and disposition/params) of the objects
+    """
+    base = os.path.join(payload_dir, f"scale-{scale}")
+    manifest = []
+    for obj in get_objects(date):
+        if flows and obj['flow'] not in flows:
+            continue
+        entry = {k: v for k, v in obj.items() if k != 'make'}
+        if obj['make'] is None:
+            # listed but never fetched
+            entry.update(path=None, size=int(sizes[obj['flow']] * scale / 8), md5=hashlib.md5(obj['route'].encode()).hexdigest())
+            manifest.append(entry)
+            continue
+        filepath = base + obj['route']
+        if not os.path.exists(filepath):
+            write_file(filepath, obj['make'](scale))
+        md5 = hashlib.md5()
+        with open(filepath, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(1024*1024), b''):
+                md5.update(chunk)
+        entry.update(path=filepath, size=os.path.getsize(filepath), md5=md5.hexdigest())
+        manifest.append(entry)
+    return manifest
@@ -0,0 +1,137 @@
+"""
+Benchmark of the ingestion of the DARWIN Push Port logs
+
+Synthetic logs (bench/payloads.py pushport_line, forecasts, schedules and deactivations)
+are archived as nrdp_logs does (gzipped, in {archive}/YYYY/MM/DD) and ingested into the
+Push Port store (utils/pushport.py ingest_day) with pools of each number of --workers,
+reporting MB/s of decompressed logs and rows/s. The rows are checked against a parse of
+each message into a DOM, and the offset of every row against the message it came from.
+
+    python bench/pushport_bench.py --logs 16 --size 12 --workers 1,2,4
+
+Exits with 1 if the rows or offsets differ.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from xml.etree import ElementTree
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FLOWS_DIR = os.path.join(os.path.dirname(BENCH_DIR), "flows")
+
+YEAR, MON, DAY = "2022", "07", "21"
+
+
+def make_logs(count, size, workdir):
+    """Archived logs of about size MB each (generated once)
+
+       Returns: (archive path, list of the decompressed logs)
+    """
+    sys.path.insert(0, BENCH_DIR)
+    from payloads import gzip_data, make_text, pushport_line
+
+    archive = os.path.join(workdir, f"logs-{size}")
+    dirpath = os.path.join(archive, YEAR, MON, DAY)
+    os.makedirs(dirpath, exist_ok=True)
+    logs = []
+    for idx in range(count):
+        data = make_text(pushport_line, size * 1024**2, idx)
+        filepath = os.path.join(dirpath, f"{YEAR}{MON}{DAY}{idx // 4:02d}{idx % 4 * 15:02d}00_PP.txt.gz")
+        if not os.path.exists(filepath):
+            with open(filepath + ".tmp", 'wb') as fd:
+                fd.write(gzip_data(data))
+            os.replace(filepath + ".tmp", filepath)
+        logs.append(data)
+    return archive, logs
+
+
+def count_dom(data):
+    """Rows of each table in the messages of a log, each message parsed into a DOM"""
+    counts = {'forecasts': 0, 'schedules': 0, 'deactivations': 0}
+    for line in data.splitlines():
+        message = ElementTree.fromstring(line[line.find(b"?>") + 2:])
+        for elem in message.iter():
+            tag = elem.tag.rpartition('}')[2]
+            if tag == 'Location':
+                counts['forecasts'] += sum(1 for x in elem if x.tag.rpartition('}')[2] in ('arr', 'dep', 'pass'))
+            elif tag == 'schedule':
+                counts['schedules'] += sum(1 for x in elem if 'tpl' in x.attrib)
+            elif tag == 'deactivated':
+                counts['deactivations'] += 1
+    return counts
+
+
+def check_offsets(store_path, logs):
+    """Messages at the offsets of the rows that do not carry their RID"""
+    from utils.pushport import read_partition, tables
+
+    names = {f"{YEAR}{MON}{DAY}{idx // 4:02d}{idx % 4 * 15:02d}00_PP": data for idx, data in enumerate(logs)}
+    wrong = 0
+    for table in tables:
+        rows = read_partition(store_path, table, YEAR, MON, DAY, columns=['rid', 'offset'])
+        for part, source in enumerate(rows['sources']):
+            data = names[os.path.basename(source).split('.')[0]]
+            selected = rows['part'] == part
+            for rid, offset in zip(rows['rid'][selected], rows['offset'][selected]):
+                end = data.index(b"\n", offset)
+                if not data[offset:end].startswith(b"<?xml") or b'rid="' + rid + b'"' not in data[offset:end]:
+                    wrong += 1
+    return wrong
+
+
+def run_bench(args):
+    sys.path.insert(0, FLOWS_DIR)
+    from utils.pushport import ingest_day
+
+    os.makedirs(args.workdir, exist_ok=True)
+    archive, logs = make_logs(args.logs, args.size, args.workdir)
+    cfg = SimpleNamespace(get_filepath_prefix=lambda year, mon, day: os.path.join(archive, year, mon, day))
+    store_path = os.path.join(args.workdir, "store")
+    total = sum(len(x) for x in logs)
+    print(f"{args.logs} logs, {total / 1024**2:.0f} MB of messages")
+
+    results = []
+    for workers in [int(x) for x in args.workers.split(',')]:
+        shutil.rmtree(store_path, ignore_errors=True)
+        started = time.perf_counter()
+        results = ingest_day("nrdp_logs", cfg, store_path, YEAR, MON, DAY, workers=workers)
+        seconds = time.perf_counter() - started
+        rows = sum(sum(x['rows'].values()) for x in results)
+        print(f"{workers:>3} workers{seconds:>9.2f}s {total / 1024**2 / seconds:>8.1f} MB/s "
+              f"{rows / seconds:>10.0f} rows/s")
+
+    expected = {'forecasts': 0, 'schedules': 0, 'deactivations': 0}
+    for data in logs:
+        for table, count in count_dom(data).items():
+            expected[table] += count
+    got = {table: sum(x['rows'].get(table, 0) for x in results) for table in expected}
+    print("rows: " + ", ".join(f"{count} {table}" for table, count in got.items()))
+    failed = [x['error'] for x in results if x['error']]
+    if got != expected:
+        failed.append(f"rows differ from the DOM parse {expected}")
+    wrong = check_offsets(store_path, logs)
+    if wrong:
+        failed.append(f"{wrong} rows with offsets not at their message")
+    if failed:
+        print(f"\nFailed: {'; '.join(failed)}")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of the Push Port log ingestion")
+    parser.add_argument("--logs", type=int, default=8, help="number of logs")
+    parser.add_argument("--size", type=int, default=12, help="MB of messages in each log")
+    parser.add_argument("--workers", default=f"1,{os.cpu_count() or 1}",
+                        help="comma separated numbers of processes to time")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "railcron-pushport"),
+                        help="where the logs and the store are kept")
+    sys.exit(run_bench(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
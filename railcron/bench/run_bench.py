@@ -0,0 +1,517 @@
+"""
+Offline end-to-end benchmarks of the flows
+
+The flows are run against the local stand-ins of bench/standins.py serving synthetic
+payloads (bench/payloads.py), with an ephemeral Prefect database, a temporary archive
+and a local rsync target, so nothing is fetched from Network Rail, NRDP or A51.
+
+Each flow is run in its own process. The functions of each stage of the flows are
+wrapped to measure the wall time, CPU time (including commands run), bytes/items and
+peak RSS of:
+    list:       listing of S3 prefixes/HDA blobs, Opendata authentication
+    download:   requests and the streaming of the data to disk
+    archive:    saving, manifest, dedup and delta of the files
+    recompress: unzip/tar/recompression of the files
+    replicate:  rsync to the backup target
+Times are exclusive (a stage called inside another is not counted twice). When stages
+run concurrently (hda_data downloads in threads) their CPU times overlap.
+
+Results are saved as results/<commit>.json (with -dirty when the tree has changes) so
+runs of different commits can be compared:
+
+    python bench/run_bench.py run --scale 0.1 --flows nrdp_logs,a51_trust
+    python bench/run_bench.py compare bench/results/abc1234.json bench/results/def5678.json
+"""
+import argparse
+from contextlib import contextmanager
+from datetime import datetime
+import functools
+import inspect
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FLOWS_DIR = os.path.join(os.path.dirname(BENCH_DIR), "flows")
+
+# flow -> module defining it
+flow_modules = {
+    'nrdp_logs': 'nrdp_data',
+    'a51_trust': 'a51_archive',
+    'a51_darwin': 'a51_archive',
+    'atoc_timetable': 'opendata',
+    'incidents': 'opendata',
+    'data_corpus': 'singlefile',
+    'sched_full_json': 'singlefile',
+    'hda_data': 'hda_data',
+}
+stages = ['list', 'download', 'archive', 'recompress', 'replicate']
+
+
+class Meter:
+    """Accumulates the measurements of the stages of a flow run"""
+
+    def __init__(self, interval=0.01):
+        self.stats = {}
+        self.local = threading.local()
+        self.active = {}
+        self.lock = threading.Lock()
+        self.peak_rss = 0
+        self.interval = interval
+        self.running = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    @staticmethod
+    def get_rss():
+        """Current resident memory of this process in bytes"""
+        try:
+            with open("/proc/self/statm", encoding='ascii') as fd:
+                return int(fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def sample(self):
+        while self.running:
+            rss = self.get_rss()
+            with self.lock:
+                self.peak_rss = max(self.peak_rss, rss)
+                for stage, count in self.active.items():
+                    if count:
+                        stat = self.stats[stage]
+                        stat['peak_rss'] = max(stat['peak_rss'], rss)
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.sampler.join()
+
+    @staticmethod
+    def get_cpu():
+        """CPU seconds of this process and of its finished children"""
+        times = os.times()
+        return times[0] + times[1] + times[2] + times[3]
+
+    @contextmanager
+    def measure(self, stage):
+        """Measures a call of a stage, yielding a dict to add its bytes/items to"""
+        stack = self.local.__dict__.setdefault('stack', [])
+        frame = {'bytes': 0, 'items': 0, 'child_seconds': 0.0, 'child_cpu': 0.0}
+        with self.lock:
+            self.stats.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'cpu_seconds': 0.0,
+                                          'bytes': 0, 'items': 0, 'peak_rss': 0})
+            self.active[stage] = self.active.get(stage, 0) + 1
+        stack.append(frame)
+        started, cpu = time.perf_counter(), self.get_cpu()
+        try:
+            yield frame
+        finally:
+            elapsed, used = time.perf_counter() - started, self.get_cpu() - cpu
+            stack.pop()
+            if stack:
+                stack[-1]['child_seconds'] += elapsed
+                stack[-1]['child_cpu'] += used
+            with self.lock:
+                self.active[stage] -= 1
+                stat = self.stats[stage]
+                stat['calls'] += 1
+                stat['seconds'] += elapsed - frame['child_seconds']
+                stat['cpu_seconds'] += max(used - frame['child_cpu'], 0)
+                stat['bytes'] += frame['bytes']
+                stat['items'] += frame['items']
+                stat['peak_rss'] = max(stat['peak_rss'], self.get_rss())
+
+
+def file_size(path):
+    """Size of a file (0 if it is not there)"""
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+def tree_size(path):
+    """Total size of the files under a directory"""
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+
+def response_size(resp):
+    """Bytes of a requests response already read (not those of a streaming one)"""
+    content = resp.__dict__.get('_content')
+    return len(content) if isinstance(content, bytes) else 0
+
+
+# name of the function/method -> (stage, function of (args, result, before) giving the bytes,
+#                                  function of args called before the call)
+probes = {
+    's3_list_objects': ('list', None, None),
+    'list_objects': ('list', None, None),
+    'list_blobs': ('list', None, None),
+    'authenticate': ('list', None, None),
+    'get_object_stream': ('download', None, None),
+    'get_https_s3_file': ('download', lambda a, r, b: response_size(r), None),
+    'get_file': ('download', lambda a, r, b: response_size(r), None),
+    'get_datafeeds_file': ('download', lambda a, r, b: response_size(r), None),
+    'write_chunks': ('download', lambda a, r, b: r['size'], None),
+    'archive_data_to_file': ('archive', lambda a, r, b: file_size(r), None),
+    'archive_atoc': ('archive', lambda a, r, b: file_size(r), None),
+    'archive_incidents': ('archive', lambda a, r, b: file_size(r), None),
+    'archive_file': ('archive', lambda a, r, b: file_size(r), None),
+    'record_file': ('archive', None, None),
+    'dedup_file': ('archive', None, None),
+    'file_changed': ('archive', None, None),
+    'store_delta': ('archive', None, None),
+    'unzip_file': ('recompress', lambda a, r, b: b, lambda a: file_size(a[0])),
+    'tar_and_compress': ('recompress', lambda a, r, b: b, lambda a: file_size(a[1])),
+    'recompress': ('recompress', lambda a, r, b: b, lambda a: file_size(a[1])),
+    'exec_rsync': ('replicate', lambda a, r, b: b, lambda a: tree_size(a[0].archive_path)),
+}
+
+
+def wrap(meter, func, stage, size_of, before):
+    """Wraps a function (sync, async, sync_compatible, Prefect task or generator) to measure it"""
+
+    def account(frame, args, result, pre):
+        if size_of is not None:
+            frame['bytes'] += size_of(args, result, pre) or 0
+        if isinstance(result, list):
+            frame['items'] += len(result)
+
+    target = getattr(func, 'aio', None) or getattr(func, 'fn', None) or func
+    if inspect.isgeneratorfunction(target):
+        @functools.wraps(func)
+        def gen_wrapper(*args, **kwargs):
+            items = func(*args, **kwargs)
+            while True:
+                with meter.measure(stage) as frame:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    frame['items'] += 1
+                yield item
+        return gen_wrapper
+
+    if inspect.iscoroutinefunction(target):
+        async def async_wrapper(*args, **kwargs):
+            pre = before(args) if before else None
+            with meter.measure(stage) as frame:
+                result = func(*args, **kwargs)
+                if inspect.isawaitable(result):
+                    result = await result
+                account(frame, args, result, pre)
+            return result
+        if hasattr(func, 'aio'):
+            # sync_compatible: awaited in async flows, called directly in sync ones
+            from prefect.utilities.asyncutils import sync_compatible
+            return sync_compatible(async_wrapper)
+        return functools.wraps(target)(async_wrapper)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        pre = before(args) if before else None
+        with meter.measure(stage) as frame:
+            result = func(*args, **kwargs)
+            account(frame, args, result, pre)
+        return result
+    return wrapper
+
+
+def instrument(meter, flow_module):
+    """Wraps the stage functions wherever the flows and utils modules refer to them"""
+    from utils import blocks, dedup, delta, files
+    from utils.blocks import a51, hda, nrdatafeeds, opendata
+
+    for module in (flow_module, files, dedup, delta, a51, hda, opendata, nrdatafeeds):
+        for name, (stage, size_of, before) in probes.items():
+            if name in vars(module) and callable(vars(module)[name]):
+                setattr(module, name, wrap(meter, vars(module)[name], stage, size_of, before))
+    for cls in (blocks.A51Block, blocks.HdaBlock, blocks.OpendataBlock, blocks.NrdatafeedsBlock,
+                blocks.Nrdfs3Block):
+        for name, (stage, size_of, before) in probes.items():
+            if name in vars(cls):
+                setattr(cls, name, wrap(meter, vars(cls)[name], stage, size_of, before))
+
+
+def write_config(cfg_dir, base_url, archive_root, replica, recompress):
+    """Writes the railcron.yml of the flows pointed at the stand-ins"""
+    import yaml
+    from standins import USERNAME, PASSWORD
+
+    def rsync(flow):
+        return f"rsync -rRa --ignore-existing ./ $BACKUP_ROOT/{flow}/"
+
+    config = {
+        'opendata': {'username': USERNAME, 'password': PASSWORD},
+        'nrdatafeeds': {'username': USERNAME, 'password': PASSWORD},
+        'settings': {'recompress': recompress or None, 'dedup': False, 'seekable': False,
+                     'cache_dir': None, 'cache_gb': 20,
+                     'BACKUP_HOST': "localhost" if replica else None,
+                     'BACKUP_ROOT': replica,
+                     'MAIL_FROM': None, 'MAIL_TO': None, 'MAIL_CC': None, 'MAIL_BCC': None,
+                     'MAIL_LOGIN': None, 'MAIL_PWD': None, 'MAIL_SRV': None, 'MAIL_TYPE': None,
+                     'MAIL_PORT': None},
+        'atoc_timetable': {'username': 'opendata__username', 'password': 'opendata__password',
+                           'data_url': f"{base_url}/api/staticfeeds/3.0/timetable", 'filetype': 'zip'},
+        'incidents': {'username': 'opendata__username', 'password': 'opendata__password',
+                      'data_url': f"{base_url}/api/staticfeeds/5.0/incidents", 'filetype': 'xml.gz'},
+        'nrdp_logs': {'aws_access_key_id': 'bench', 'aws_secret_access_key': 'bench',
+                      'region_name': 'eu-west-1', 'bucket': 'nrdp-v16-logs', 'key': 'logs/',
+                      'date_in_key': True, 'filetype': 'txt.gz', 'filter': 'yesterdays',
+                      'endpoint_url': base_url},
+        'a51_trust': {'key': 'archive/rail/trust/', 'filetype': 'tbz2', 'endpoint_url': base_url},
+        'a51_darwin': {'key': 'archive/rail/darwin/', 'filetype': 'gz', 'endpoint_url': base_url},
+        'data_corpus': {'username': 'nrdatafeeds__username', 'password': 'nrdatafeeds__password',
+                        'data_url': f"{base_url}/ntrod/SupportingFileAuthenticate",
+                        'params': {'type': 'CORPUS'}, 'filetype': 'json.gz'},
+        'sched_full_json': {'username': 'nrdatafeeds__username', 'password': 'nrdatafeeds__password',
+                            'data_url': f"{base_url}/ntrod/CifFileAuthenticate",
+                            'params': {'type': 'CIF_ALL_FULL_DAILY', 'day': 'toc-full'},
+                            'filetype': 'full.json.gz'},
+        'hda_data': {},
+    }
+    for flow, section in config.items():
+        if flow in flow_modules:
+            section['archive_path'] = os.path.join(archive_root, flow)
+            section['rsync'] = rsync(flow)
+    os.makedirs(cfg_dir, exist_ok=True)
+    with open(os.path.join(cfg_dir, "railcron.yml"), 'w', encoding='utf8') as fd:
+        yaml.safe_dump(config, fd)
+
+
+def run_worker(flow_name, date, base_url, output):
+    """Runs one flow in this process and writes its measurements to output"""
+    sys.path.insert(0, FLOWS_DIR)
+    import asyncio
+    import importlib
+
+    module = importlib.import_module(flow_modules[flow_name])
+    meter = Meter()
+    instrument(meter, module)
+
+    # the Literal URLs of these blocks can not be set in the config file
+    load_block = module.load_block
+
+    @functools.wraps(load_block)
+    def bench_load_block(block_type, block_name):
+        def point(block):
+            if block_type == 'opendata':
+                block.auth_url = f"{base_url}/authenticate"
+            if block_type == 'hda':
+                block.url = f"{base_url}/historic-delay-attribution"
+            return block
+        result = load_block(block_type, block_name)
+        if inspect.isawaitable(result):
+            async def pointed():
+                return point(await result)
+            return pointed()
+        return point(result)
+    module.load_block = bench_load_block
+
+    flow_func = getattr(module, flow_name)
+    year, mon, day = date
+    started, cpu = time.perf_counter(), Meter.get_cpu()
+    if flow_modules[flow_name] in ('nrdp_data', 'a51_archive'):
+        asyncio.run(flow_func(year=year, mon=mon, day=day))
+    else:
+        flow_func()
+    elapsed, used = time.perf_counter() - started, Meter.get_cpu() - cpu
+    meter.stop()
+
+    stats = {}
+    for stage in stages:
+        stat = meter.stats.get(stage)
+        if stat is None:
+            continue
+        stats[stage] = {'calls': stat['calls'],
+                        'seconds': round(stat['seconds'], 4),
+                        'cpu_seconds': round(stat['cpu_seconds'], 4),
+                        'bytes': stat['bytes'],
+                        'items': stat['items'],
+                        'mb_per_s': round(stat['bytes'] / 1024**2 / stat['seconds'], 2) if stat['seconds'] else None,
+                        'peak_rss_mb': round(stat['peak_rss'] / 1024**2, 1)}
+    archived = tree_size(os.path.join(os.environ['BENCH_ARCHIVE'], flow_name))
+    downloaded = stats.get('download', {}).get('bytes', 0)
+    result = {'seconds': round(elapsed, 4),
+              'cpu_seconds': round(used, 4),
+              'overhead_seconds': round(max(elapsed - sum(s['seconds'] for s in stats.values()), 0), 4),
+              'downloaded_bytes': downloaded,
+              'archived_bytes': archived,
+              'mb_per_s': round(downloaded / 1024**2 / elapsed, 2) if elapsed else None,
+              'peak_rss_mb': round(meter.peak_rss / 1024**2, 1),
+              'children_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+              'stages': stats}
+    with open(output, 'w', encoding='utf8') as fd:
+        json.dump(result, fd)
+
+
+def get_commit():
+    """Short hash of the commit of the tree (with -dirty if it has changes)"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, check=True,
+                                capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BENCH_DIR,
+                               capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+def run_bench(args):
+    """Runs the benchmarks of the flows and saves the results"""
+    sys.path.insert(0, BENCH_DIR)
+    from payloads import build_payloads
+    from standins import make_replica_dir, start_standins
+
+    flows = args.flows.split(',') if args.flows else list(flow_modules.keys())
+    unknown = [f for f in flows if f not in flow_modules]
+    if unknown:
+        raise Exception(f"Unknown flows: {', '.join(unknown)}")
+    date = [int(x) for x in args.date.split('-')]
+    print(f"Generating payloads (scale {args.scale}) in {args.payload_dir}")
+    manifest = build_payloads(args.payload_dir, date, args.scale, flows)
+    proc, base_url = start_standins(manifest, date)
+
+    results = {'commit': get_commit(), 'date': datetime.now().isoformat(timespec='seconds'),
+               'scale': args.scale, 'recompress': args.recompress,
+               'python': platform.python_version(), 'machine': platform.machine(),
+               'cpus': os.cpu_count(), 'flows': {}}
+    try:
+        for flow_name in flows:
+            for repeat in range(args.repeat):
+                # a fresh archive, Prefect database and config for every run
+                with tempfile.TemporaryDirectory(prefix="railcron-bench-") as workdir:
+                    archive_root = os.path.join(workdir, "archive")
+                    replica = make_replica_dir(workdir)
+                    write_config(workdir, base_url, archive_root, replica, args.recompress)
+                    env = dict(os.environ, RAILCRON_CFG=workdir, BENCH_ARCHIVE=archive_root,
+                               PREFECT_HOME=os.path.join(workdir, "prefect"),
+                               PREFECT_LOGGING_LEVEL=args.log_level)
+                    env.pop('PREFECT_API_URL', None)
+                    output = os.path.join(workdir, "result.json")
+                    print(f"Running {flow_name} ({repeat + 1}/{args.repeat})")
+                    subprocess.run([sys.executable, os.path.abspath(__file__), "worker", flow_name,
+                                    "--date", args.date, "--url", base_url, "--output", output],
+                                   cwd=FLOWS_DIR, env=env, check=True)
+                    with open(output, encoding='utf8') as fd:
+                        run = json.load(fd)
+                    if replica is None:
+                        run['stages'].pop('replicate', None)
+                        run['note'] = "rsync not installed, replicate not measured"
+                best = results['flows'].get(flow_name)
+                # the fastest of the repeats is kept
+                if best is None or run['seconds'] < best['seconds']:
+                    results['flows'][flow_name] = run
+    finally:
+        proc.terminate()
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    outpath = os.path.join(args.results_dir, f"{results['commit']}.json")
+    if os.path.exists(outpath):
+        # runs of other flows of the same commit and settings are kept
+        with open(outpath, encoding='utf8') as fd:
+            previous = json.load(fd)
+        if (previous['scale'], previous['recompress']) == (results['scale'], results['recompress']):
+            results['flows'] = dict(previous['flows'], **results['flows'])
+    with open(outpath, 'w', encoding='utf8') as fd:
+        json.dump(results, fd, indent=2)
+    print_results(results)
+    print(f"Results saved to {outpath}")
+    return outpath
+
+
+def print_results(results):
+    """Prints a table of the results of a run"""
+    print(f"\nCommit {results['commit']}  scale {results['scale']}  recompress {results['recompress']}")
+    print(f"{'flow':<16}{'stage':<12}{'seconds':>9}{'cpu':>9}{'MB':>10}{'MB/s':>9}{'RSS MB':>9}")
+    for flow_name, run in results['flows'].items():
+        print(f"{flow_name:<16}{'total':<12}{run['seconds']:>9.3f}{run['cpu_seconds']:>9.3f}"
+              f"{run['downloaded_bytes'] / 1024**2:>10.1f}{run['mb_per_s'] or 0:>9.2f}{run['peak_rss_mb']:>9.1f}")
+        for stage, stat in run['stages'].items():
+            print(f"{'':<16}{stage:<12}{stat['seconds']:>9.3f}{stat['cpu_seconds']:>9.3f}"
+                  f"{stat['bytes'] / 1024**2:>10.1f}{stat['mb_per_s'] or 0:>9.2f}{stat['peak_rss_mb']:>9.1f}")
+
+
+def compare(args):
+    """Compares the results of two runs, exits with 1 if the second one has regressed"""
+    with open(args.baseline, encoding='utf8') as fd:
+        base = json.load(fd)
+    with open(args.current, encoding='utf8') as fd:
+        current = json.load(fd)
+    if base['scale'] != current['scale']:
+        print(f"WARNING: scales differ ({base['scale']} vs {current['scale']})")
+    regressed = []
+    print(f"{base['commit']} -> {current['commit']}")
+    print(f"{'flow':<16}{'stage':<12}{'seconds':>20}{'change':>9}{'RSS MB':>16}{'change':>9}")
+
+    def row(flow_name, stage, old, new):
+        changes = []
+        for key in ('seconds', 'peak_rss_mb'):
+            pct = (new[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+            changes.append(pct)
+            # tiny stages are too noisy to flag
+            if pct > args.threshold and new[key] - old[key] > args.min_delta.get(key, 0):
+                regressed.append(f"{flow_name} {stage} {key} +{pct:.1f}%")
+        print(f"{flow_name:<16}{stage:<12}{old['seconds']:>9.3f} ->{new['seconds']:>8.3f}{changes[0]:>+8.1f}%"
+              f"{old['peak_rss_mb']:>7.1f} ->{new['peak_rss_mb']:>6.1f}{changes[1]:>+8.1f}%")
+
+    for flow_name, new_run in current['flows'].items():
+        old_run = base['flows'].get(flow_name)
+        if old_run is None:
+            continue
+        row(flow_name, 'total', old_run, new_run)
+        for stage, stat in new_run['stages'].items():
+            if stage in old_run['stages']:
+                row(flow_name, stage, old_run['stages'][stage], stat)
+    if regressed:
+        print("\nRegressions over {:.0f}%:\n  ".format(args.threshold) + "\n  ".join(regressed))
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the Railcron flows")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_cmd = commands.add_parser("run", help="benchmark the flows")
+    run_cmd.add_argument("--flows", default="", help="comma separated flows (default all): "
+                         + ", ".join(flow_modules.keys()))
+    run_cmd.add_argument("--scale", type=float, default=0.1, help="fraction of the real sizes of the files")
+    run_cmd.add_argument("--repeat", type=int, default=1, help="runs of each flow (fastest is kept)")
+    run_cmd.add_argument("--date", default="2022-07-21", help="day the flows fetch (YYYY-MM-DD)")
+    run_cmd.add_argument("--recompress", default="xz", help="recompress setting (blank to disable)")
+    run_cmd.add_argument("--payload-dir", default=os.path.join(tempfile.gettempdir(), "railcron-bench"),
+                         help="where generated payloads are kept")
+    run_cmd.add_argument("--results-dir", default=os.path.join(BENCH_DIR, "results"))
+    run_cmd.add_argument("--log-level", default="WARNING", help="Prefect logging level of the flows")
+
+    cmp_cmd = commands.add_parser("compare", help="compare the results of two runs")
+    cmp_cmd.add_argument("baseline")
+    cmp_cmd.add_argument("current")
+    cmp_cmd.add_argument("--threshold", type=float, default=10, help="percent increase flagged")
+
+    worker = commands.add_parser("worker")
+    worker.add_argument("flow")
+    worker.add_argument("--date")
+    worker.add_argument("--url")
+    worker.add_argument("--output")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run_bench(args)
+    elif args.command == "compare":
+        # seconds / MB increases below these are noise
+        args.min_delta = {'seconds': 0.05, 'peak_rss_mb': 5}
+        sys.exit(compare(args))
+    else:
+        run_worker(args.flow, [int(x) for x in args.date.split('-')], args.url, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""
+Local stand-ins of the upstream services used by the flows
+
+One threaded HTTP server (run in its own process so it does not count in the measurements
+of the flows) answers like:
+    - S3 (path style): ListObjectsV2 (paged) and GET/HEAD of objects with Range support,
+      for the NRDP buckets and the A51 CDN (also what its HTTPS downloads are pointed at)
+    - NR Opendata: POST /authenticate and the static feeds, checking the token
+    - NR Datafeeds: basic auth, then a redirect to the file as the real service does
+    - the Azure container listing (paged XML with NextMarker) and blobs of the HDA files
+
+It only speaks plain HTTP, there is no TLS in the measurements.
+
+make_smtp_server() is a minimal SMTP server (no TLS, any login accepted) that keeps the
+emails it receives and counts its connections, for the alerts of the flows.
+"""
+import base64
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import multiprocessing
+import os
+import shutil
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+import threading
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+
+TOKEN = "bench-token"
+USERNAME = "bench"
+PASSWORD = "bench"
+# keys per page of the S3 and HDA listings
+PAGE_SIZE = 1000
+HDA_PAGE_SIZE = 10
+LAST_MODIFIED = formatdate(1658361600, usegmt=True)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """Routes the requests of the flows to the payloads"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_data(self, data, content_type="application/xml", headers=None):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def send_status(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_object(self, obj, headers=None):
+        """Sends the file of an object, or the part of it asked for by a Range header"""
+        if obj['path'] is None:
+            return self.send_status(404)
+        size = obj['size']
+        start, end = 0, size - 1
+        status = 200
+        wanted = self.headers.get("Range")
+        if wanted and wanted.startswith("bytes="):
+            first, _, last = wanted[6:].partition('-')
+            start = int(first) if first else size - int(last)
+            end = min(int(last), size - 1) if (first and last) else size - 1
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command == "HEAD":
+            return None
+        with open(obj['path'], 'rb') as fd:
+            fd.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = fd.read(min(remaining, 1024*1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+        return None
+
+    def s3_listing(self, bucket, query):
+        """ListObjectsV2 of a bucket"""
+        prefix = query.get('prefix', [''])[0]
+        start = int(query.get('continuation-token', ['0'])[0])
+        keys = sorted(k for k in self.server.buckets.get(bucket, {}) if k.startswith(prefix))
+        page = keys[start:start + PAGE_SIZE]
+        truncated = start + PAGE_SIZE < len(keys)
+        contents = []
+        for key in page:
+            obj = self.server.buckets[bucket][key]
+            contents.append(f"<Contents><Key>{escape(key)}</Key>"
+                            f"<LastModified>{obj['last_modified']}</LastModified>"
+                            f"<ETag>&quot;{obj['md5']}&quot;</ETag><Size>{obj['size']}</Size>"
+                            f"<StorageClass>STANDARD</StorageClass></Contents>")
+        body = (f'<?xml version="1.0" encoding="UTF-8"?>'
+                f'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                f'<Name>{bucket}</Name><Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount>'
+                f'<MaxKeys>{PAGE_SIZE}</MaxKeys><IsTruncated>{str(truncated).lower()}</IsTruncated>'
+                + "".join(contents)
+                + (f"<NextContinuationToken>{start + PAGE_SIZE}</NextContinuationToken>" if truncated else "")
+                + "</ListBucketResult>")
+        self.send_data(body.encode('utf8'))
+
+    def hda_listing(self, query):
+        """Azure container listing of the HDA blobs"""
+        names = sorted(self.server.hda.keys())
+        start = int(query.get('marker', ['0'])[0])
+        page = names[start:start + HDA_PAGE_SIZE]
+        blobs = []
+        for name in page:
+            obj = self.server.hda[name]
+            blobs.append(f"<Blob><Name>{escape(name)}</Name><Url></Url><Properties>"
+                         f"<Last-Modified>{LAST_MODIFIED}</Last-Modified>"
+                         f"<Etag>0x8DA{obj['md5'][:13].upper()}</Etag>"
+                         f"<Content-Length>{obj['size']}</Content-Length></Properties></Blob>")
+        marker = start + HDA_PAGE_SIZE if start + HDA_PAGE_SIZE < len(names) else None
+        body = ('<?xml version="1.0" encoding="utf-8"?><EnumerationResults><Blobs>' + "".join(blobs)
+                + "</Blobs>" + (f"<NextMarker>{marker}</NextMarker>" if marker else "<NextMarker />")
+                + "</EnumerationResults>")
+        self.send_data(body.encode('utf8'))
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        body = parse_qs(self.rfile.read(length).decode('utf8'))
+        if url.path != "/authenticate":
+            return self.send_status(404)
+        if body.get('username', [''])[0] != USERNAME or body.get('password', [''])[0] != PASSWORD:
+            return self.send_status(401)
+        return self.send_data(json.dumps({"username": USERNAME, "token": TOKEN}).encode('utf8'),
+                              "application/json")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path
+        if path.startswith("/api/staticfeeds/"):
+            if self.headers.get("X-Auth-Token") != TOKEN:
+                return self.send_status(401)
+            obj = self.server.routes.get(path)
+            return self.send_object(obj, {"Content-Disposition": obj.get('disposition', ''),
+                                          "ETag": f"\"{obj['md5']}\""}) if obj else self.send_status(404)
+        if path.startswith("/ntrod/s3/"):
+            obj = self.server.routes.get(path)
+            return self.send_object(obj, {"ETag": f"\"{obj['md5']}\""}) if obj else self.send_status(404)
+        if path.startswith("/ntrod/"):
+            auth = self.headers.get("Authorization", "")
+            expected = base64.b64encode(f"{USERNAME}:{PASSWORD}".encode()).decode()
+            if auth != f"Basic {expected}":
+                return self.send_status(401)
+            for obj in self.server.routes.values():
+                if obj.get('params') and all(query.get(k, [None])[0] == v for k, v in obj['params'].items()):
+                    self.send_response(302)
+                    self.send_header("Location", obj['route'])
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return None
+            return self.send_status(404)
+        if path == "/historic-delay-attribution" and query.get('comp') == ['list']:
+            return self.hda_listing(query)
+        if path.startswith("/historic-delay-attribution/"):
+            obj = self.server.hda.get(path[len("/historic-delay-attribution/"):])
+            if obj is None:
+                return self.send_status(404)
+            md5 = base64.b64encode(bytes.fromhex(obj['md5'])).decode()
+            return self.send_object(obj, {"Content-MD5": md5, "ETag": f"0x8DA{obj['md5'][:13].upper()}"})
+        # S3, path style
+        bucket, _, key = path.lstrip('/').partition('/')
+        if not key and query.get('list-type') == ['2']:
+            return self.s3_listing(bucket, query)
+        obj = self.server.buckets.get(bucket, {}).get(key)
+        if obj is None:
+            return self.send_status(404)
+        return self.send_object(obj, {"ETag": f"\"{obj['md5']}\""})
+
+
+def make_server(manifest, date, port=0):
+    """HTTP server of the objects of a payload manifest (see payloads.build_payloads())"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandinHandler)
+    server.daemon_threads = True
+    server.routes = {obj['route']: obj for obj in manifest}
+    server.buckets = {}
+    server.hda = {}
+    last_modified = f"{date[0]}-{date[1]:02d}-{date[2]:02d}T08:30:02.000Z"
+    for obj in manifest:
+        if obj['flow'] in ('nrdp_logs', 'a51_trust', 'a51_darwin'):
+            bucket, _, key = obj['route'].lstrip('/').partition('/')
+            server.buckets.setdefault(bucket, {})[key] = dict(obj, last_modified=last_modified)
+        elif obj['flow'] == 'hda_data':
+            server.hda[obj['route'][len("/historic-delay-attribution/"):]] = obj
+    return server
+
+
+def serve(manifest, date, ready):
+    """Runs the server until the process is terminated, sending its port through ready"""
+    server = make_server(manifest, date)
+    ready.send(server.server_address[1])
+    server.serve_forever()
+
+
+def start_standins(manifest, date):
+    """Starts the stand-in server in a separate process
+
+       Returns: (process, base URL of the server)
+    """
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=serve, args=(manifest, date, child), daemon=True)
+    proc.start()
+    port = parent.recv()
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def make_replica_dir(root):
+    """Local rsync target (None when rsync is not installed)"""
+    if shutil.which("rsync") is None:
+        return None
+    target = os.path.join(root, "replica")
+    os.makedirs(target, exist_ok=True)
+    return target
+
+
+class SmtpStandinHandler(StreamRequestHandler):
+    """One SMTP session, saving each message as {maildir}/{n}.eml"""
+
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode('ascii'))
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self.reply("220 railcron-standin ESMTP")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf8', 'replace').strip()
+            verb = command.split(' ')[0].upper()
+            if verb == "EHLO":
+                self.reply("250-railcron-standin")
+                self.reply("250-AUTH PLAIN LOGIN")
+                self.reply("250 8BITMIME")
+            elif verb == "AUTH":
+                parts = command.split()
+                prompts = 2 if parts[1].upper() == "LOGIN" else (1 if len(parts) < 3 else 0)
+                for _ in range(prompts):
+                    self.reply("334 ")
+                    self.rfile.readline()
+                self.reply("235 Authentication successful")
+            elif verb == "MAIL":
+                recipients = []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.split(':', 1)[1].strip(" <>"))
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for line in iter(self.rfile.readline, b""):
+                    if line in (b".\r\n", b".\n"):
+                        break
+                    data.append(line[1:] if line.startswith(b"..") else line)
+                with self.server.lock:
+                    self.server.messages.append(recipients)
+                    filepath = os.path.join(self.server.maildir, f"{len(self.server.messages)}.eml")
+                with open(filepath, 'wb') as fd:
+                    fd.write(b"".join(data))
+                self.reply("250 OK")
+            elif verb in ("HELO", "NOOP", "RSET"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+def make_smtp_server(maildir, port=0):
+    """SMTP server saving the emails in maildir (run serve_forever() in a thread)
+
+       Its connections and messages (list of the recipients of each) attributes count what it received
+    """
+    os.makedirs(maildir, exist_ok=True)
+    server = ThreadingTCPServer(("127.0.0.1", port), SmtpStandinHandler)
+    server.daemon_threads = True
+    server.maildir = maildir
+    server.connections = 0
+    server.messages = []
+    server.lock = threading.Lock()
+    return server
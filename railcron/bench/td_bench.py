@@ -0,0 +1,160 @@
+"""
+Benchmark of the TD berth step index
+
+A synthetic day of TD messages (bench/payloads.py td_line, berth steps of 600 trains in
+6 areas with cancels, interposes and S-class updates mixed in) is archived as a51_td is
+(a .tbz2 of hourly files, or gzipped with --codec gz) and:
+    decode:    decoded into the sorted, indexed table of berth steps (utils/td.py get_steps)
+    scan:      the messages decoded line by line, as finding a train took before
+    queries:   "where was <headcode> between HH:MM and HH:MM" and "what went through
+               berth <area> <berth>", median and 95th percentile, each in a fresh BerthSteps
+Every query is checked against the steps found by the line by line scan.
+
+    python bench/td_bench.py --size 200 --queries 200
+
+Exits with 1 if an answer differs or the median query is over --max-ms.
+"""
+import argparse
+from collections import defaultdict
+from datetime import datetime
+import gzip
+import json
+import os
+import random
+import statistics
+import sys
+import tarfile
+import tempfile
+import time
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FLOWS_DIR = os.path.join(os.path.dirname(BENCH_DIR), "flows")
+
+YEAR, MON, DAY = "2022", "07", "21"
+
+
+def make_day(size, codec, workdir):
+    """Archived day of about size MB of messages (generated once)
+
+       Returns: (archive path, path of the day's file)
+    """
+    sys.path.insert(0, BENCH_DIR)
+    from payloads import make_tbz2, make_text, td_line
+
+    archive = os.path.join(workdir, f"td-{size}-{codec}")
+    filepath = os.path.join(archive, YEAR, MON, f"{DAY}.tbz2" if codec == 'tbz2' else f"{DAY}.json.gz")
+    if not os.path.exists(filepath):
+        hours = [make_text(td_line, size * 1024**2 // 24, hour) for hour in range(24)]
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath + ".tmp", 'wb') as fd:
+            if codec == 'tbz2':
+                fd.write(make_tbz2([(f"{hour:02d}.json", data) for hour, data in enumerate(hours)]))
+            else:
+                fd.write(gzip.compress(b"".join(hours), 6))
+        os.replace(filepath + ".tmp", filepath)
+    return archive, filepath
+
+
+def scan_python(filepath, codec):
+    """C-class messages of the day decoded line by line
+
+       Returns: dict of headcode -> list and (area, berth) -> list of (time, from, to, kind)
+    """
+    if codec == 'tbz2':
+        with tarfile.open(filepath, 'r:bz2') as tar:
+            lines = [line for member in tar if member.isfile() for line in tar.extractfile(member)]
+    else:
+        with gzip.open(filepath) as fd:
+            lines = fd.readlines()
+    by_headcode, by_berth = defaultdict(list), defaultdict(list)
+    for line in lines:
+        for message in json.loads(line):
+            for key, body in message.items():
+                if key not in ("CA_MSG", "CB_MSG", "CC_MSG"):
+                    continue
+                step = (int(body['time']), body.get('from', ""), body.get('to', ""), key[:2])
+                by_headcode[body['descr']].append(step)
+                for berth in {step[1], step[2]} - {""}:
+                    by_berth[(body['area_id'], berth)].append(step)
+    for steps in list(by_headcode.values()) + list(by_berth.values()):
+        steps.sort(key=lambda x: x[0])
+    return by_headcode, by_berth
+
+
+def to_steps(result):
+    return [(int(t), f.decode(), b.decode(), k.decode())
+            for t, f, b, k in zip(result['time'], result['from_berth'], result['to_berth'], result['kind'])]
+
+
+def run_bench(args):
+    sys.path.insert(0, BENCH_DIR)
+    sys.path.insert(0, FLOWS_DIR)
+    from payloads import td_trains
+    from utils.td import BerthSteps, get_steps
+
+    os.makedirs(args.workdir, exist_ok=True)
+    archive, filepath = make_day(args.size, args.codec, args.workdir)
+    cfg = SimpleNamespace(archive_path=archive, settings=SimpleNamespace(cache_dir=None, store_dir=None))
+
+    started = time.perf_counter()
+    steps = get_steps(cfg, YEAR, MON, DAY, refresh=True)
+    decode_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    by_headcode, by_berth = scan_python(filepath, args.codec)
+    scan_seconds = time.perf_counter() - started
+    print(f"{args.size} MB of messages ({os.path.basename(filepath)}): {steps.rows} berth steps")
+    print(f"{'decode into table':24}{decode_seconds:>8.2f}s {args.size / decode_seconds:>8.1f} MB/s")
+    print(f"{'scan line by line':24}{scan_seconds:>8.2f}s {args.size / scan_seconds:>8.1f} MB/s")
+
+    rng = random.Random(1)
+    zone = ZoneInfo("Europe/London")
+    berths = sorted(by_berth.keys())
+    times, mismatches = defaultdict(list), []
+    for _ in range(args.queries):
+        # data of hour h of the payloads is from h:00 UTC
+        hour = rng.randint(0, 22)
+        first = datetime.fromtimestamp(1658361600 + hour * 3600, zone)
+        start, end = first.strftime("%H:%M"), first.replace(minute=30).strftime("%H:%M")
+        low, high = int(first.timestamp() * 1000), int(first.replace(minute=30).timestamp() * 1000)
+        headcode = td_trains[int(rng.random() ** 2 * len(td_trains))][0]
+        started = time.perf_counter()
+        got = BerthSteps(steps.path).where(headcode, start, end)
+        times['where'].append(time.perf_counter() - started)
+        if to_steps(got) != [x for x in by_headcode[headcode] if low <= x[0] <= high]:
+            mismatches.append(f"where {headcode} {start}-{end}")
+        area, berth = rng.choice(berths)
+        started = time.perf_counter()
+        got = BerthSteps(steps.path).at_berth(area, berth)
+        times['at_berth'].append(time.perf_counter() - started)
+        if to_steps(got) != by_berth[(area, berth)]:
+            mismatches.append(f"at_berth {area} {berth}")
+    medians = {}
+    for name, values in times.items():
+        values.sort()
+        medians[name] = statistics.median(values) * 1000
+        print(f"{name + ' queries':24}{medians[name]:>8.2f} ms median, "
+              f"{values[int(len(values) * 0.95)] * 1000:.2f} ms p95 ({args.queries} queries)")
+    if mismatches:
+        print(f"\nFailed: answers differ from the line by line scan for {', '.join(mismatches[:10])}")
+        return 1
+    if max(medians.values()) > args.max_ms:
+        print(f"\nFailed: median query over {args.max_ms} ms")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode and query times of the TD berth step index")
+    parser.add_argument("--size", type=int, default=100, help="MB of messages in the day")
+    parser.add_argument("--codec", default="tbz2", choices=['tbz2', 'gz'], help="how the day is archived")
+    parser.add_argument("--queries", type=int, default=100, help="queries of each kind timed and checked")
+    parser.add_argument("--max-ms", type=float, default=20, help="median query time allowed")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "railcron-td"),
+                        help="where the day and the table are kept")
+    sys.exit(run_bench(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Benchmark of the ATOC timetable store
+
+A synthetic CIF timetable (bench/payloads.py make_cif, schedules along routes sharing
+hub stations, with overlays and cancellations) is archived as the flows do (ZIP, or tar
+recompressed with --codec) and:
+    parse:     parsed into the timetable store (utils/cif.py build_timetable)
+    python:    parsed line by line in Python, as consumers did before, into dicts
+    queries:   "trains calling at X on date D" answered from the store, median and
+               95th percentile of random TIPLOCs and dates, each in a fresh Timetable,
+               and from the dicts of the line by line parse
+Every query is checked against the line by line answer.
+
+    python bench/timetable_bench.py --size 256 --codec xz --queries 200
+
+Exits with 1 if an answer differs or the median query is over --max-ms.
+"""
+import argparse
+from collections import defaultdict
+from datetime import date, timedelta
+import io
+import os
+import random
+import statistics
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FLOWS_DIR = os.path.join(os.path.dirname(BENCH_DIR), "flows")
+
+# tar compression of each --codec (zip is the file as fetched)
+tar_modes = {'gz': 'w:gz', 'bz2': 'w:bz2', 'xz': 'w:xz'}
+
+
+def make_archive(size, codec, workdir):
+    """Archived timetable of about size MB of MCA records (generated once)
+
+       Returns: (path of the archive, MCA data)
+    """
+    sys.path.insert(0, BENCH_DIR)
+    from payloads import make_cif
+
+    mca = os.path.join(workdir, f"RJTTF{size:03d}.MCA")
+    if not os.path.exists(mca):
+        with open(mca + ".tmp", 'wb') as fd:
+            fd.write(make_cif(size * 1024**2, 200))
+        os.replace(mca + ".tmp", mca)
+    with open(mca, 'rb') as fd:
+        data = fd.read()
+    archive = os.path.join(workdir, f"RJTTF{size:03d}.ZIP" if codec == 'zip' else f"RJTTF{size:03d}.tar.{codec}")
+    if not os.path.exists(archive):
+        if codec == 'zip':
+            with zipfile.ZipFile(archive + ".tmp", 'w', zipfile.ZIP_DEFLATED) as zfile:
+                zfile.write(mca, os.path.basename(mca))
+        else:
+            with tarfile.open(archive + ".tmp", tar_modes[codec]) as tar:
+                info = tarfile.TarInfo(os.path.basename(mca))
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        os.replace(archive + ".tmp", archive)
+    return archive, data
+
+
+def to_date(yymmdd):
+    return date(2000 + int(yymmdd[:2]), int(yymmdd[2:4]), int(yymmdd[4:6]))
+
+
+def parse_python(data):
+    """Schedules of the MCA records parsed line by line
+
+       Returns: dict of uid -> list of (stp, from, to, days, calling TIPLOCs)
+    """
+    schedules = defaultdict(list)
+    current = None
+    for line in io.TextIOWrapper(io.BytesIO(data), encoding='ascii'):
+        kind = line[:2]
+        if kind == "BS":
+            end = date.max if line[15:21] == "999999" else to_date(line[15:21])
+            current = (line[79], to_date(line[9:15]), end, line[21:28], [])
+            schedules[line[3:9]].append(current)
+        elif kind in ("LO", "LT") or (kind == "LI" and not line[20:25].strip()):
+            current[4].append(line[2:9].strip())
+    return schedules
+
+
+def calls_python(schedules, tiploc, day):
+    """Train UIDs calling at a TIPLOC on a day (the schedule with the highest STP precedence)"""
+    uids = []
+    for uid, candidates in schedules.items():
+        running = [x for x in candidates if x[1] <= day <= x[2] and x[3][day.weekday()] == "1"]
+        if not running:
+            continue
+        applying = min(running, key=lambda x: "CNOP".index(x[0]))
+        if applying[0] != "C":
+            uids.extend([uid] * applying[4].count(tiploc))
+    return sorted(uids)
+
+
+def run_bench(args):
+    sys.path.insert(0, BENCH_DIR)
+    sys.path.insert(0, FLOWS_DIR)
+    from payloads import cif_hubs, cif_routes
+    from utils.cif import Timetable, build_timetable
+
+    os.makedirs(args.workdir, exist_ok=True)
+    archive, data = make_archive(args.size, args.codec, args.workdir)
+    path = os.path.join(args.workdir, "store", os.path.basename(archive).split('.')[0])
+
+    started = time.perf_counter()
+    rows = build_timetable(archive, path)
+    parse_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    schedules = parse_python(data)
+    python_seconds = time.perf_counter() - started
+    print(f"{len(data) / 1024**2:.0f} MB of MCA records ({os.path.basename(archive)}): "
+          + ", ".join(f"{count} {table}" for table, count in rows.items()))
+    print(f"{'parse into store':24}{parse_seconds:>8.2f}s {len(data) / 1024**2 / parse_seconds:>8.1f} MB/s")
+    print(f"{'parse line by line':24}{python_seconds:>8.2f}s {len(data) / 1024**2 / python_seconds:>8.1f} MB/s")
+
+    rng = random.Random(1)
+    tiplocs = cif_hubs + sorted({x for route in cif_routes for x in route})
+    times, python_times, mismatches = [], [], []
+    for _ in range(args.queries):
+        tiploc = rng.choice(cif_hubs) if rng.random() < 0.3 else rng.choice(tiplocs)
+        day = date(2022, 7, 1) + timedelta(days=rng.randint(0, 30))
+        started = time.perf_counter()
+        calls = Timetable(path).calls_at(tiploc, day)
+        times.append(time.perf_counter() - started)
+        got = sorted(x.decode() for x in calls['uid'])
+        started = time.perf_counter()
+        expected = calls_python(schedules, tiploc, day)
+        python_times.append(time.perf_counter() - started)
+        if got != expected:
+            mismatches.append(f"{tiploc} {day}")
+    times.sort()
+    median = statistics.median(times) * 1000
+    print(f"{'calls_at queries':24}{median:>8.2f} ms median, {times[int(len(times) * 0.95)] * 1000:.2f} ms p95"
+          f" ({args.queries} queries)")
+    print(f"{'line by line queries':24}{statistics.median(python_times) * 1000:>8.2f} ms median"
+          " (after the parse above)")
+    if mismatches:
+        print(f"\nFailed: answers differ from the line by line parse for {', '.join(mismatches[:10])}")
+        return 1
+    if median > args.max_ms:
+        print(f"\nFailed: median query over {args.max_ms} ms")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse and query times of the ATOC timetable store")
+    parser.add_argument("--size", type=int, default=64, help="MB of MCA records")
+    parser.add_argument("--codec", default="zip", choices=['zip'] + list(tar_modes.keys()),
+                        help="how the timetable is archived")
+    parser.add_argument("--queries", type=int, default=100, help="calls_at queries timed and checked")
+    parser.add_argument("--max-ms", type=float, default=50, help="median query time allowed")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "railcron-timetable"),
+                        help="where the timetable and the store are kept")
+    sys.exit(run_bench(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Benchmark of the TRUST movement analyses
+
+A synthetic day of TRUST messages (bench/payloads.py trust_line, arrays of movements of
+400 locations and 8 operators with activations mixed in) is archived as a51_trust is
+(a .tbz2 of hourly files, or gzipped with --codec gz) and:
+    decode:    decoded into the TRUST store (utils/trust.py get_movements)
+    cached:    the decoded day opened again from the store
+    python:    the messages looped over in Python, as analyses did before, accumulating
+               delays per location and operator
+    analyses:  on-time percentages and delay distributions per location and operator,
+               and delay percentiles per operator, with NumPy over the columns
+The answers are checked against the Python loop.
+
+    python bench/trust_bench.py --size 200 --codec tbz2
+
+Exits with 1 if an answer differs.
+"""
+import argparse
+from collections import defaultdict
+import gzip
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FLOWS_DIR = os.path.join(os.path.dirname(BENCH_DIR), "flows")
+
+YEAR, MON, DAY = "2022", "07", "21"
+
+
+def make_day(size, codec, workdir):
+    """Archived day of about size MB of messages (generated once)
+
+       Returns: (archive path, list of the hourly files)
+    """
+    sys.path.insert(0, BENCH_DIR)
+    from payloads import make_tbz2, make_text, trust_line
+
+    hours = [make_text(trust_line, size * 1024**2 // 24, hour) for hour in range(24)]
+    archive = os.path.join(workdir, f"trust-{size}-{codec}")
+    filepath = os.path.join(archive, YEAR, MON, f"{DAY}.tbz2" if codec == 'tbz2' else f"{DAY}.json.gz")
+    if not os.path.exists(filepath):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath + ".tmp", 'wb') as fd:
+            if codec == 'tbz2':
+                fd.write(make_tbz2([(f"{hour:02d}.json", data) for hour, data in enumerate(hours)]))
+            else:
+                fd.write(gzip.compress(b"".join(hours), 6))
+        os.replace(filepath + ".tmp", filepath)
+    return archive, filepath
+
+
+def analyse_python(filepath, codec, edges):
+    """Delays per location and operator, the messages looped over one by one
+
+       Returns: dict of (column, key) -> list of minutes late
+    """
+    delays = defaultdict(list)
+    if codec == 'tbz2':
+        with tarfile.open(filepath, 'r:bz2') as tar:
+            lines = [line for member in tar if member.isfile() for line in tar.extractfile(member)]
+    else:
+        with gzip.open(filepath) as fd:
+            lines = fd.readlines()
+    for line in lines:
+        for message in json.loads(line):
+            if message['header']['msg_type'] != "0003":
+                continue
+            body = message['body']
+            if not body['planned_timestamp']:
+                continue
+            minutes = int(body['timetable_variation'])
+            if body['variation_status'] == "EARLY":
+                minutes = -minutes
+            delays[('stanox', int(body['loc_stanox']))].append(minutes)
+            delays[('toc', body['toc_id'].encode())].append(minutes)
+    return delays
+
+
+def check_answers(movements, delays, edges):
+    """Analyses of the store that differ from the Python loop"""
+    wrong = []
+    for by in ('stanox', 'toc'):
+        keys, counts, percent = movements.on_time(by=by)
+        _, histogram = movements.delay_distribution(by=by, edges=edges)
+        for key, count, pct, row in zip(keys, counts, percent, histogram):
+            key = key.item() if by == 'stanox' else bytes(key)
+            expected = delays[(by, key)]
+            if count != len(expected) or abs(pct - 100 * sum(x <= 0 for x in expected) / len(expected)) > 1e-9:
+                wrong.append(f"on time of {by} {key}")
+            if list(row) != list(np.bincount(np.searchsorted(edges, expected, side='right'),
+                                             minlength=len(edges) + 1)):
+                wrong.append(f"distribution of {by} {key}")
+    keys, _, values = movements.delay_percentiles(by='toc', percentiles=(50, 90))
+    for key, row in zip(keys, values):
+        expected = np.percentile(delays[('toc', bytes(key))], (50, 90), method='lower')
+        if list(row) != list(expected):
+            wrong.append(f"percentiles of toc {key}")
+    return wrong
+
+
+def run_bench(args):
+    sys.path.insert(0, FLOWS_DIR)
+    from utils.trust import DELAY_EDGES, get_movements
+
+    os.makedirs(args.workdir, exist_ok=True)
+    archive, filepath = make_day(args.size, args.codec, args.workdir)
+    cfg = SimpleNamespace(archive_path=archive, settings=SimpleNamespace(cache_dir=None, store_dir=None),
+                          get_filepath_prefix=lambda year, mon, day=None: os.path.join(archive, year, mon))
+    edges = np.asarray(DELAY_EDGES)
+
+    started = time.perf_counter()
+    movements = get_movements(cfg, YEAR, MON, DAY, refresh=True)
+    decode_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    movements = get_movements(cfg, YEAR, MON, DAY)
+    cached_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    delays = analyse_python(filepath, args.codec, edges)
+    python_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for by in ('stanox', 'toc'):
+        movements.on_time(by=by)
+        movements.delay_distribution(by=by)
+    movements.delay_percentiles(by='toc')
+    analyses_seconds = time.perf_counter() - started
+
+    print(f"{args.size} MB of messages ({os.path.basename(filepath)}): {movements.rows} movements")
+    print(f"{'decode into store':24}{decode_seconds:>8.2f}s {args.size / decode_seconds:>8.1f} MB/s")
+    print(f"{'open cached day':24}{cached_seconds * 1000:>8.2f} ms")
+    print(f"{'analyses':24}{analyses_seconds * 1000:>8.2f} ms")
+    print(f"{'python loop':24}{python_seconds:>8.2f}s (decompress, parse and accumulate)")
+    wrong = check_answers(movements, delays, edges)
+    if wrong:
+        print(f"\nFailed: answers differ from the Python loop for {', '.join(wrong[:10])}")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode and analysis times of TRUST movements")
+    parser.add_argument("--size", type=int, default=100, help="MB of messages in the day")
+    parser.add_argument("--codec", default="tbz2", choices=['tbz2', 'gz'], help="how the day is archived")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "railcron-trust"),
+                        help="where the day and the store are kept")
+    sys.exit(run_bench(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,26 +9,34 @@ yesterday's month because archiving process delayed in zipping up files sometime
 """
 import asyncio
 import os
-from sys import argv, exc_info, modules
+from sys import argv, exc_info
 import traceback
 
 from prefect import flow, get_run_logger
 from prefect.task_runners import SequentialTaskRunner
 
 from utils.blocks import load_block, update_newfile_block
-from utils.files import archive_data_to_file, async_recompress, async_exec_rsync
-from utils.misc import create_flows, get_current_ymd, email_message
+from utils.dedup import dedup_file
+from utils.files import archive_data_to_file, recompress, exec_rsync, async_retry_corrupt
+from utils.metrics import publish_metrics, stage
+from utils.misc import create_flows, defer_flows, get_current_ymd, email_message, queue_flow_run
+from utils.profiling import start_profile, stop_profile
 
 # did not use S3 file system block because it is just a thin wrapper around s3fs
 # and did not use s3fs because would only use get_file() and no streaming support
 # Did not use s3_download() either because no streaming support
 
+# flow processing the files fetched by a flow (when "process" is set in its Block)
+process_flows = {'a51_trust': "A51 TRUST Movements", 'a51_td': "A51 TD Berth Steps"}
+
+
 def pass_filter(existing_files, filename, year, mon, day):
     """Filter for checking if current file is already in archive"""
     # can't do this because LastModified of files is the next day or even later
     # if not (x['LastModified'].year == int(yyear) and x['LastModified'].month == int(ymon) and
     #         x['LastModified'].day == int(yday)): continue
-    firstpart = os.path.splitext(filename)[0]
+    # compare up to the first '.' as recompaction may change the extension(s) of archived files
+    firstpart = filename.split('.')[0]
     if firstpart.isdigit() and int(firstpart) < 10:
         firstpart = "0" + firstpart
     if firstpart in existing_files:
@@ -46,19 +54,24 @@ def pass_filter(existing_files, filename, year, mon, day):
     return True
 
 
-async def process_object(cfg, year, mon, filename):
-    """Process S3 object and archive it when it passes filter"""
+async def process_object(cfg, year, mon, filename, obj):
+    """Process S3 object and archive it when it passes filter
+
+       The downloaded file is verified against the ETag and Size of the S3 object
+    """
     firstpart = os.path.splitext(filename)[0]
     data = await cfg.get_https_s3_file(year, mon, filename)
     # force day.tbz2 files to 0-day.tbz2
     if firstpart.isdigit() and int(firstpart) < 10:
         filename = "0" + filename
     filepath_prefix = cfg.get_filepath_prefix(year, mon)
-    filepath = archive_data_to_file(data, filepath_prefix, filename)
+    filepath = archive_data_to_file(data, filepath_prefix, filename,
+                                    expected={'etag': obj['ETag'], 'size': obj['Size']},
+                                    archive_path=cfg.archive_path, source=obj['Key'])
     # the tbz2 files are optimally compressed
     if os.path.splitext(filename)[1] == ".gz" and cfg.settings.recompress:
-        filepath = await async_recompress(cfg, filepath)
-    return filepath
+        filepath = await recompress(cfg, filepath)
+    return dedup_file(cfg, filepath)
 
 
 def flow_generator(fname):
@@ -79,16 +92,19 @@ def flow_generator(fname):
         nonlocal fname
         logger = get_run_logger()
         a51 = await load_block('a51', fname)
+        profiler = start_profile(fname, a51)
         try:
             if year is None:
                 year, mon, _ = get_current_ymd(yesterday=True, strip_zeros=True)
-            objects = await a51.list_objects(year=year, mon=mon)
+            with stage('list') as record:
+                objects = await a51.list_objects(year=year, mon=mon)
+                record.add(objects=len(objects))
             logger.debug(objects)
 
             existing_files = []
             fullpath = a51.get_filepath_prefix(year=year, mon=mon)
             if os.path.exists(fullpath):
-                existing_files = [os.path.splitext(os.path.basename(f))[0]
+                existing_files = [os.path.basename(f).split('.')[0]
                                   for f in os.scandir(fullpath) if f.is_file()]
             logger.debug(existing_files)
 
@@ -97,31 +113,41 @@ def flow_generator(fname):
                 filename = obj['Key'].replace(os.path.join(a51.key, str(year), str(mon)) + '/',"")
                 if not pass_filter(existing_files, filename, year, mon, day):
                     continue
-                filepath = await process_object(a51, year, mon, filename)
+                filepath = await async_retry_corrupt(process_object, a51, year, mon, filename, obj)
                 logger.info(f"Fetched {obj['Key']}")
 
             if filepath is None:
                 logger.error(f"NOTICE: A51 file for {fname} {year}-{mon} not present, no fetch")
             else:
-                output = await async_exec_rsync(a51)
+                output = await exec_rsync(a51)
                 if output: logger.debug(output)
                 logger.info(f"Flow {fname} got new file: {filepath}")
-                await update_newfile_block(fname, filepath)
+                await update_newfile_block(fname, filepath, a51)
+                if a51.process and fname in process_flows:
+                    parameters = {'year': year, 'mon': mon}
+                    if day is not None:
+                        parameters['day'] = day
+                    flow_run = await queue_flow_run(process_flows[fname], parameters)
+                    logger.info(f"Queued {process_flows[fname]} run {flow_run}")
         except Exception as err:
             msg = '<br/>'.join(traceback.format_exception(*exc_info()))
             logger.error(msg)
             email_message(a51, f"Error in Prefect Flow {fname}", msg)
             raise err
+        finally:
+            stop_profile(profiler)
+            publish_metrics(fname, a51, failed=exc_info()[0] is not None)
 
     infunc.__name__ = fname
     return flow(infunc, name=f"{fname}",
                 description="Fetches A51 Archive File from https://cdn.area51.onl/archive/rail/",
                 task_runner=SequentialTaskRunner())
 
-prefix_flows = create_flows(flow_generator, ['a51_'])
-for k, v in prefix_flows.items(): setattr(modules[__name__], k, v)
+# flows are only made when looked up (e.g. by the agent running a deployment), not on import
+__getattr__ = defer_flows(flow_generator, ['a51_'], __name__)
 
 if __name__ == "__main__":
+    prefix_flows = create_flows(flow_generator, ['a51_'])
     if argv[1] == 'all':
         for k, v in prefix_flows.items():
             print(f"\n\n RUNNING {k}")
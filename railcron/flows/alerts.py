@@ -0,0 +1,41 @@
+"""
+Alert Digest
+
+A Prefect Flow that sends the digest of the errors spooled by the other flows
+(alert_window setting, see utils/alerts.py) once the window of the oldest is over,
+so the last errors of an outage are reported even if no other flow fails after them.
+Scheduled every few minutes.
+"""
+from sys import argv
+
+from prefect import flow, get_run_logger
+from prefect.task_runners import SequentialTaskRunner
+
+from utils.alerts import close_smtp, flush_alerts
+from utils.blocks import load_block
+
+
+@flow(name="Alert Digest", task_runner=SequentialTaskRunner())
+def alert_digest(force: bool = False):
+    """Emails the digest of the spooled errors if it is due
+
+       Args:
+           force: True to send whatever is spooled now
+
+       Returns: number of (deduplicated) errors sent
+    """
+    logger = get_run_logger()
+    settings = load_block('railcron', 'settings')
+    try:
+        sent = flush_alerts(settings, force=force)
+    finally:
+        close_smtp()
+    if sent:
+        logger.info(f"Sent digest of {sent} errors")
+    else:
+        logger.info("No digest due")
+    return sent
+
+
+if __name__ == "__main__":
+    alert_digest(force=(len(argv) > 1 and argv[1] == 'force'))
@@ -0,0 +1,65 @@
+"""
+Archive Coverage Reporting
+
+A Prefect Flow that scans the archives of all configured flows and reports which
+days/hours/months of data are missing from them, optionally queueing runs of the
+NRDP and A51 flows to refetch the missing data.
+"""
+import json
+from sys import argv, exc_info
+import traceback
+
+from prefect import flow, get_run_logger
+from prefect.task_runners import SequentialTaskRunner
+
+from utils.blocks import block_types, load_block
+from utils.coverage import format_report, get_repair_parameters, scan_archives
+from utils.misc import email_message, get_flow_names, queue_flow_run
+
+
+@flow(name="Archive Coverage", task_runner=SequentialTaskRunner())
+def archive_coverage(since: str = None, until: str = None, repair: bool = False,
+                     report_path: str = None):
+    """Builds a coverage report of the archives of all configured flows
+
+       Args:
+           since: "year-mon-day" of first date to check
+                  Default of None means from the start of each archive
+           until: "year-mon-day" of last date to check
+                  Default of None means yesterday
+           repair: True to queue deployment runs that refetch missing data
+                   (only possible for nrdp_ and a51_ flows)
+           report_path: Optional path of a JSON file to save the report to
+
+       Returns: dictionary of flow name -> coverage of the flow's archive
+    """
+    logger = get_run_logger()
+    cfg = None
+    try:
+        flow_cfgs = {}
+        for fname in get_flow_names([x for x in block_types.keys() if x != 'settings']):
+            cfg = load_block(block_types[fname.split('_')[0]], fname)
+            flow_cfgs[fname] = cfg
+        report = scan_archives(flow_cfgs, since=since, until=until)
+        for line in format_report(report):
+            logger.info(line)
+        if report_path:
+            with open(report_path, 'w', encoding='utf8') as fd:
+                json.dump(report, fd, indent=2)
+
+        if repair:
+            for fname, info in report.items():
+                for params in get_repair_parameters(fname, info['missing']):
+                    flow_run_id = queue_flow_run(fname, params)
+                    logger.info(f"Queued {fname} run {flow_run_id} with {params}")
+        return report
+    except Exception as err:
+        msg = '<br/>'.join(traceback.format_exception(*exc_info()))
+        logger.error(msg)
+        if cfg is not None:
+            email_message(cfg, "Error in Prefect Flow archive_coverage", msg)
+        raise err
+
+
+if __name__ == "__main__":
+    archive_coverage(repair=(len(argv) > 1 and argv[1] == 'repair'))
@@ -0,0 +1,53 @@
+"""
+Deduplication Reporting
+
+A Prefect Flow that reports how much space the content-addressed stores of the
+archives of all configured flows save, optionally removing unused blobs.
+"""
+import os
+from sys import argv, exc_info
+import traceback
+
+from prefect import flow, get_run_logger
+from prefect.task_runners import SequentialTaskRunner
+
+from utils.blocks import block_types, load_block
+from utils.dedup import get_dedup_report, prune_blobs
+from utils.misc import email_message, get_flow_names
+
+
+@flow(name="Dedup Report", task_runner=SequentialTaskRunner())
+def dedup_report(prune: bool = False):
+    """Logs the dedup ratio (logical bytes / stored bytes) of each archive
+
+       Args:
+           prune: True to remove blobs no longer linked into any archive
+
+       Returns: dictionary of archive_path -> dedup report
+    """
+    logger = get_run_logger()
+    cfg = None
+    try:
+        reports = {}
+        for fname in get_flow_names([x for x in block_types.keys() if x != 'settings']):
+            cfg = load_block(block_types[fname.split('_')[0]], fname)
+            if not cfg.archive_path or not os.path.isdir(cfg.archive_path) or cfg.archive_path in reports:
+                continue
+            if prune:
+                logger.info(f"Pruned {prune_blobs(cfg.archive_path)} bytes of blobs from {cfg.archive_path}")
+            reports[cfg.archive_path] = get_dedup_report(cfg.archive_path)
+            info = reports[cfg.archive_path]
+            logger.info(f"{cfg.archive_path}: {info['files']} files of {info['logical_bytes']} bytes "
+                        f"stored as {info['unique_files']} files of {info['stored_bytes']} bytes "
+                        f"(ratio {info['ratio']})")
+        return reports
+    except Exception as err:
+        msg = '<br/>'.join(traceback.format_exception(*exc_info()))
+        logger.error(msg)
+        if cfg is not None:
+            email_message(cfg, "Error in Prefect Flow dedup_report", msg)
+        raise err
+
+
+if __name__ == "__main__":
+    dedup_report(prune=(len(argv) > 1 and argv[1] == 'prune'))
@@ -4,70 +4,119 @@ Network Rail HDA Data Fetching
 A Prefect Flow that downloads new HDA related ZIP/CSVs from
 https://www.networkrail.co.uk/who-we-are/transparency-and-ethics/transparency/open-data-feeds/
 """
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextvars import copy_context
 import os
 from sys import exc_info
 import traceback
-import xml.dom.minidom
 
 from prefect import flow, get_run_logger
+from prefect.blocks.core import Block
+from prefect.blocks.system import JSON
 from prefect.task_runners import SequentialTaskRunner
 
 from utils.blocks import load_block, update_newfile_block
-from utils.files import exec_rsync, tar_and_compress, unzip_file
+from utils.dedup import dedup_file
+from utils.files import exec_rsync, retry_corrupt, tar_and_compress, unzip_file
+from utils.manifest import record_file
+from utils.metrics import publish_metrics, stage
 from utils.misc import email_message
+from utils.profiling import start_profile, stop_profile
 
 
-# List of new HDA files embedded within a XML chunk in the main HTML page
+# List of new HDA files is the XML listing of the Azure blob container behind the main HTML page
 # So have to parse it and find new files
 # thus using RemoteFileSystem not straightforward compared to this function
 
+def fetch_blob(hda, blob):
+    """Downloads a HDA file and saves it to the archive (retried if corrupt)"""
+    def fetch():
+        data = hda.get_file(other_url=blob['Url'], streaming=True)
+        return hda.archive_file(data, blob['Name'])
+    return retry_corrupt(fetch)
+
+
+def get_existing_files(archive_path):
+    """Names of the original files already in the archive (before any ETags were recorded)"""
+    existing_files = []
+    if os.path.exists(archive_path):
+        filelist = os.walk(archive_path)
+        existing_files = [d[0] + '/' + f for d in filelist for f in d[2] if d[2]]
+        # originals are .zips so compare to .tar.? files
+        existing_files = [
+            f.replace(archive_path + '/', "").replace(
+                ".tar" + os.path.splitext(f)[1], ".zip")
+            for f in existing_files]
+    return existing_files
+
+
 @flow(name="NR HDA Data", task_runner=SequentialTaskRunner())
-def hda_data(debugging=False):
+def hda_data(debugging=False, max_workers: int = 4):
     """Fetches new Historic Delay Attribution CSVs from NR website
        https://www.networkrail.co.uk/who-we-are/transparency-and-ethics/transparency/open-data-feeds/
 
-       List of available files is in a section on the main page
-       Gets that section, determines if any entries are new compared to existing list of files
+       List of available files is in the (paged) XML listing of the container they are stored in.
+       Files that are new or whose ETag has changed since they were last fetched are downloaded
+       in parallel. The ETags are kept in the "hda-data-etags" JSON Block.
     """
     logger = get_run_logger()
     hda = load_block('hda', 'hda_data')
+    profiler = start_profile("hda_data", hda)
     try:
-        xmldata = hda.get_file()
-        thelist = xml.dom.minidom.parseString(xmldata.content)
-        all_zips = thelist.getElementsByTagName('Name')
-        for x in all_zips: logger.debug(x.firstChild.nodeValue)
-
-        existing_files = []
-        if os.path.exists(hda.archive_path):
-            filelist = os.walk(hda.archive_path)
-            existing_files = [d[0] + '/' + f for d in filelist for f in d[2] if d[2]]
-            # originals are .zips so compare to .tar.? files
-            existing_files = [
-                f.replace(hda.archive_path + '/', "").replace(
-                    ".tar" + os.path.splitext(f)[1], ".zip")
-                for f in existing_files]
-        logger.debug(existing_files)
+        try:
+            etags = Block.load("json/hda-data-etags")
+        except ValueError:
+            # first time, so files already archived are known by name only
+            etags = JSON(value={name: None for name in get_existing_files(hda.archive_path)})
+
+        to_fetch = []
+        with stage('list') as record:
+            for blob in hda.list_blobs():
+                logger.debug(blob)
+                record.add(objects=1)
+                name = blob['Name']
+                if name in etags.value and etags.value[name] in (None, blob['Etag']):
+                    etags.value[name] = blob['Etag']
+                    continue
+                to_fetch.append(blob)
+                if debugging: break
 
         zipfile = None
-        for hda_node in all_zips:
-            zip_name = hda_node.firstChild.nodeValue
-            if zip_name not in existing_files:
-                logger.info(f"Fetching {zip_name}")
-                data = hda.get_file(other_url=hda_node.nextSibling.firstChild.nodeValue, streaming=True)
-                zipfile = hda.archive_file(data, zip_name)
+        failure = None
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(copy_context().run, fetch_blob, hda, blob): blob
+                       for blob in to_fetch}
+            for future in as_completed(futures):
+                blob = futures[future]
+                try:
+                    zipfile = future.result()
+                except Exception as exc:
+                    logger.error(f"Failed to fetch {blob['Name']}: {exc}")
+                    failure = exc
+                    continue
+                logger.info(f"Fetched {blob['Name']} ({blob['Content-Length']} bytes)")
+                # recompression is already multithreaded, so one file at a time
                 if zipfile.endswith(".zip") and hda.settings.recompress:
                     zipfile = tar_and_compress(hda.settings.recompress, zipfile, unzip_file(zipfile))
-            if debugging: break
+                record_file(hda.archive_path, zipfile, source=blob['Url'], etag=blob['Etag'])
+                dedup_file(hda, zipfile)
+                etags.value[blob['Name']] = blob['Etag']
+        etags.save(name="hda-data-etags", overwrite=True)
+        if failure is not None:
+            raise failure
 
         if zipfile is not None:
             logger.debug(exec_rsync(hda))
             logger.info(f"Flow hda_data got new file: {zipfile}")
-            update_newfile_block("hda_data", zipfile)
+            update_newfile_block("hda_data", zipfile, hda)
     except Exception as err:
         msg = '<br/>'.join(traceback.format_exception(*exc_info()))
         logger.error(msg)
         email_message(hda, "Error in Prefect Flow hda_data", msg)
         raise err
+    finally:
+        stop_profile(profiler)
+        publish_metrics("hda_data", hda, failed=exc_info()[0] is not None)
 
 
 if __name__ == "__main__":
@@ -6,16 +6,21 @@ well as nrdp-v16-logs related files (location, reference, logs)
 from NRDP's S3 repositories.
 """
 import asyncio
-from sys import argv, exc_info, modules
+import os
+from sys import argv, exc_info
 import traceback
 
 from prefect import flow, get_run_logger
 from prefect.task_runners import SequentialTaskRunner
-from prefect_aws.s3 import s3_download, s3_list_objects
+from prefect_aws.s3 import s3_list_objects
 
 from utils.blocks import load_block, update_newfile_block
-from utils.files import archive_data_to_file, async_recompress, async_exec_rsync
-from utils.misc import get_current_ymd, create_flows, email_message
+from utils.dedup import dedup_file
+from utils.files import archive_data_to_file, recompress, exec_rsync, async_retry_corrupt
+from utils.metrics import publish_metrics, stage
+from utils.misc import get_current_ymd, get_date_range, create_flows, defer_flows, email_message, queue_flow_run
+from utils.pack import get_pack_path
+from utils.profiling import start_profile, stop_profile
 
 # S3 objects in lists
 # {'Key': 'darwin_direct/20220727092930_PP.log.gz',
@@ -23,64 +28,193 @@ from utils.misc import get_current_ymd, create_flows, email_message
 #  'ETag': '"127ed5aba74a15ef3e5f0e297af5962c"',
 #  'Size': 13240, 'StorageClass': 'STANDARD'},
 
+# flow processing the files fetched by a flow (when "process" is set in its Block)
+process_flows = {'nrdp_logs': "DARWIN Push Port Ingest"}
+
+
+def get_key_prefix(nrdf, year, mon):
+    """Deals with any S3 path / prefix requirements of the Block"""
+    prefi = nrdf.key
+    if nrdf.date_in_key:
+        # have to worry about subdirectories?
+        mons = str(mon) if int(mon) > 9 else "0" + str(int(mon))
+        prefi += f"{year}/{year}{mons}/"
+    return prefi
+
+
+def modified_on(obj):
+    """Returns zero padded [year, mon, day] of an S3 object's LastModified"""
+    modified = obj['LastModified']
+    return [str(modified.year), f"{modified.month:02d}", f"{modified.day:02d}"]
+
+
+async def fetch_object(nrdf, obj, prefi, year, mon, day):
+    """Downloads an S3 object and archives it under the directory for year/mon/day
+
+       The object is streamed to its file, so it is never held in memory, and
+       verified against the ETag and Size of the S3 object
+    """
+    logger = get_run_logger()
+    filename = obj['Key'].replace(prefi, "")
+    logger.info(f"Getting new file {filename}")
+    if int(mon) < 10: mon = "0" + str(int(mon))
+    if int(day) < 10: day = "0" + str(int(day))
+    # assumption of files do not already exist - check?
+    filepath_prefix = nrdf.get_filepath_prefix(year, mon, day)
+    loop = asyncio.get_running_loop()
+    # the download stage is recorded by archive_data_to_file as the object is streamed
+    body = await loop.run_in_executor(None, nrdf.get_object_stream, obj['Key'])
+    filepath = await loop.run_in_executor(
+        None, lambda: archive_data_to_file(body, filepath_prefix, filename, streaming=True,
+                                           expected={'etag': obj['ETag'], 'size': obj['Size']},
+                                           archive_path=nrdf.archive_path, source=obj['Key']))
+    if nrdf.settings.recompress:
+        filepath = await recompress(nrdf, filepath)
+    return dedup_file(nrdf, filepath)
+
+
+async def fetch_range(nrdf, aws_creds, start, end, concurrency=4):
+    """Fetches the files of every missing day from start to end (inclusive)
+
+       Each month's S3 prefix is listed only once and each object is fetched
+       for at most one day. As for a single day, the objects are bucketed by
+       the day of their LastModified if the Block has a filter. Without one, a
+       single-day run takes every object under the prefix, so each object goes
+       to the day of its LastModified if it is missing, else to the last
+       missing day of its prefix. Days that already have a non-empty
+       directory under the archive_path are skipped.
+
+       Args:
+           nrdf: Nrdfs3Block of the flow
+           aws_creds: AwsCredentials to access the S3 bucket with
+           start: [year, mon, day] of first day
+           end: [year, mon, day] of last day
+           concurrency: Maximum number of simultaneous downloads
+
+       Returns: path of the last file fetched or None
+    """
+    logger = get_run_logger()
+    wanted = {}
+    for year, mon, day in get_date_range(start, end):
+        filepath_prefix = nrdf.get_filepath_prefix(year, mon, day)
+        if (os.path.isdir(filepath_prefix) and os.listdir(filepath_prefix)) \
+                or os.path.exists(get_pack_path(filepath_prefix)):
+            logger.debug(f"Already have files for {year}-{mon}-{day}")
+            continue
+        wanted[(year, mon, day)] = []
+    if not wanted:
+        logger.info("No missing days in range, no fetch")
+        return None
+
+    # without a date in the key all days share the same prefix
+    prefixes = sorted({get_key_prefix(nrdf, year, mon) for year, mon, _ in wanted.keys()})
+    for prefi in prefixes:
+        with stage('list') as record:
+            objects = await s3_list_objects(bucket=nrdf.bucket,
+                                            aws_credentials=aws_creds,
+                                            aws_client_parameters=nrdf.get_client_parameters(),
+                                            prefix=prefi)
+            record.add(objects=len(objects))
+        logger.debug(objects)
+        prefix_days = [x for x in sorted(wanted.keys()) if get_key_prefix(nrdf, x[0], x[1]) == prefi]
+        for obj in objects:
+            if obj['Key'].replace(prefi, "") == "": continue
+            the_day = tuple(modified_on(obj))
+            if the_day not in prefix_days:
+                if nrdf.filter:
+                    continue
+                the_day = prefix_days[-1]
+            wanted[the_day].append((prefi, obj))
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_day(the_day, day_objects):
+        filepath = None
+        for prefi, obj in day_objects:
+            async with semaphore:
+                filepath = await async_retry_corrupt(fetch_object, nrdf, obj, prefi, *the_day)
+        if filepath is None:
+            logger.warning(f"NOTICE: No files for {'-'.join(the_day)} present upstream")
+        return filepath
+
+    results = await asyncio.gather(*[fetch_day(k, v) for k, v in sorted(wanted.items())])
+    fetched = [f for f in results if f is not None]
+    return fetched[-1] if fetched else None
+
+
 def flow_generator(fname):
     """Generator of flow functions based on configurations in YAML cfg"""
 
-    async def infunc(year: int = None, mon: int = None, day: int = None):
+    async def infunc(year: int = None, mon: int = None, day: int = None,
+                     end_year: int = None, end_mon: int = None, end_day: int = None):
+        """Fetch files based on the NRDP S3 Block configuration
+
+           Args:
+               year / mon / day: Date of files to get
+                     Default of None means today's or yesterday's files
+                     as determined by the filter set in the Block
+               end_year / end_mon / end_day: Last date of a range to backfill
+                     If specified (all three), missing days from year/mon/day
+                     up to this date are all fetched in this flow run
+        """
         nonlocal fname
         logger = get_run_logger()
         nrdf = await load_block('nrdfs3', fname)
+        profiler = start_profile(fname, nrdf)
         try:
+            ends = [end_year, end_mon, end_day]
+            if None in ends and ends != [None, None, None]:
+                raise Exception("end_year, end_mon and end_day must be given together")
             if year is None:
                 year, mon, day = get_current_ymd(yesterday=(nrdf.filter == 'yesterdays'))
             aws_creds = nrdf.get_credentials()
-            # deal with any S3 path / prefix requirements
-            prefi = nrdf.key
-            # If y/m/d not explicitly specified, then flow gets either today's
-            # file or yesterday's as determined by the filter set in the Block
-            if nrdf.date_in_key:
-                # have to worry about subdirectories?
-                mons = str(mon) if int(mon) > 9 else "0" + str(int(mon))
-                prefi += f"{year}/{year}{mons}/"
-
-            objects = await s3_list_objects(bucket=nrdf.bucket,
-                                            aws_credentials=aws_creds,
-                                            prefix=prefi)
-            logger.debug(objects)
 
             filepath = None
-            for obj in objects:
-                if nrdf.filter:
-                    to_filter = (not (obj['LastModified'].year == int(year) and
-                                      obj['LastModified'].month == int(mon) and
-                                      obj['LastModified'].day == int(day)))
-                    if to_filter:
-                        continue
-                filename = obj['Key'].replace(prefi, "")
-                if filename == "": continue
-
-                logger.info(f"Getting new file {filename}")
-                fdata = await s3_download(bucket=nrdf.bucket, key=obj['Key'],
-                                          aws_credentials=aws_creds)
-                if int(mon) < 10: mon = "0" + str(int(mon))
-                if int(day) < 10: day = "0" + str(int(day))
-                # assumption of files do not already exist - check?
-                filepath_prefix = nrdf.get_filepath_prefix(year, mon, day)
-                filepath = archive_data_to_file(fdata, filepath_prefix, filename,
-                                                streaming=False)
-                if nrdf.settings.recompress:
-                    filepath = await async_recompress(nrdf, filepath)
+            if end_year is not None:
+                filepath = await fetch_range(nrdf, aws_creds, [year, mon, day],
+                                             [end_year, end_mon, end_day])
+            else:
+                prefi = get_key_prefix(nrdf, year, mon)
+                with stage('list') as record:
+                    objects = await s3_list_objects(bucket=nrdf.bucket,
+                                                    aws_credentials=aws_creds,
+                                                    aws_client_parameters=nrdf.get_client_parameters(),
+                                                    prefix=prefi)
+                    record.add(objects=len(objects))
+                logger.debug(objects)
+
+                for obj in objects:
+                    # If y/m/d not explicitly specified, then flow gets either today's
+                    # file or yesterday's as determined by the filter set in the Block
+                    if nrdf.filter:
+                        to_filter = (not (obj['LastModified'].year == int(year) and
+                                          obj['LastModified'].month == int(mon) and
+                                          obj['LastModified'].day == int(day)))
+                        if to_filter:
+                            continue
+                    if obj['Key'].replace(prefi, "") == "": continue
+                    filepath = await async_retry_corrupt(fetch_object, nrdf, obj, prefi,
+                                                         year, mon, day)
 
             if filepath is not None:
-                output = await async_exec_rsync(nrdf)
+                output = await exec_rsync(nrdf)
                 if output: logger.debug(output)
                 logger.info(f"Flow {fname} got new file: {filepath}")
-                await update_newfile_block(fname, filepath)
+                await update_newfile_block(fname, filepath, nrdf)
+                if nrdf.process and fname in process_flows:
+                    parameters = {'year': year, 'mon': mon, 'day': day}
+                    if end_year is not None:
+                        parameters.update(end_year=end_year, end_mon=end_mon, end_day=end_day)
+                    flow_run = await queue_flow_run(process_flows[fname], parameters)
+                    logger.info(f"Queued {process_flows[fname]} run {flow_run}")
         except Exception as err:
             msg = '<br/>'.join(traceback.format_exception(*exc_info()))
             logger.error(msg)
             email_message(nrdf, f"Error in Prefect Flow {fname}", msg)
             raise err
+        finally:
+            stop_profile(profiler)
+            publish_metrics(fname, nrdf, failed=exc_info()[0] is not None)
 
     infunc.__name__ = fname
     return flow(infunc, name=f"{fname}",
@@ -88,10 +222,11 @@ def flow_generator(fname):
                 task_runner=SequentialTaskRunner())
 
 
-prefix_flows = create_flows(flow_generator, ['nrdp_'])
-for k, v in prefix_flows.items(): setattr(modules[__name__], k, v)
+# flows are only made when looked up (e.g. by the agent running a deployment), not on import
+__getattr__ = defer_flows(flow_generator, ['nrdp_'], __name__)
 
 if __name__ == "__main__":
+    prefix_flows = create_flows(flow_generator, ['nrdp_'])
     if argv[1] == 'all':
         for k, v in prefix_flows.items():
             # testing nrdp_logs involves many files
@@ -100,4 +235,5 @@ if __name__ == "__main__":
             asyncio.run(v())
     else:
         # asyncio.run(prefix_flows[argv[1]](year=2022, mon=10, day=16))
+        # asyncio.run(prefix_flows[argv[1]](year=2022, mon=10, day=1, end_year=2022, end_mon=10, end_day=16))
         asyncio.run(prefix_flows[argv[1]]())
@@ -12,55 +12,77 @@ from prefect import flow, get_run_logger
 from prefect.task_runners import SequentialTaskRunner
 
 from utils.blocks import load_block, update_newfile_block
-from utils.files import recompress, exec_rsync, tar_and_compress, unzip_file
-from utils.misc import email_message
+from utils.dedup import dedup_file
+from utils.files import recompress, exec_rsync, retry_corrupt, tar_and_compress, unzip_file
+from utils.manifest import record_file
+from utils.metrics import publish_metrics
+from utils.misc import email_message, queue_flow_run
+from utils.profiling import start_profile, stop_profile
 
 # Can not use RemoteFileSystem / fsspec to download file due to issues with redirects
 # and fsspec expects a standard file system type of logic using file objects things
 # e.g https://.../filename.txt
 
+def fetch_atoc(opendata):
+    """Downloads the ATOC timetable ZIP and archives it"""
+    auth_data = opendata.authenticate()
+    data = opendata.get_file(auth_data, streaming=True)
+    return opendata.archive_atoc(data)
+
+
 @flow(task_runner=SequentialTaskRunner())
 def atoc_timetable():
     """Fetches latest ATOC Timetable *TTF ZIP from https://opendata.nationalrail.co.uk/"""
     logger = get_run_logger()
     opendata = load_block('opendata', 'atoc_timetable')
+    profiler = start_profile("atoc_timetable", opendata)
     try:
-        auth_data = opendata.authenticate()
-        data = opendata.get_file(auth_data, streaming=True)
-        filepath = opendata.archive_atoc(data)
+        filepath = retry_corrupt(fetch_atoc, opendata)
         if opendata.settings.recompress:
             filepath = tar_and_compress(opendata.settings.recompress, filepath, unzip_file(filepath))
+        record_file(opendata.archive_path, filepath, source=opendata.data_url)
+        dedup_file(opendata, filepath)
         logger.debug(exec_rsync(opendata))
         logger.info(f"Flow atoc_timetable got new file: {filepath}")
-        update_newfile_block("atoc", filepath)
+        update_newfile_block("atoc", filepath, opendata)
+        if opendata.process:
+            logger.info(f"Queued ATOC Timetable Store run {queue_flow_run('ATOC Timetable Store')}")
     except Exception as err:
         msg = '<br/>'.join(traceback.format_exception(*exc_info()))
         logger.error(msg)
         email_message(opendata, "Error in Prefect Flow atoc_timetable", msg)
         raise err
+    finally:
+        stop_profile(profiler)
+        publish_metrics("atoc_timetable", opendata, failed=exc_info()[0] is not None)
 
 
 @flow(task_runner=SequentialTaskRunner())
 def incidents():
     """Periodically fetches Incidents XML from https://opendata.nationalrail.co.uk/"""
     logger = get_run_logger()
+    opendata = load_block('opendata', 'incidents')
+    profiler = start_profile("incidents", opendata)
     try:
-        opendata = load_block('opendata', 'incidents')
         now = datetime.now()
         thehour = str(now.hour) if now.hour > 9 else "0" + str(now.hour)
         auth_data = opendata.authenticate()
-        data = opendata.get_file(auth_data, streaming=False)
+        data = opendata.get_file(auth_data, streaming=True)
         filepath = opendata.archive_incidents(data, thehour)
         if opendata.settings.recompress:
             filepath = recompress(opendata, filepath)
+        dedup_file(opendata, filepath)
         logger.debug(exec_rsync(opendata))
         logger.info(f"Flow incidents got new file: {filepath}")
-        update_newfile_block("incidents", filepath)
+        update_newfile_block("incidents", filepath, opendata)
     except Exception as err:
         msg = '<br/>'.join(traceback.format_exception(*exc_info()))
         logger.error(msg)
         email_message(opendata, "Error in Prefect Flow incidents", msg)
         raise err
+    finally:
+        stop_profile(profiler)
+        publish_metrics("incidents", opendata, failed=exc_info()[0] is not None)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,47 @@
+"""
+Archive Packing
+
+A Prefect Flow that packs the day directories of the flows producing many small files
+(incidents, nrdp_*) into one seekable, indexed container per day once the day is complete.
+"""
+import os
+from sys import argv, exc_info
+import traceback
+
+from prefect import flow, get_run_logger
+from prefect.task_runners import SequentialTaskRunner
+
+from utils.blocks import block_types, load_block
+from utils.misc import email_message, get_flow_names
+from utils.pack import get_packable_days, pack_day
+
+
+@flow(name="Archive Pack", task_runner=SequentialTaskRunner())
+def archive_pack(min_age_days: int = 2):
+    """Packs the day directories of the incidents and nrdp_ flows older than min_age_days
+
+       Args:
+           min_age_days: Only days at least this many days old are packed
+    """
+    logger = get_run_logger()
+    cfg = None
+    try:
+        for fname in get_flow_names(['incidents', 'nrdp']):
+            cfg = load_block(block_types[fname.split('_')[0]], fname)
+            if not cfg.archive_path or not os.path.isdir(cfg.archive_path):
+                continue
+            packed = 0
+            for daypath in get_packable_days(cfg.archive_path, min_age_days):
+                if pack_day(cfg.archive_path, daypath):
+                    packed += 1
+            logger.info(f"Packed {packed} days of {fname}")
+    except Exception as err:
+        msg = '<br/>'.join(traceback.format_exception(*exc_info()))
+        logger.error(msg)
+        if cfg is not None:
+            email_message(cfg, "Error in Prefect Flow archive_pack", msg)
+        raise err
+
+
+if __name__ == "__main__":
+    archive_pack(min_age_days=(int(argv[1]) if len(argv) > 1 else 2))
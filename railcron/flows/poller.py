@@ -0,0 +1,89 @@
+"""
+Upstream Change Poller
+
+A Prefect Flow that cheaply checks whether the sources of the ATOC timetable, NR Datafeeds
+(data_*/sched_*) and HDA flows have published something new and only then triggers runs
+of those flows' deployments. Only headers or listings are requested, all in one event loop.
+
+The signature (ETag/Last-Modified/etc) of each source is kept in a "{flow name}-poll" JSON Block.
+"""
+import asyncio
+from sys import exc_info
+import traceback
+
+import httpx
+from prefect import flow, get_run_logger
+from prefect.blocks.core import Block
+from prefect.blocks.system import JSON
+from prefect.task_runners import SequentialTaskRunner
+
+from utils.blocks import block_types, load_block
+from utils.misc import email_message, get_flow_names, queue_flow_run
+
+# names of flows that differ from their section in the config file
+flow_names = {'hda_data': 'NR HDA Data'}
+
+
+async def poll_source(client, fname, cfg):
+    """Gets the current signature of a flow's source and the last one seen
+
+       Returns: (JSON Block of the last signature, current signature)
+    """
+    signature = await cfg.get_signature(client)
+    try:
+        state = await Block.load(f"json/{fname}-poll".replace('_','-'))
+    except ValueError:
+        state = JSON(value={"signature": ""})
+    return state, signature
+
+
+@flow(name="Upstream Poller", task_runner=SequentialTaskRunner())
+async def upstream_poller(dryrun: bool = False):
+    """Triggers flows whose upstream source has changed since it was last polled
+
+       Args:
+           dryrun: True to only log which sources changed
+    """
+    logger = get_run_logger()
+    cfg = None
+    try:
+        flow_cfgs = {}
+        for fname in get_flow_names(['atoc_', 'data_', 'sched_', 'hda_']):
+            cfg = await load_block(block_types[fname.split('_')[0]], fname)
+            flow_cfgs[fname] = cfg
+
+        async with httpx.AsyncClient(timeout=60) as client:
+            results = await asyncio.gather(
+                *[poll_source(client, fname, cfg) for fname, cfg in flow_cfgs.items()],
+                return_exceptions=True)
+
+        failures = []
+        for fname, result in zip(flow_cfgs.keys(), results):
+            if isinstance(result, Exception):
+                logger.error(f"Could not poll source of {fname}: {result}")
+                failures.append(fname)
+                continue
+            state, signature = result
+            if state.value["signature"] == signature:
+                logger.info(f"No change in source of {fname}")
+                continue
+            logger.info(f"Source of {fname} changed: {signature}")
+            if dryrun:
+                continue
+            flow_run_id = await queue_flow_run(flow_names.get(fname, fname))
+            logger.info(f"Queued {fname} run {flow_run_id}")
+            # only remember the change once the flow has been triggered
+            state.value["signature"] = signature
+            await state.save(name=f"{fname}-poll".replace('_','-'), overwrite=True)
+        if failures:
+            raise Exception(f"Failed to poll sources of {', '.join(failures)}")
+    except Exception as err:
+        msg = '<br/>'.join(traceback.format_exception(*exc_info()))
+        logger.error(msg)
+        if cfg is not None:
+            email_message(cfg, "Error in Prefect Flow upstream_poller", msg)
+        raise err
+
+
+if __name__ == "__main__":
+    asyncio.run(upstream_poller(dryrun=True))
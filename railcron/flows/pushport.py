@@ -0,0 +1,76 @@
+"""
+DARWIN Push Port Ingest
+
+A Prefect Flow that parses the DARWIN Push Port logs archived by nrdp_logs into
+date/hour partitioned column stores of forecasts, schedules and deactivations (see
+utils/pushport.py), the logs of a day parsed in parallel by a pool of processes.
+Logs already ingested are skipped, so it can be run again as more logs of a day arrive.
+nrdp_logs queues it when "process" is set in its section of the config file,
+otherwise schedule it after nrdp_logs.
+
+The store is kept in {store}/nrdp_logs/YYYY/MM/DD/HH/{table}/{name of the log}.
+"""
+from sys import argv, exc_info
+import traceback
+
+from prefect import flow, get_run_logger
+from prefect.task_runners import SequentialTaskRunner
+
+from utils.blocks import load_block
+from utils.columnar import get_store_path
+from utils.metrics import publish_metrics, stage
+from utils.misc import email_message, get_current_ymd, get_date_range
+from utils.profiling import start_profile, stop_profile
+from utils.pushport import ingest_day
+
+
+@flow(name="DARWIN Push Port Ingest", task_runner=SequentialTaskRunner())
+def pushport_ingest(year: int = None, mon: int = None, day: int = None,
+                    end_year: int = None, end_mon: int = None, end_day: int = None,
+                    workers: int = None, force: bool = False):
+    """Ingests the Push Port logs of a day (or range of days) into the Push Port store
+
+       Args:
+           year / mon / day: Date the logs were archived under (default yesterday)
+           end_year / end_mon / end_day: Last date of a range to ingest
+           workers: Number of processes parsing logs (default is number of CPUs)
+           force: Ingest the logs already ingested again
+
+       Returns: number of logs ingested
+    """
+    logger = get_run_logger()
+    nrdf = load_block('nrdfs3', 'nrdp_logs')
+    profiler = start_profile("pushport_ingest", nrdf)
+    try:
+        if year is None:
+            year, mon, day = get_current_ymd(yesterday=True)
+        end = [end_year, end_mon, end_day] if end_year is not None else [year, mon, day]
+        store_path = get_store_path(nrdf, "nrdp_logs")
+        count = 0
+        for the_year, the_mon, the_day in get_date_range([year, mon, day], end):
+            with stage('process') as record:
+                results = ingest_day("nrdp_logs", nrdf, store_path, the_year, the_mon, the_day,
+                                     workers=workers, force=force)
+                record.add(sum(x['bytes'] for x in results), len(results))
+            for result in results:
+                if result['error']:
+                    logger.warning(f"NOTICE: {result['source']} only partly ingested: {result['error']}")
+            count += len(results)
+            logger.info(f"Flow pushport_ingest ingested {len(results)} logs of {the_year}-{the_mon}-{the_day}: "
+                        f"{sum(x['messages'] for x in results)} messages")
+        return count
+    except Exception as err:
+        msg = '<br/>'.join(traceback.format_exception(*exc_info()))
+        logger.error(msg)
+        email_message(nrdf, "Error in Prefect Flow pushport_ingest", msg)
+        raise err
+    finally:
+        stop_profile(profiler)
+        publish_metrics("pushport_ingest", nrdf, failed=exc_info()[0] is not None)
+
+
+if __name__ == "__main__":
+    if len(argv) > 3:
+        pushport_ingest(*argv[1:4])
+    else:
+        pushport_ingest()
@@ -0,0 +1,68 @@
+"""
+Archive Recompaction
+
+A Prefect Flow that recompresses the files of cold months of the archives of all
+configured flows with the strongest codec (xz -9e or zstd --ultra -22 --long) whose
+decompression speed still meets a target, in the background at idle priority.
+Files are verified and atomically swapped, and the manifests and lastfile blocks
+are updated to point at the new files.
+"""
+import os
+from sys import argv, exc_info
+import traceback
+
+from prefect import flow, get_run_logger
+from prefect.task_runners import SequentialTaskRunner
+
+from utils.blocks import block_types, load_block, rename_lastfile
+from utils.misc import email_message, get_flow_names
+from utils.recompact import recompact_archive
+
+
+@flow(name="Archive Recompact", task_runner=SequentialTaskRunner())
+def archive_recompact(min_age_days: int = 90, min_decompress_mbps: float = 50,
+                      workers: int = 2, max_load: float = None):
+    """Recompacts the months of all archives that ended more than min_age_days ago
+
+       Args:
+           min_age_days: Only months that ended more than this many days ago are recompacted
+           min_decompress_mbps: Decompression speed (MB/s) the chosen codec must achieve
+           workers: Number of files recompressed at the same time
+           max_load: Stop starting new files when the 1 minute load average exceeds this
+                     (default is half the number of CPUs)
+    """
+    logger = get_run_logger()
+    cfg = None
+    try:
+        if max_load is None:
+            max_load = (os.cpu_count() or 2) / 2
+        archive_paths = []
+        flow_tags = ["atoc", "incidents"]
+        for fname in get_flow_names([x for x in block_types.keys() if x != 'settings']):
+            flow_tags.append(fname)
+            cfg = load_block(block_types[fname.split('_')[0]], fname)
+            if cfg.archive_path and os.path.isdir(cfg.archive_path) and cfg.archive_path not in archive_paths:
+                archive_paths.append(cfg.archive_path)
+
+        renamed = {}
+        for archive_path in archive_paths:
+            moved = recompact_archive(archive_path, min_age_days=min_age_days,
+                                      min_decompress_mbps=min_decompress_mbps,
+                                      workers=workers, max_load=max_load, logger=logger)
+            logger.info(f"Recompacted {len(moved)} files of {archive_path}")
+            renamed.update(moved)
+
+        if renamed:
+            for flow_tag in flow_tags:
+                if rename_lastfile(flow_tag, renamed):
+                    logger.info(f"Updated lastfile block of {flow_tag}")
+    except Exception as err:
+        msg = '<br/>'.join(traceback.format_exception(*exc_info()))
+        logger.error(msg)
+        if cfg is not None:
+            email_message(cfg, "Error in Prefect Flow archive_recompact", msg)
+        raise err
+
+
+if __name__ == "__main__":
+    archive_recompact(min_age_days=(int(argv[1]) if len(argv) > 1 else 90))
@@ -0,0 +1,65 @@
+"""
+Archive Scrubbing
+
+A Prefect Flow that incrementally checks the archives of all configured flows for
+bit-rot: compressed files are test decompressed and their checksums compared with
+those in each archive's manifest, across a pool of processes.
+"""
+import os
+from sys import argv, exc_info
+import traceback
+
+from prefect import flow, get_run_logger
+from prefect.task_runners import SequentialTaskRunner
+
+from utils.blocks import block_types, load_block
+from utils.misc import email_message, get_flow_names
+from utils.scrub import scrub_archive
+
+
+@flow(name="Archive Scrub", task_runner=SequentialTaskRunner())
+def archive_scrub(max_age_days: int = 30, max_gb: float = None, workers: int = None):
+    """Scrubs files that are new, changed or not scrubbed for max_age_days
+
+       Args:
+           max_age_days: Files last scrubbed longer ago than this are rescanned
+           max_gb: Optional limit of GBs scrubbed in this run (across all archives)
+                   so that a full pass is spread over several runs
+           workers: Number of processes to use (default is number of CPUs)
+    """
+    logger = get_run_logger()
+    cfg = None
+    try:
+        archive_paths = []
+        for fname in get_flow_names([x for x in block_types.keys() if x != 'settings']):
+            cfg = load_block(block_types[fname.split('_')[0]], fname)
+            if cfg.archive_path and os.path.isdir(cfg.archive_path) and cfg.archive_path not in archive_paths:
+                archive_paths.append(cfg.archive_path)
+
+        budget = max_gb * 1024**3 if max_gb else None
+        failures = []
+        for archive_path in archive_paths:
+            if budget is not None and budget <= 0:
+                break
+            results = scrub_archive(archive_path, max_age_days=max_age_days,
+                                    max_bytes=budget, workers=workers)
+            scrubbed = sum([r['size'] for r in results])
+            if budget is not None:
+                budget -= scrubbed
+            bad = [r for r in results if not r['ok']]
+            logger.info(f"Scrubbed {len(results)} files ({scrubbed} bytes) of {archive_path}, {len(bad)} bad")
+            for result in bad:
+                logger.error(f"{archive_path}/{result['path']}: {result['error']}")
+            failures.extend(bad)
+        if failures:
+            raise Exception(f"Scrub found {len(failures)} corrupt files")
+    except Exception as err:
+        msg = '<br/>'.join(traceback.format_exception(*exc_info()))
+        logger.error(msg)
+        if cfg is not None:
+            email_message(cfg, "Error in Prefect Flow archive_scrub", msg)
+        raise err
+
+
+if __name__ == "__main__":
+    archive_scrub(max_gb=(float(argv[1]) if len(argv) > 1 else None))
@@ -5,7 +5,7 @@ Generated Prefect Flows that fetch SMART/TPS/Corpus files as well as schedule
 related files from the https://datafeeds.networkrail.co.uk/ntrod/ website.
 """
 import os
-from sys import argv, exc_info, modules
+from sys import argv, exc_info
 import traceback
 
 from prefect import flow, get_run_logger
@@ -14,13 +14,25 @@ from prefect.blocks.system import JSON
 from prefect.task_runners import SequentialTaskRunner
 
 from utils.blocks import load_block, update_newfile_block
-from utils.files import archive_data_to_file, recompress, exec_rsync, file_changed
-from utils.misc import create_flows, email_message, get_current_ymd
+from utils.dedup import dedup_file
+from utils.delta import store_delta
+from utils.files import archive_data_to_file, recompress, exec_rsync, file_changed, retry_corrupt
+from utils.manifest import forget_file
+from utils.metrics import publish_metrics
+from utils.misc import create_flows, defer_flows, email_message, get_current_ymd
+from utils.profiling import start_profile, stop_profile
 
 # Can not use RemoteFileSystem / fsspec to download file due to issues with redirects
 # and fsspec expects a standard file system type of logic using file objects things
 # e.g https://.../filename.txt
 
+def fetch_file(nrdf, filepath_prefix, filename):
+    """Downloads the file and saves it, verified against the response's headers"""
+    data = nrdf.get_datafeeds_file(streaming=True)
+    return archive_data_to_file(data, filepath_prefix, filename,
+                                archive_path=nrdf.archive_path, source=nrdf.data_url)
+
+
 def flow_generator(fname):
     """Generator of flow functions based on configurations in YAML cfg"""
 
@@ -28,6 +40,7 @@ def flow_generator(fname):
         nonlocal fname
         logger = get_run_logger()
         nrdf = load_block('nrdatafeeds', fname)
+        profiler = start_profile(fname, nrdf)
         try:
             file_hash = None
             if fname.startswith("data_"):
@@ -36,39 +49,46 @@ def flow_generator(fname):
                 except ValueError:
                     file_hash = JSON(value={"last_hash": 0})
 
-            data = nrdf.get_datafeeds_file(streaming=True)
             # for data_* and sched_* blocks, always getting data for today
             year, mon, day = get_current_ymd(yesterday=False)
             filename = day + '.' + nrdf.filetype
             filepath_prefix = nrdf.get_filepath_prefix(year, mon, day)
-            filepath = archive_data_to_file(data, filepath_prefix, filename)
+            filepath = retry_corrupt(fetch_file, nrdf, filepath_prefix, filename)
 
             if fname.startswith('data_') and not file_changed(fname, filepath, file_hash):
                 logger.info("NOTICE: No change in file, so deleting today's")
                 os.unlink(filepath)
+                forget_file(nrdf.archive_path, filepath)
                 return
-            if nrdf.settings.recompress:
+            if nrdf.delta:
+                filepath = store_delta(nrdf, fname, filepath, year, mon, day)
+            elif nrdf.settings.recompress:
                 filepath = recompress(nrdf, filepath)
+            dedup_file(nrdf, filepath)
             logger.debug(exec_rsync(nrdf))
 
             logger.info(f"Flow {fname} got new file: {filepath}")
-            update_newfile_block(fname, filepath)
+            update_newfile_block(fname, filepath, nrdf)
         except Exception as err:
             msg = '<br/>'.join(traceback.format_exception(*exc_info()))
             logger.error(msg)
             email_message(nrdf, f"Error in Prefect Flow {fname}", msg)
             raise err
+        finally:
+            stop_profile(profiler)
+            publish_metrics(fname, nrdf, failed=exc_info()[0] is not None)
 
     infunc.__name__ = fname
     return flow(infunc, name=f"{fname}", task_runner=SequentialTaskRunner(),
         description="Fetches single files from https://datafeeds.networkrail.co.uk/ntrod/login")
 
 
-prefix_flows = create_flows(flow_generator, ['sched_', 'data_'])
-for k, v in prefix_flows.items(): setattr(modules[__name__], k, v)
+# flows are only made when looked up (e.g. by the agent running a deployment), not on import
+__getattr__ = defer_flows(flow_generator, ['sched_', 'data_'], __name__)
 
 
 if __name__ == "__main__":
+    prefix_flows = create_flows(flow_generator, ['sched_', 'data_'])
     if argv[1] == 'all':
         for k, v in prefix_flows.items():
             print(f"\n\n RUNNING {k}")
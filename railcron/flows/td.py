@@ -0,0 +1,79 @@
+"""
+A51 TD Berth Steps
+
+A Prefect Flow that converts the days of Train Describer messages archived by a51_td
+into tables of berth steps sorted by time and indexed by headcode and by area and
+berth (see utils/td.py), so "where was 1A23 between 08:00 and 09:00" is answered with
+binary searches instead of scanning a day of messages. Days already converted are
+skipped unless their archived files changed. a51_td queues it for the month fetched
+when "process" is set in its section of the config file, otherwise schedule it after
+a51_td.
+
+Each day is kept in {store}/a51_td/YYYY-MM-DD.
+"""
+from sys import argv, exc_info
+import traceback
+
+from prefect import flow, get_run_logger
+from prefect.task_runners import SequentialTaskRunner
+
+from utils.blocks import load_block
+from utils.coverage import scan_month
+from utils.metrics import publish_metrics, stage
+from utils.misc import email_message, get_current_ymd
+from utils.profiling import start_profile, stop_profile
+from utils.td import get_steps
+
+
+@flow(name="A51 TD Berth Steps", task_runner=SequentialTaskRunner())
+def td_steps(year: int = None, mon: int = None, day: int = None, refresh: bool = False):
+    """Converts the archived TD days not converted yet into berth step tables
+
+       Args:
+           year / mon: Month of the days (default yesterday's)
+           day: Day to convert, default of None means every archived day of the month
+                (just yesterday if no month is given either)
+           refresh: Convert the days even if already converted
+
+       Returns: number of berth steps of the days
+    """
+    logger = get_run_logger()
+    a51 = load_block('a51', 'a51_td')
+    profiler = start_profile("td_steps", a51)
+    try:
+        if year is None:
+            year, mon, day = get_current_ymd(yesterday=True)
+        year, mon = str(year), f"{int(mon):02d}"
+        if day is not None:
+            days = [f"{int(day):02d}"]
+        else:
+            days = sorted(x.split('-')[2] for x in scan_month('a51', a51, year, mon))
+        count = 0
+        for the_day in days:
+            with stage('process') as record:
+                steps = get_steps(a51, year, mon, the_day, refresh=refresh)
+                record.add(objects=int(steps is not None))
+            if steps is None:
+                logger.warning(f"NOTICE: No TD file archived for {year}-{mon}-{the_day}")
+                continue
+            count += steps.rows
+            logger.info(f"Flow td_steps has {steps.rows} berth steps of {year}-{mon}-{the_day}")
+            if steps.meta.get('skipped_lines'):
+                logger.warning(f"NOTICE: {steps.meta['skipped_lines']} malformed lines skipped "
+                               f"in the TD files of {year}-{mon}-{the_day}")
+        return count
+    except Exception as err:
+        msg = '<br/>'.join(traceback.format_exception(*exc_info()))
+        logger.error(msg)
+        email_message(a51, "Error in Prefect Flow td_steps", msg)
+        raise err
+    finally:
+        stop_profile(profiler)
+        publish_metrics("td_steps", a51, failed=exc_info()[0] is not None)
+
+
+if __name__ == "__main__":
+    if len(argv) > 2:
+        td_steps(*argv[1:4])
+    else:
+        td_steps()
@@ -0,0 +1,117 @@
+"""
+ATOC Timetable Store
+
+A Prefect Flow that parses the latest ATOC timetable archived by atoc_timetable into
+an indexed column store (see utils/cif.py), so that "trains calling at X on date D"
+and the like are answered in milliseconds instead of every consumer re-parsing the
+MCA file. It processes the file of the "atoc" newfile event and marks it as done.
+atoc_timetable queues it when "process" is set in its section of the config file,
+otherwise schedule it after atoc_timetable.
+
+Each timetable is kept in {store}/atoc_timetable/<name of the archived file> and
+{store}/atoc_timetable/current links to the latest one. Only the current timetable and
+the one before it are kept.
+"""
+import os
+from shutil import rmtree
+from sys import argv, exc_info
+import traceback
+
+from prefect import flow, get_run_logger
+from prefect.task_runners import SequentialTaskRunner
+
+from utils.blocks import acknowledge_newfile, load_block, newfile_present
+from utils.cif import build_timetable
+from utils.columnar import get_store_path
+from utils.metrics import publish_metrics, stage
+from utils.misc import email_message
+from utils.profiling import start_profile, stop_profile
+
+
+CURRENT_NAME = "current"
+
+
+def set_current(store_path, name):
+    """Points the current link of the store to a timetable (replaced at once)"""
+    link = os.path.join(store_path, CURRENT_NAME)
+    tmplink = link + ".tmp"
+    if os.path.lexists(tmplink):
+        os.unlink(tmplink)
+    os.symlink(name, tmplink)
+    os.replace(tmplink, link)
+
+
+def get_current(store_path):
+    """Name of the timetable the current link of the store points to (None if none)"""
+    link = os.path.join(store_path, CURRENT_NAME)
+    return os.readlink(link) if os.path.islink(link) else None
+
+
+def prune_timetables(store_path, name, previous=None):
+    """Removes the timetables of the store but the current one and the one before it
+
+       Args:
+           store_path: Directory of the timetables
+           name: Current timetable
+           previous: Timetable current before it, else the latest other one is kept
+
+       Returns: list of the names of the timetables removed
+    """
+    # timetables being written are hidden (.tmp-*)
+    others = sorted([x for x in os.scandir(store_path) if x.is_dir(follow_symlinks=False)
+                     and not x.name.startswith('.') and x.name != name],
+                    key=lambda x: x.stat(follow_symlinks=False).st_mtime, reverse=True)
+    if previous not in [x.name for x in others]:
+        previous = others[0].name if others else None
+    removed = []
+    for entry in others:
+        if entry.name != previous:
+            rmtree(entry.path)
+            removed.append(entry.name)
+    return removed
+
+
+@flow(name="ATOC Timetable Store", task_runner=SequentialTaskRunner())
+def atoc_store(filepath: str = None):
+    """Parses the new ATOC timetable (or the given archived file) into the timetable store
+
+       Args:
+           filepath: Archived RJTTF file to process instead of the one of the newfile event
+
+       Returns: path of the timetable or None if there was nothing new
+    """
+    logger = get_run_logger()
+    opendata = load_block('opendata', 'atoc_timetable')
+    profiler = start_profile("atoc_store", opendata)
+    try:
+        newfile = filepath or newfile_present("atoc")
+        if not newfile:
+            logger.info("No new ATOC timetable to process")
+            return None
+        store_path = get_store_path(opendata, "atoc_timetable")
+        name = os.path.basename(newfile).split('.')[0]
+        with stage('process') as record:
+            rows = build_timetable(newfile, os.path.join(store_path, name), opendata)
+            record.add(os.path.getsize(newfile), 1)
+        previous = get_current(store_path)
+        set_current(store_path, name)
+        removed = prune_timetables(store_path, name, previous)
+        if removed:
+            logger.info(f"Removed old timetables {', '.join(removed)}")
+        if not filepath:
+            acknowledge_newfile("atoc", newfile)
+        logger.info(f"Flow atoc_store processed {newfile}: "
+                    + ", ".join(f"{count} {table}" for table, count in rows.items()))
+        return os.path.join(store_path, name)
+    except Exception as err:
+        msg = '<br/>'.join(traceback.format_exception(*exc_info()))
+        logger.error(msg)
+        email_message(opendata, "Error in Prefect Flow atoc_store", msg)
+        raise err
+    finally:
+        stop_profile(profiler)
+        publish_metrics("atoc_store", opendata, failed=exc_info()[0] is not None)
+
+
+if __name__ == "__main__":
+    atoc_store(argv[1] if len(argv) > 1 else None)
@@ -0,0 +1,79 @@
+"""
+A51 TRUST Movements
+
+A Prefect Flow that decodes the days of TRUST train movements archived by a51_trust
+into memory mapped columns (see utils/trust.py), so delay analyses (per location and
+operator delay distributions, on-time percentages...) open the day without parsing
+any JSON. Days already decoded are skipped unless their archived files changed.
+a51_trust queues it for the month fetched when "process" is set in its section of
+the config file, otherwise schedule it after a51_trust.
+
+Each day is kept in {store}/a51_trust/YYYY-MM-DD.
+"""
+from sys import argv, exc_info
+import traceback
+
+from prefect import flow, get_run_logger
+from prefect.task_runners import SequentialTaskRunner
+
+from utils.blocks import load_block
+from utils.coverage import scan_month
+from utils.metrics import publish_metrics, stage
+from utils.misc import email_message, get_current_ymd
+from utils.profiling import start_profile, stop_profile
+from utils.trust import get_movements
+
+
+@flow(name="A51 TRUST Movements", task_runner=SequentialTaskRunner())
+def trust_movements(year: int = None, mon: int = None, day: int = None, refresh: bool = False):
+    """Decodes the archived TRUST days not decoded yet into the TRUST store
+
+       Args:
+           year / mon: Month of the days (default yesterday's)
+           day: Day to decode, default of None means every archived day of the month
+                (just yesterday if no month is given either)
+           refresh: Decode the days even if already decoded
+
+       Returns: number of movements of the days
+    """
+    logger = get_run_logger()
+    a51 = load_block('a51', 'a51_trust')
+    profiler = start_profile("trust_movements", a51)
+    try:
+        if year is None:
+            year, mon, day = get_current_ymd(yesterday=True)
+        year, mon = str(year), f"{int(mon):02d}"
+        if day is not None:
+            days = [f"{int(day):02d}"]
+        else:
+            days = sorted(x.split('-')[2] for x in scan_month('a51', a51, year, mon))
+        count = 0
+        for the_day in days:
+            with stage('process') as record:
+                movements = get_movements(a51, year, mon, the_day, refresh=refresh)
+                record.add(objects=int(movements is not None))
+            if movements is None:
+                logger.warning(f"NOTICE: No TRUST file archived for {year}-{mon}-{the_day}")
+                continue
+            count += movements.rows
+            logger.info(f"Flow trust_movements has {movements.rows} movements of {year}-{mon}-{the_day}, "
+                        f"{movements.on_time():.1f}% on time")
+            if movements.meta.get('skipped_lines'):
+                logger.warning(f"NOTICE: {movements.meta['skipped_lines']} malformed lines skipped "
+                               f"in the TRUST files of {year}-{mon}-{the_day}")
+        return count
+    except Exception as err:
+        msg = '<br/>'.join(traceback.format_exception(*exc_info()))
+        logger.error(msg)
+        email_message(a51, "Error in Prefect Flow trust_movements", msg)
+        raise err
+    finally:
+        stop_profile(profiler)
+        publish_metrics("trust_movements", a51, failed=exc_info()[0] is not None)
+
+
+if __name__ == "__main__":
+    if len(argv) > 2:
+        trust_movements(*argv[1:4])
+    else:
+        trust_movements()
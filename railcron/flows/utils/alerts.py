@@ -0,0 +1,240 @@
+"""
+Error alerts of the flows, sent at once or as digests
+
+By default every error is emailed when it happens. With the "alert_window" setting
+(minutes) errors are instead spooled in a SQLite database ("alert_spool", shared by all
+flow runs of the host) and deduplicated by their source (the subject of the alert, i.e.
+the flow) and a signature of the error (its last line with numbers and addresses blanked
+out), counting repeats. Once the oldest spooled error is alert_window minutes old, the
+next failing flow or the alert_digest flow (flows/alerts.py, to be scheduled every few
+minutes) sends one digest of them all, so an outage upstream of a backfill gives one
+email rather than one per failed run.
+
+Mail is sent with the "mail" command (MAIL_SRV blank or "sendmail") or through the SMTP
+server of the settings, whose connection is kept open and reused for the next emails
+of the process. Both are plain blocking calls, so errors are sent the same way from sync
+and async flows.
+"""
+from datetime import datetime
+from email.message import EmailMessage
+import hashlib
+import html
+import os
+import re
+import smtplib
+import sqlite3
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+
+SPOOL_NAME = "railcron-alerts.db"
+# seconds the mail command is given to hand over an email
+MAIL_TIMEOUT = 60
+# sent alerts kept in the spool (seconds)
+KEEP_SENT = 7 * 86400
+# default ports of the MAIL_TYPEs
+smtp_ports = {'SSL': 465, 'STARTTLS': 587, 'INSECURE': 25}
+
+schema = [
+    """CREATE TABLE IF NOT EXISTS alerts (
+           id INTEGER PRIMARY KEY,
+           source TEXT,
+           signature TEXT,
+           error TEXT,
+           message TEXT,
+           count INTEGER,
+           first_seen REAL,
+           last_seen REAL,
+           sent REAL)""",
+    "CREATE INDEX IF NOT EXISTS alerts_unsent ON alerts (sent, source, signature)",
+]
+
+_connections = {}
+_lock = threading.Lock()
+
+
+def mail_enabled(settings):
+    """Whether emails are configured (MAIL_FROM and MAIL_TO set)"""
+    return settings.MAIL_FROM not in (None, "") and settings.MAIL_TO not in (None, "")
+
+
+def get_spool_path(settings):
+    """Path of the spool database (alert_spool setting, else in the temp directory)"""
+    return getattr(settings, 'alert_spool', None) or os.path.join(tempfile.gettempdir(), SPOOL_NAME)
+
+
+def connect(settings):
+    """Opens (and creates if needed) the spool of the alerts"""
+    spool_path = get_spool_path(settings)
+    os.makedirs(os.path.dirname(os.path.abspath(spool_path)), exist_ok=True)
+    conn = sqlite3.connect(spool_path, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    for statement in schema:
+        conn.execute(statement)
+    return conn
+
+
+def get_signature(source, msg):
+    """Signature of an error, so repeats of it can be counted instead of sent again
+
+       Returns: (signature, error line of the message)
+    """
+    lines = [x.strip() for x in re.split(r"<br/>|\n", msg) if x.strip()]
+    error = lines[-1] if lines else ""
+    normalized = re.sub(r"0x[0-9a-fA-F]+", "0x#", error)
+    normalized = re.sub(r"\d+", "#", normalized)
+    return hashlib.sha1(f"{source}\n{normalized}".encode('utf8')).hexdigest()[:16], error
+
+
+def queue_alert(settings, source, msg, now=None):
+    """Spools an error, counting it as a repeat if the same one is already waiting
+
+       Returns: number of times the error is now spooled
+    """
+    now = now or time.time()
+    signature, error = get_signature(source, msg)
+    conn = connect(settings)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT id, count FROM alerts WHERE sent IS NULL AND source = ? AND signature = ?",
+                           (source, signature)).fetchone()
+        if row is None:
+            conn.execute("INSERT INTO alerts (source, signature, error, message, count, first_seen, last_seen) "
+                         "VALUES (?, ?, ?, ?, 1, ?, ?)", (source, signature, error, msg, now, now))
+            count = 1
+        else:
+            conn.execute("UPDATE alerts SET count = count + 1, last_seen = ? WHERE id = ?", (now, row['id']))
+            count = row['count'] + 1
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return count
+
+
+def format_digest(rows):
+    """Subject and HTML body of the digest of spooled errors"""
+    total = sum(row['count'] for row in rows)
+    sources = sorted({row['source'] for row in rows})
+    subject = f"Railcron: {total} errors in {len(sources)} flows"
+
+    def when(seconds):
+        return datetime.fromtimestamp(seconds).strftime('%Y-%m-%d %H:%M:%S')
+
+    summary = [f"{html.escape(row['source'])}: {row['count']} x {html.escape(row['error'])} "
+               f"(first {when(row['first_seen'])}, last {when(row['last_seen'])})" for row in rows]
+    details = [f"<b>{html.escape(row['source'])}</b> ({row['count']} x)<br/>{row['message']}" for row in rows]
+    return subject, "<br/>".join(summary) + "<hr/>" + "<hr/>".join(details)
+
+
+def flush_alerts(settings, force=False, now=None):
+    """Sends the spooled errors as one digest if the oldest is alert_window old
+
+       Only one process sends a digest: the errors are marked as sent before sending,
+       and unmarked if it fails.
+
+       Args:
+           settings: RailcronBlock of the mail and alert settings
+           force: True to send whatever is spooled now
+
+       Returns: number of (deduplicated) errors sent
+    """
+    now = now or time.time()
+    window = (getattr(settings, 'alert_window', 0) or 0) * 60
+    conn = connect(settings)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM alerts WHERE sent IS NOT NULL AND sent < ?", (now - KEEP_SENT,))
+        rows = conn.execute("SELECT * FROM alerts WHERE sent IS NULL ORDER BY source, first_seen").fetchall()
+        if not rows or (not force and now - min(row['first_seen'] for row in rows) < window):
+            conn.execute("COMMIT")
+            return 0
+        ids = [row['id'] for row in rows]
+        conn.executemany("UPDATE alerts SET sent = ? WHERE id = ?", [(now, x) for x in ids])
+        conn.execute("COMMIT")
+        try:
+            send_email(settings, *format_digest(rows))
+        except Exception:
+            conn.executemany("UPDATE alerts SET sent = NULL WHERE id = ?", [(x,) for x in ids])
+            raise
+    finally:
+        conn.close()
+    return len(rows)
+
+
+def get_smtp(settings):
+    """Open (logged in) connection to the SMTP server of the settings, reused if still alive"""
+    smtp_type = (settings.MAIL_TYPE or 'SSL').strip()
+    key = (settings.MAIL_SRV.strip(), settings.MAIL_PORT or smtp_ports[smtp_type], smtp_type,
+           (settings.MAIL_LOGIN or "").strip())
+    server = _connections.get(key)
+    if server is not None:
+        try:
+            if server.noop()[0] == 250:
+                return server
+        except smtplib.SMTPException:
+            pass
+        close_smtp(key)
+    if smtp_type == 'SSL':
+        server = smtplib.SMTP_SSL(key[0], key[1], context=ssl.create_default_context(), timeout=60)
+    else:
+        server = smtplib.SMTP(key[0], key[1], timeout=60)
+        if smtp_type == 'STARTTLS':
+            server.starttls(context=ssl.create_default_context())
+    if key[3]:
+        server.login(key[3], (settings.MAIL_PWD or "").strip())
+    _connections[key] = server
+    return server
+
+
+def close_smtp(key=None):
+    """Closes the kept SMTP connections (or the one of key)"""
+    for k in [key] if key else list(_connections.keys()):
+        server = _connections.pop(k, None)
+        try:
+            if server is not None:
+                server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+
+def send_email(settings, subject, msg):
+    """Emails an HTML message through the mail command or the SMTP server of the settings
+
+       Returns: output of the mail command or the subject
+    """
+    if not mail_enabled(settings):
+        return ""
+    if settings.MAIL_SRV in (None, "", "sendmail"):
+        args = ["mail", "-r", settings.MAIL_FROM, "-s", subject]
+        for option, value in (("-c", settings.MAIL_CC), ("-b", settings.MAIL_BCC)):
+            if value:
+                args += [option, value]
+        args.append(settings.MAIL_TO)
+        # the message is given on stdin rather than through the shell
+        result = subprocess.run(args, input=(msg + "\n").encode('utf8'), stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, timeout=MAIL_TIMEOUT)
+        output = result.stdout.decode('utf8', errors='replace')
+        if result.returncode != 0:
+            raise Exception(f"mail exited with {result.returncode}: {output}")
+        return output
+
+    message = EmailMessage()
+    message["Subject"] = subject
+    message["From"] = (settings.MAIL_LOGIN or settings.MAIL_FROM).strip()
+    message["To"] = settings.MAIL_TO.strip()
+    if settings.MAIL_CC:
+        message["Cc"] = settings.MAIL_CC.strip()
+    message.set_content(msg, subtype="html")
+    recipients = [x.strip() for field in (settings.MAIL_TO, settings.MAIL_CC, settings.MAIL_BCC)
+                  if field for x in field.split(',') if x.strip()]
+    with _lock:
+        try:
+            get_smtp(settings).send_message(message, to_addrs=recipients)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # the server closed the kept connection since the NOOP
+            close_smtp()
+            get_smtp(settings).send_message(message, to_addrs=recipients)
+    return subject
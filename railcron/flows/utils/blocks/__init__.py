@@ -1,19 +1,67 @@
+import asyncio
+import importlib
 import os
 
 from prefect.blocks.core import Block
 from prefect.blocks.system import JSON
 from prefect.utilities.asyncutils import sync_compatible
 
+from ..cache import warm_file
+from ..metrics import stage, timed
 from ..misc import load_config
-from .hda import HdaBlock
-from .opendata import OpendataBlock
-from .nrdatafeeds import NrdatafeedsBlock, Nrdfs3Block
-from .a51 import A51Block
-from .railcron import RailcronBlock
+
+
+# module of each Block class, imported when the class is first used so that a flow
+# only imports what its own Block needs (e.g. boto3 for the S3 based ones)
+block_modules = {
+    'HdaBlock': 'hda',
+    'OpendataBlock': 'opendata',
+    'NrdatafeedsBlock': 'nrdatafeeds',
+    'Nrdfs3Block': 'nrdatafeeds',
+    'A51Block': 'a51',
+    'RailcronBlock': 'railcron'
+}
+
+# type of Block used by the flows of each config file prefix
+block_types = {
+    'hda': 'hda',
+    'nrdp': 'nrdfs3',
+    'atoc': 'opendata',
+    'incidents': 'opendata',
+    'sched': 'nrdatafeeds',
+    'data': 'nrdatafeeds',
+    'a51': 'a51',
+    'settings': 'railcron'
+}
+
+
+def get_block_class(name):
+    """Block class of the given name (e.g. "Nrdfs3Block"), importing its module if needed"""
+    if name not in block_modules:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(f".{block_modules[name]}", __name__), name)
+
+
+def __getattr__(name):
+    """Lazy access to the Block classes, e.g. from utils.blocks import A51Block"""
+    return get_block_class(name)
+
+
+@timed('block_io')
+async def save_newfile(flow_tag, newfile):
+    """Saves the new file of a flow-block (oldfile -> previous newfile)"""
+    lastfile = None
+    try:
+        lastfile = await Block.load(f"json/{flow_tag}-lastfile".replace('_','-'))
+    except ValueError:
+        lastfile = JSON(value={"oldfile": "", "newfile": ""})
+    lastfile.value["oldfile"] = lastfile.value["newfile"]
+    lastfile.value["newfile"] = newfile
+    await lastfile.save(name=f"{flow_tag}-lastfile".replace('_','-'), overwrite=True)
 
 
 @sync_compatible
-async def update_newfile_block(flow_tag, newfile):
+async def update_newfile_block(flow_tag, newfile, cfg=None):
     """Used to record when a new file has been fetched
 
        When a flow gets a new file, this block can be used to indicate the
@@ -24,21 +72,24 @@ async def update_newfile_block(flow_tag, newfile):
        Other flows accessing this block can then be triggered (e.g. to process
        the new file). They MUST update the block when done (oldfile->newfile).
 
+       The new file is also added to the local decompressed cache when enabled
+       (measured as the cache stage, not as block_io)
+
        Args:
            flow_tag: The name of the semaphore
            newfile: The new value of it (e.g. the file path)
+           cfg: Block of the flow, to pre-warm the cache with the new file
     """
-    lastfile = None
-    try:
-        lastfile = await Block.load(f"json/{flow_tag}-lastfile".replace('_','-'))
-    except ValueError:
-        lastfile = JSON(value={"oldfile": "", "newfile": ""})
-    lastfile.value["oldfile"] = lastfile.value["newfile"]
-    lastfile.value["newfile"] = newfile
-    await lastfile.save(name=f"{flow_tag}-lastfile".replace('_','-'), overwrite=True)
+    await save_newfile(flow_tag, newfile)
+    if cfg is not None and cfg.settings.cache_dir:
+        with stage('cache') as record:
+            entry = await asyncio.get_running_loop().run_in_executor(None, warm_file, cfg, newfile, flow_tag)
+            if entry is not None:
+                record.add(os.path.getsize(entry), 1)
 
 
 @sync_compatible
+@timed('block_io')
 async def newfile_present(flow_tag):
     """Determines if the specified flow-block indicates a new file has been received
 
@@ -58,6 +109,53 @@ async def newfile_present(flow_tag):
 
 
 @sync_compatible
+@timed('block_io')
+async def acknowledge_newfile(flow_tag, newfile):
+    """Marks the new file of a flow-block as processed (oldfile -> newfile)
+
+       Nothing is changed if another file was fetched since newfile was read
+
+       Args:
+           flow_tag: The name of the semaphore
+           newfile: The file that was processed
+
+       Returns: True if the block was changed
+    """
+    lastfile = await Block.load(f"json/{flow_tag}-lastfile".replace('_','-'))
+    if lastfile.value["newfile"] != newfile:
+        return False
+    lastfile.value["oldfile"] = newfile
+    await lastfile.save(name=f"{flow_tag}-lastfile".replace('_','-'), overwrite=True)
+    return True
+
+
+@sync_compatible
+@timed('block_io')
+async def rename_lastfile(flow_tag, renamed):
+    """Updates the paths in a flow-block after files have been moved (e.g. recompacted)
+
+       Args:
+           flow_tag: The name of the semaphore
+           renamed: dict of old path -> new path
+
+       Returns: True if the block was changed
+    """
+    try:
+        lastfile = await Block.load(f"json/{flow_tag}-lastfile".replace('_','-'))
+    except ValueError:
+        return False
+    changed = False
+    for key in ("oldfile", "newfile"):
+        if lastfile.value[key] in renamed:
+            lastfile.value[key] = renamed[lastfile.value[key]]
+            changed = True
+    if changed:
+        await lastfile.save(name=f"{flow_tag}-lastfile".replace('_','-'), overwrite=True)
+    return changed
+
+
+@sync_compatible
+@timed('block_io')
 async def load_block(block_type, block_name):
     """Gets the specified block from storage or dynamically makes one based on the config file
 
@@ -68,8 +166,8 @@ async def load_block(block_type, block_name):
        Returns: new block for accessing data
     """
     new_block = None
-    block_class = globals()[block_type.capitalize() + "Block"]
-    settings_cls = globals()["RailcronBlock"]
+    block_class = get_block_class(block_type.capitalize() + "Block")
+    settings_cls = get_block_class("RailcronBlock")
     try:
         new_block = await block_class.load(block_name.replace('_', '-'))
         settings = await settings_cls.load("settings")
@@ -15,6 +15,7 @@
 import asyncio
 from functools import partial
 import os
+from typing import Optional
 from typing_extensions import Literal
 
 from botocore import UNSIGNED
@@ -26,6 +27,7 @@ from prefect_aws.s3 import s3_list_objects
 # from pydantic import Field, validator
 import requests
 
+from ..metrics import timed
 from ..misc import get_current_ymd
 
 
@@ -45,6 +47,11 @@ class A51Block(Block):
                       Full path gets extended with "../year/0-month/"
         filetype: Extension of files to get (blank means all)
         rsync: Command to backup the files with
+        endpoint_url: URL of an S3 compatible service serving the bucket instead of the
+                      CDN (path style, e.g. the stand-in of bench/), blank for the CDN
+        profile: Profile every run of the flow (see utils/profiling.py)
+        process: Queue the flow processing the files fetched (a51_trust and a51_td, see
+                 flows/trust.py and flows/td.py)
     """
 
     _block_type_name = "Network Rail - A51 Archives"
@@ -57,6 +64,9 @@ class A51Block(Block):
     archive_path: str
     filetype: str = None
     rsync: str = None
+    endpoint_url: Optional[str] = None
+    profile: bool = False
+    process: bool = False
 
     # Pydantic's validation features not working with Prefect
     # class Config:
@@ -72,12 +82,15 @@ class A51Block(Block):
         """Defines scheme by which files are organized under the archive_path"""
         if year is None:
             year, mon, _ = get_current_ymd(yesterday=True, strip_zeros=False)
-        if int(mon) < 10: mon = "0" + str(mon)
+        mon = f"{int(mon):02d}"
         return os.path.join(self.archive_path, str(year), str(mon))
 
+    @timed('download', objects=0)
     async def get_https_s3_file(self, year, mon, fname, streaming=True):
         """Downloads a file from A51 S3 using https"""
         data_url = f"https://{self.bucket}/{self.key}"
+        if self.endpoint_url:
+            data_url = f"{self.endpoint_url.rstrip('/')}/{self.bucket}/{self.key}"
         filepath = os.path.join(data_url, str(year), str(mon), fname)
         loop = asyncio.get_event_loop()
         future1 = loop.run_in_executor(None, partial(requests.get, filepath, stream=streaming))
@@ -95,7 +108,8 @@ class A51Block(Block):
         """Get list of available objects/files from S3 bucket"""
         prefi = os.path.join(self.key, str(year), str(mon))
         # public S3 repositories require no auth info, e.g. --no-sign-request"
-        aws_params = AwsClientParameters(config=Config(signature_version=UNSIGNED))
+        aws_params = AwsClientParameters(config=Config(signature_version=UNSIGNED),
+                                         endpoint_url=self.endpoint_url or None)
         objects = await s3_list_objects(bucket=self.bucket,
                         aws_credentials=AwsCredentials(),
                         aws_client_parameters=aws_params,
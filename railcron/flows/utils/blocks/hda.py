@@ -1,13 +1,42 @@
 """Prefect Block for managing access to NR HDA data"""
 
+import hashlib
 import os
 from typing_extensions import Literal
+from xml.etree.ElementTree import XMLPullParser
 
 from prefect import get_run_logger
 from prefect.blocks.core import Block
 from pydantic import Field
 import requests
 
+from ..files import get_expected_digests, write_chunks
+from ..metrics import timed
+
+def parse_listing(parser, chunk):
+    """Feeds a chunk of an Azure blob listing to an incremental XML parser
+
+       Args:
+           parser: XMLPullParser of the current page of the listing
+           chunk: Next bytes of the page
+
+       Returns: (list of properties of completed blobs, NextMarker if reached)
+    """
+    blobs = []
+    marker = None
+    parser.feed(chunk)
+    for _, elem in parser.read_events():
+        if elem.tag == 'Blob':
+            props = {'Name': elem.findtext('Name'), 'Url': elem.findtext('Url')}
+            for key in ['Content-Length', 'Etag', 'Last-Modified']:
+                props[key] = elem.findtext(f"Properties/{key}")
+            props['Content-Length'] = int(props['Content-Length'] or 0)
+            blobs.append(props)
+            elem.clear()
+        elif elem.tag == 'NextMarker':
+            marker = elem.text
+    return blobs, marker
+
 
 class HdaBlock(Block):
     """Block used to fetch Historic Delay Attribution files from Network Rail's website
@@ -21,6 +50,7 @@ class HdaBlock(Block):
            #  comp: list
            archive_path: Where to archive the files
            rsync: Command to execute rsync
+           profile: Profile every run of the flow (see utils/profiling.py)
     """
 
     _block_type_name = "Network Rail HDA Files"
@@ -33,7 +63,9 @@ class HdaBlock(Block):
     # params: dict = {'restype': 'container', 'comp': 'list'}
     archive_path: str
     rsync: str = None
+    profile: bool = False
 
+    @timed('download', objects=0)
     def get_file(self, other_url=None, streaming=False):
         """Downloads XML section of HDA CSVs or the zip file"""
         url = self.url if other_url is None else other_url
@@ -48,14 +80,73 @@ class HdaBlock(Block):
             raise Exception(f"Could not download {url}")
         return resp
 
+    def list_blobs(self):
+        """Incrementally parses all pages of the XML listing of HDA files
+
+           Yields: dict of Name, Url, Content-Length, Etag and Last-Modified of each file
+        """
+        marker = None
+        while True:
+            params = {'restype': 'container', 'comp': 'list'}
+            if marker:
+                params['marker'] = marker
+            resp = requests.get(self.url, params=params, stream=True)
+            if resp.status_code not in (200, 201):
+                logger = get_run_logger()
+                logger.error(f"Could not download {self.url}")
+                logger.error(resp.status_code)
+                logger.error(resp.headers)
+                raise Exception(f"Could not download {self.url}")
+            parser = XMLPullParser(events=('end',))
+            marker = None
+            for chunk in resp.iter_content(chunk_size=64*1024):
+                blobs, next_marker = parse_listing(parser, chunk)
+                marker = next_marker or marker
+                for blob in blobs:
+                    if not blob['Url']:
+                        blob['Url'] = f"{self.url}/{blob['Name']}"
+                    yield blob
+            parser.close()
+            if not marker:
+                break
+
+    async def get_signature(self, client):
+        """Gets all pages of the XML listing of HDA files
+
+           Args:
+               client: httpx.AsyncClient to make the requests with
+
+           Returns: signature of the current names and ETags of the files
+        """
+        fileinfo = []
+        marker = None
+        while True:
+            params = {'restype': 'container', 'comp': 'list'}
+            if marker:
+                params['marker'] = marker
+            parser = XMLPullParser(events=('end',))
+            marker = None
+            async with client.stream("GET", self.url, params=params) as resp:
+                if resp.status_code not in (200, 201):
+                    raise Exception(f"Could not download {self.url}: {resp.status_code}")
+                async for chunk in resp.aiter_bytes():
+                    blobs, next_marker = parse_listing(parser, chunk)
+                    marker = next_marker or marker
+                    fileinfo.extend([f"{b['Name']}|{b['Etag']}" for b in blobs])
+            parser.close()
+            if not marker:
+                break
+        return hashlib.md5('\n'.join(sorted(fileinfo)).encode('utf8')).hexdigest()
+
     def archive_file(self, data, zip_name):
-        """Save streamed file to subdirectory based on original path"""
+        """Save streamed file to subdirectory based on original path
+
+           Raises: IntegrityError if file does not match its Content-Length/Content-MD5
+        """
         # dir structure on source is copied
         dirpart = zip_name[0: zip_name.index('/')]
         dirpath = os.path.join(self.archive_path, dirpart)
         os.makedirs(dirpath, mode=0o755, exist_ok=True)
         zipfile = os.path.join(self.archive_path, zip_name)
-        with open(zipfile, 'wb') as fd:
-            for chunk in data.iter_content(chunk_size=100*1024):
-                fd.write(chunk)
+        write_chunks(data.iter_content(chunk_size=100*1024), zipfile, get_expected_digests(data))
         return zipfile
@@ -1,14 +1,33 @@
-"""Prefect Blocks for managing access to Network Rail Datafeeds services"""
+"""
+Prefect Blocks for managing access to Network Rail Datafeeds services
+
+prefect_aws (and so boto3) is only imported by the methods of the S3 based block,
+the flows of the HTTPS based one do not need it
+"""
+from functools import lru_cache
 import os
+from typing import Optional
 from typing_extensions import Literal
 
 from prefect import get_run_logger
 from prefect.blocks.core import Block
-from prefect_aws import AwsCredentials
 from pydantic import Field, SecretStr
 import requests
 
-from ..misc import get_current_ymd, get_day_of_week
+from ..metrics import timed
+from ..misc import get_current_ymd, get_day_of_week, get_headers_signature
+
+
+@lru_cache(maxsize=None)
+def get_s3_client(aws_access_key_id, aws_secret_access_key, region_name, endpoint_url=None):
+    """boto3 S3 client shared by every download with the same credentials (clients are thread safe)"""
+    from prefect_aws import AwsCredentials, AwsClientParameters
+
+    credentials = AwsCredentials(aws_access_key_id=aws_access_key_id,
+                                 aws_secret_access_key=aws_secret_access_key,
+                                 region_name=region_name)
+    return credentials.get_boto3_session().client(
+        "s3", **AwsClientParameters(endpoint_url=endpoint_url).get_params_override())
 
 
 class NrdatafeedsBlock(Block):
@@ -24,6 +43,9 @@ class NrdatafeedsBlock(Block):
            archive_path: Path where to store saved files
            filetype: Extension of files to get
            rsync: Command to use to backup files
+           delta: Store daily files as deltas against a periodic full keyframe
+           keyframe_days: Number of days between keyframes
+           profile: Profile every run of the flow (see utils/profiling.py)
     """
 
     _block_type_name = "Network Rail Datafeeds Files"
@@ -36,6 +58,9 @@ class NrdatafeedsBlock(Block):
     archive_path: str
     filetype: str
     rsync: str = None
+    delta: bool = False
+    keyframe_days: int = 7
+    profile: bool = False
 
     def get_filepath_prefix(self, year=None, mon=None, day=None):
         """Defines scheme by which files are organized under the archive_path"""
@@ -43,14 +68,19 @@ class NrdatafeedsBlock(Block):
             year, mon, _ = get_current_ymd(yesterday=False, strip_zeros=False)
         return os.path.join(self.archive_path, str(year), str(mon))
 
+    def get_params(self):
+        """Params of the request with day related variables in the filename filled in"""
+        params = dict(self.params)
+        the_day = get_day_of_week(yesterday=True)
+        if 'day' in params:
+            params['day'] = params['day'].replace("{theday}", the_day)
+        return params
+
+    @timed('download', objects=0)
     def get_datafeeds_file(self, streaming=False):
         """Downloads a file from NR Datafeeds site"""
-        # deal with day related variables in filename
-        the_day = get_day_of_week(yesterday=True)
-        if 'day' in self.params:
-            self.params['day'] = self.params['day'].replace("{theday}", the_day)
         resp = requests.get(self.data_url,
-                         params=self.params,
+                         params=self.get_params(),
                          auth=(self.username, self.password.get_secret_value()),
                          stream=streaming)
         if resp.status_code not in (200, 201):
@@ -62,6 +92,21 @@ class NrdatafeedsBlock(Block):
             raise Exception("Failed to get file from NR Datafeeds")
         return resp
 
+    async def get_signature(self, client):
+        """Gets the headers of the file from NR Datafeeds site without downloading it
+
+           Args:
+               client: httpx.AsyncClient to make the request with
+
+           Returns: signature of the current version of the file
+        """
+        async with client.stream("GET", self.data_url, params=self.get_params(),
+                                 auth=(self.username, self.password.get_secret_value()),
+                                 follow_redirects=True) as resp:
+            if resp.status_code not in (200, 201):
+                raise Exception(f"Failed to get headers from NR Datafeeds: {resp.status_code}")
+            return get_headers_signature(resp.headers)
+
 
 
 class Nrdfs3Block(Block):
@@ -82,6 +127,10 @@ class Nrdfs3Block(Block):
            filetype: Extension of files to download
            filter: Name of filter to use when downloading files
            rsync: Command to use to backup files
+           endpoint_url: URL of an S3 compatible service to use instead of AWS
+                         (e.g. a mirror or the stand-in of bench/), blank for AWS
+           profile: Profile every run of the flow (see utils/profiling.py)
+           process: Queue the flow processing the files fetched (nrdp_logs, see flows/pushport.py)
     """
 
     _block_type_name = "NR Datafeeds (S3 based)"
@@ -98,6 +147,9 @@ class Nrdfs3Block(Block):
     filetype: str
     filter: Literal["todays", "yesterdays"] = None
     rsync: str = None
+    endpoint_url: Optional[str] = None
+    profile: bool = False
+    process: bool = False
 
     def get_filepath_prefix(self, year=None, mon=None, day=None):
         """Defines scheme by which files are organized under the archive_path"""
@@ -105,8 +157,25 @@ class Nrdfs3Block(Block):
 
     def get_credentials(self):
         """Creates an AwsCredentials out of AWS information"""
+        from prefect_aws import AwsCredentials
+
         return AwsCredentials(
             aws_access_key_id=self.aws_access_key_id,
             aws_secret_access_key=self.aws_secret_access_key,
             region_name=self.region_name
         )
+
+    def get_client_parameters(self):
+        """Parameters of the boto3 S3 client (endpoint_url if not AWS)"""
+        from prefect_aws import AwsClientParameters
+
+        return AwsClientParameters(endpoint_url=self.endpoint_url or None)
+
+    def get_object_stream(self, key):
+        """Gets an S3 object of the bucket without reading its data
+
+           Returns: botocore StreamingBody of the data (read it with iter_chunks())
+        """
+        client = get_s3_client(self.aws_access_key_id, self.aws_secret_access_key.get_secret_value(),
+                               self.region_name, self.endpoint_url or None)
+        return client.get_object(Bucket=self.bucket, Key=key)['Body']
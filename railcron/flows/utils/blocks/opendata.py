@@ -10,7 +10,9 @@ from prefect.blocks.core import Block
 from pydantic import Field, SecretStr
 import requests
 
-from ..misc import get_current_ymd
+from ..files import get_expected_digests, write_chunks
+from ..metrics import timed
+from ..misc import get_current_ymd, get_headers_signature
 
 
 class OpendataBlock(Block):
@@ -25,6 +27,8 @@ class OpendataBlock(Block):
            archive_path: Where to save file to the file system
            rsync: Optional command to invoke rsync to backup files
            filetype: Extension of the fetched file
+           profile: Profile every run of the flow (see utils/profiling.py)
+           process: Queue the flow processing every new file (see flows/timetable.py)
     """
 
     _block_type_name = "National Rail OD Files"
@@ -37,9 +41,12 @@ class OpendataBlock(Block):
     archive_path: str
     filetype: str
     rsync: str = None
+    profile: bool = False
+    process: bool = False
 
     # no get_filepath_prefix() defined because of need to do specific things when saving a file
 
+    @timed('download', objects=0)
     def authenticate(self):
         """Logs into NR Opendata site and gets a token"""
         resp = requests.post(self.auth_url,
@@ -54,6 +61,7 @@ class OpendataBlock(Block):
             raise Exception("Could not authenticate with NR Opendata")
         return json.loads(resp.text)
 
+    @timed('download', objects=0)
     def get_file(self, auth_data, streaming=False):
         """Downloads a file from NR Opendata site"""
         headers = {
@@ -70,28 +78,57 @@ class OpendataBlock(Block):
             raise Exception("Failed to get file from NR Opendata")
         return resp
 
+    async def get_signature(self, client):
+        """Gets the headers of the data file from NR Opendata site without downloading it
+
+           Args:
+               client: httpx.AsyncClient to make the requests with
+
+           Returns: signature of the current version of the file
+        """
+        resp = await client.post(self.auth_url,
+                                 headers={ "Content-Type": "application/x-www-form-urlencoded" },
+                                 data={"username": self.username,
+                                       "password": self.password.get_secret_value()})
+        if resp.status_code not in (200, 201):
+            raise Exception(f"Could not authenticate with NR Opendata: {resp.status_code}")
+        headers = {
+           "Content-Type": "application/json",
+           "X-Auth-Token": resp.json()['token']
+        }
+        async with client.stream("GET", self.data_url, headers=headers,
+                                 follow_redirects=True) as resp:
+            if resp.status_code not in (200, 201):
+                raise Exception(f"Failed to get headers from NR Opendata: {resp.status_code}")
+            return get_headers_signature(resp.headers)
+
     def archive_atoc(self, data):
-        """Archives the ATOC ZIP file received from NR Opendata"""
+        """Archives the ATOC ZIP file received from NR Opendata
+
+           Raises: IntegrityError if file does not match the response's headers
+        """
         cyear, cmon, _ = get_current_ymd()
         os.makedirs(os.path.join(self.archive_path, cyear, cmon), mode=0o755, exist_ok=True)
         # get name of PKZIP file from headers - if it exists already, do not save it
         filename = data.headers['Content-Disposition'].split('"')[1]   # get the RJTTF*.ZIP part
         filepath = os.path.join(self.archive_path, cyear, cmon, filename)
         if not os.path.isfile(filepath):
-            with open(filepath, 'wb') as fd:
-                for chunk in data.iter_content(chunk_size=100*1024):
-                    fd.write(chunk)
+            write_chunks(data.iter_content(chunk_size=100*1024), filepath, get_expected_digests(data))
         return filepath
 
     def archive_incidents(self, data, thehour):
         """Archives the gzipped XML file received from the NR Incidents stream
 
+           The (streaming) response is compressed as it is received, never held in memory
+
            Note: the filename template is {thehour}.incidents.gz
         """
         cyear, cmon, cday = get_current_ymd()
         os.makedirs(os.path.join(self.archive_path, cyear, cmon, cday), mode=0o755, exist_ok=True)
         filepath = os.path.join(self.archive_path, cyear, cmon, cday,
                                 f"{thehour}.incidents." + self.filetype)
-        with gzip.open(filepath, 'wt', encoding='utf8') as fd:
-            fd.write(data.text)
+        # no timestamp in the gzip header so identical XML gives identical files
+        with gzip.GzipFile(filepath, 'wb', mtime=0) as fd:
+            for chunk in data.iter_content(chunk_size=100*1024):
+                fd.write(chunk)
         return filepath
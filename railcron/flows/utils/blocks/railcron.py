@@ -33,6 +33,20 @@ class RailcronBlock(Block):
                          Blank to disable, otherwise name of compression utility
                          Maximum compression by default
                          Only xz, gzip, bzip2, zstd supported
+           dedup:        Store identical files once (content-addressed store
+                         in archive_path/.blobs) and hardlink them into place
+           seekable:     With zstd, recompress to independent frames with a sidecar
+                         index so time ranges can be read without decompressing it all
+           cache_dir:    Local directory of a cache of decompressed files (blank to disable)
+                         pre-warmed with every new file, see utils/cache.py
+           cache_gb:     Maximum size of the cache, least recently used files are evicted
+           metrics_dir:  Directory of the Prometheus textfile collector where each flow
+                         run writes the metrics of its stages (blank to disable)
+           alert_window: Minutes errors are spooled and deduplicated before one digest
+                         of them is emailed (0 to email every error at once)
+           alert_spool:  SQLite database of the spooled errors (blank for the temp directory)
+           store_dir:    Directory of the column stores processed out of the archives
+                         (blank for .store/{archive directory} next to the archive_path)
 
            BACKUP_HOST:  Used in rsync command to backup files
            BACKUP_ROOT:  Set these to blank to disable rsync
@@ -45,7 +59,7 @@ class RailcronBlock(Block):
            MAIL_LOGIN:    These to send mail thru a server (not sendmail)
            MAIL_PWD:      Set all to blank to disable
            MAIL_SRV:      All these settings must be defined otherwise
-           MAIL_TYPE:     Prefect's SSL, STARTTLS, or INSECURE
+           MAIL_TYPE:     SSL, STARTTLS, or INSECURE
            MAIL_PORT:     465, 25, 587, 993...
     """
 
@@ -53,6 +67,14 @@ class RailcronBlock(Block):
     _description = "Block for managing Railcron's email, rsync, and compression functionality"
 
     recompress: Literal['bzip2', 'gzip', 'xz', 'zstd'] = None
+    dedup: bool = False
+    seekable: bool = False
+    cache_dir: Optional[str] = None
+    cache_gb: float = 20
+    metrics_dir: Optional[str] = None
+    alert_window: int = 0
+    alert_spool: Optional[str] = None
+    store_dir: Optional[str] = None
     BACKUP_HOST: Optional[str]
     BACKUP_ROOT: Optional[str]
     MAIL_FROM: Optional[str]
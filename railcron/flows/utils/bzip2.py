@@ -0,0 +1,184 @@
+"""
+Functions to decompress bzip2 files (e.g. the A51 TD/TRUST .tbz2 archives) across several cores
+
+A bzip2 stream is a sequence of independently compressed blocks, each starting with the
+48 bit magic 0x314159265359, but blocks are not byte aligned. The blocks are found by
+searching for the magic at each of the 8 possible bit shifts (bytes.find of the bytes
+fully covered by it, then checking the partial bytes at each end). Every block is then
+rewrapped as a standalone single block stream ("BZh9", the block bits, the end of stream
+magic 0x177245385090 and a stream CRC equal to the block CRC) and decompressed in a pool
+of processes, with the output put back in order.
+
+If the blocks cannot be decompressed separately (e.g. the magic occurs by chance in the
+compressed data) the file is decompressed sequentially instead, so the output is always
+that of bzip2.
+"""
+import bz2
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import io
+import mmap
+import os
+import shutil
+import tarfile
+
+
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+# files smaller than this are not worth a pool of processes
+PARALLEL_MIN = 4 * 1024 * 1024
+
+
+def get_patterns(magic):
+    """Byte patterns of a 48 bit magic at each bit shift
+
+       Returns: list of (shift, bytes to search for, first byte, mask, last byte, mask)
+    """
+    patterns = []
+    for shift in range(8):
+        window = (magic << (8 - shift)).to_bytes(7, 'big')
+        if shift == 0:
+            patterns.append((0, window[:6], None, 0, None, 0))
+        else:
+            patterns.append((shift, window[1:6], window[0], (1 << (8 - shift)) - 1,
+                             window[6], (0xFF << (8 - shift)) & 0xFF))
+    return patterns
+
+
+def find_magic(data, magic):
+    """Bit offsets of every occurrence of a 48 bit magic in data"""
+    found = []
+    for shift, pattern, first, first_mask, last, last_mask in get_patterns(magic):
+        idx = data.find(pattern)
+        while idx != -1:
+            if shift == 0:
+                found.append(idx * 8)
+            else:
+                start = idx - 1
+                if (start >= 0 and idx + 5 < len(data) and (data[start] & first_mask) == first
+                        and (data[idx + 5] & last_mask) == last):
+                    found.append(start * 8 + shift)
+            idx = data.find(pattern, idx + 1)
+    return sorted(found)
+
+
+def get_blocks(data):
+    """Bit ranges [start, end) of the blocks of bzip2 data (each up to the next marker)"""
+    blocks = set(find_magic(data, BLOCK_MAGIC))
+    markers = sorted(blocks | set(find_magic(data, EOS_MAGIC)))
+    ranges = []
+    for idx, start in enumerate(markers):
+        if start not in blocks:
+            continue
+        if idx + 1 == len(markers):
+            raise ValueError("bzip2 block without end")
+        ranges.append((start, markers[idx + 1]))
+    return ranges
+
+
+def wrap_block(chunk, start, end):
+    """Makes a standalone bzip2 stream of the block at bits [start, end) of chunk"""
+    nbits = end - start
+    value = int.from_bytes(chunk, 'big') >> (len(chunk) * 8 - end)
+    value &= (1 << nbits) - 1
+    crc = (value >> (nbits - 80)) & 0xFFFFFFFF
+    value = (value << 80) | (EOS_MAGIC << 32) | crc
+    total = nbits + 80
+    pad = -total % 8
+    return b'BZh9' + (value << pad).to_bytes((total + pad) // 8, 'big')
+
+
+def decode_block(args):
+    """Decompresses one block given as (bytes holding it, start bit, end bit)"""
+    return bz2.decompress(wrap_block(*args))
+
+
+def iter_decompressed(filepath, workers=None, lookahead=None):
+    """Yields the decompressed data of a bzip2 file block by block, in order
+
+       Args:
+           filepath: Path of the bzip2 file
+           workers: Number of processes (default is number of CPUs)
+           lookahead: Number of blocks decompressed ahead (default 2 per process)
+    """
+    produced = 0
+    try:
+        with open(filepath, 'rb') as fd, \
+                mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            blocks = get_blocks(data)
+            workers = workers or os.cpu_count() or 1
+            lookahead = lookahead or 2 * workers
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = deque()
+                for start, end in blocks:
+                    first = start // 8
+                    chunk = data[first:(end + 7) // 8]
+                    pending.append(pool.submit(decode_block, (chunk, start - first * 8, end - first * 8)))
+                    if len(pending) >= lookahead:
+                        out = pending.popleft().result()
+                        produced += len(out)
+                        yield out
+                while pending:
+                    out = pending.popleft().result()
+                    produced += len(out)
+                    yield out
+        return
+    except (ValueError, OSError, EOFError):
+        pass
+    # could not be split in blocks, carry on sequentially after what was already produced
+    with bz2.open(filepath) as fd:
+        while produced > 0:
+            produced -= len(fd.read(min(produced, 1024*1024)))
+        for chunk in iter(lambda: fd.read(1024*1024), b''):
+            yield chunk
+
+
+class ParallelBz2Reader(io.RawIOBase):
+    """Readable stream of the decompressed data of a bzip2 file (e.g. for tarfile or a recompressor)"""
+
+    def __init__(self, filepath, workers=None):
+        super().__init__()
+        self.chunks = iter_decompressed(filepath, workers)
+        self.buffer = b''
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if self.pos >= len(self.buffer):
+            self.buffer = next(self.chunks, b'')
+            self.pos = 0
+        size = min(len(buf), len(self.buffer) - self.pos)
+        buf[:size] = self.buffer[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+    def close(self):
+        self.chunks.close()
+        super().close()
+
+
+def open_bzip2(filepath, workers=None):
+    """Opens a bzip2 file for reading, in parallel if it is large enough"""
+    if os.path.getsize(filepath) < PARALLEL_MIN:
+        return bz2.open(filepath)
+    return io.BufferedReader(ParallelBz2Reader(filepath, workers), buffer_size=1024*1024)
+
+
+def decompress_file(filepath, outpath, workers=None):
+    """Decompresses a bzip2 file to outpath across a pool of processes
+
+       Returns: outpath
+    """
+    with open_bzip2(filepath, workers) as src, open(outpath, 'wb') as out:
+        shutil.copyfileobj(src, out, 1024*1024)
+    return outpath
+
+
+def open_tar(filepath, workers=None):
+    """Opens a .tbz2 archive as a streaming tar file decompressed in parallel
+
+       Returns: tarfile.TarFile to iterate over (mode 'r|', no random access)
+    """
+    return tarfile.open(fileobj=open_bzip2(filepath, workers), mode='r|')
@@ -0,0 +1,150 @@
+"""
+Functions for a local, size-bounded cache of decompressed archived files
+
+Jobs that repeatedly read the latest schedule, CORPUS or DARWIN reference files can
+get them decompressed from the cache (cache_dir setting) instead of paying for the
+decompression every time. Entries are keyed by the path of the archived file and
+its SHA-256, so a changed file is never served stale, and are evicted least recently
+used first once the cache is larger than cache_gb.
+
+Entries are only ever added by an atomic rename and are read through mmap, so
+concurrent readers are safe: an entry evicted while in use stays readable until closed.
+Populating and evicting entries is serialised with a lock file (fcntl).
+"""
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import mmap
+import os
+import shutil
+from tempfile import mkstemp
+
+from .codec import open_file
+from .delta import DELTA_EXT
+from .manifest import get_file_digests, get_file_record
+
+
+LOCK_NAME = ".lock"
+
+
+@contextmanager
+def cache_lock(cache_dir):
+    """Holds the lock of a cache"""
+    os.makedirs(cache_dir, mode=0o755, exist_ok=True)
+    with open(os.path.join(cache_dir, LOCK_NAME), 'a') as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def get_content_hash(cfg, filepath):
+    """SHA-256 of an archived file, from the manifest when it is up to date"""
+    stat = os.stat(filepath)
+    if cfg.archive_path:
+        record = get_file_record(cfg.archive_path, filepath)
+        if record is not None and record['size'] == stat.st_size and record['mtime'] == stat.st_mtime:
+            return record['sha256']
+    return get_file_digests(filepath)['sha256']
+
+
+def get_entry_path(cfg, filepath):
+    """Path of the cache entry of an archived file"""
+    abspath = os.path.abspath(filepath)
+    key = hashlib.sha256(f"{abspath}\0{get_content_hash(cfg, filepath)}".encode('utf8')).hexdigest()
+    return os.path.join(cfg.settings.cache_dir, key[:2], key)
+
+
+def evict(cache_dir, max_bytes, keep=None):
+    """Removes the least recently used entries until the cache is no larger than max_bytes
+
+       Must be called with the cache lock held, the entry keep is never removed
+
+       Returns: number of bytes freed
+    """
+    entries = []
+    total = 0
+    for dirpath, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            if filename.startswith('.'):
+                continue
+            fullpath = os.path.join(dirpath, filename)
+            stat = os.stat(fullpath)
+            total += stat.st_size
+            if fullpath != keep:
+                entries.append((stat.st_mtime, stat.st_size, fullpath))
+    freed = 0
+    for _, size, fullpath in sorted(entries):
+        if total - freed <= max_bytes:
+            break
+        os.unlink(fullpath)
+        freed += size
+    return freed
+
+
+def cached_path(cfg, filepath, fname=None):
+    """Gets the path of the decompressed copy of an archived file, decompressing it if needed
+
+       Args:
+           cfg: Block of the flow (settings.cache_dir and cache_gb)
+           filepath: Path of the archived file
+           fname: Name of the flow, needed for delta encoded files
+
+       Returns: path of the cache entry
+    """
+    entry = get_entry_path(cfg, filepath)
+    try:
+        # the modification time of an entry is its last use
+        os.utime(entry)
+        return entry
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(entry), mode=0o755, exist_ok=True)
+    fdesc, tmppath = mkstemp(dir=os.path.dirname(entry), prefix=".fill")
+    try:
+        with os.fdopen(fdesc, 'wb') as out:
+            if filepath.endswith(DELTA_EXT):
+                # imported here as the reader depends on the blocks, which use this module
+                from .reader import open_source
+                src = open_source(filepath, fname, cfg)
+            else:
+                src = open_file(filepath)
+            with src:
+                shutil.copyfileobj(src, out, 1024*1024)
+        with cache_lock(cfg.settings.cache_dir):
+            os.replace(tmppath, entry)
+            evict(cfg.settings.cache_dir, cfg.settings.cache_gb * 1024**3, keep=entry)
+    except Exception:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+    return entry
+
+
+def open_cached(cfg, filepath, fname=None):
+    """Opens the decompressed contents of an archived file as a read-only memory map
+
+       Falls back to a plain read when the cache is disabled (no cache_dir)
+
+       Returns: mmap.mmap (or bytes when empty or not cached)
+    """
+    if not cfg.settings.cache_dir:
+        with open_file(filepath) as fd:
+            return fd.read()
+    try:
+        fd = open(cached_path(cfg, filepath, fname), 'rb')
+    except FileNotFoundError:
+        # evicted by another process in between
+        fd = open(cached_path(cfg, filepath, fname), 'rb')
+    with fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def warm_file(cfg, filepath, fname=None):
+    """Adds a newly archived file to the cache (no-op if the cache is disabled)"""
+    if not cfg.settings.cache_dir or not filepath or not os.path.isfile(filepath):
+        return None
+    return cached_path(cfg, filepath, fname)
@@ -0,0 +1,432 @@
+"""
+Streaming parser of the ATOC CIF timetable into indexed column stores
+
+The .MCA file of the RJTTF*.ZIP (the full timetable, hundreds of MB of 80 character
+records) is read straight out of the archived ZIP or recompressed tar (see
+utils/files.py tar_and_compress), or its decompressed copy in the cache, without
+extracting it. Records are read a batch at a time and each batch is viewed as an
+(n, 80) array of bytes, so that a field of all the records of a type is sliced, and
+its digits converted, at once with NumPy rather than line by line.
+
+The timetable is a directory of tables (see utils/columnar.py):
+    schedules:     BS records (and the operator of their BX), the row of their first
+                   location and their number of locations
+    locations:     LO, LI and LT records, the row of their schedule and their sequence in it
+    associations:  AA records
+    tiplocs:       TI and TA records
+indexed by TIPLOC (locations, associations), train UID (schedules, associations) and
+start of validity (schedules). Timetable answers the usual queries from them.
+
+Dates are stored as days since 1970-01-01 (OPEN_END for 999999), times as seconds after
+midnight (-1 when not given) and days run as a bit mask (bit 0 Monday). The full
+extract is expected (transaction type N); CR (change en route) records are skipped.
+"""
+from contextlib import contextmanager
+from datetime import date, datetime
+import os
+from shutil import rmtree
+import tarfile
+from tempfile import mkdtemp
+import zipfile
+
+import numpy as np
+
+from .cache import cached_path
+from .codec import iter_lines, open_file
+from .columnar import Table, TableWriter, add_index
+
+
+BATCH_BYTES = 16 * 1024 * 1024
+RECORD_LEN = 80
+OPEN_END = np.iinfo(np.int32).max
+# short term planning indicators in order of precedence (blank or unknown last)
+STP_ORDER = b'CNOP'
+stp_rank = np.full(256, len(STP_ORDER), np.int8)
+stp_rank[list(STP_ORDER)] = np.arange(len(STP_ORDER))
+
+
+def record_code(name):
+    return ord(name[0]) << 8 | ord(name[1])
+
+
+BS, BX, LO, LI, LT, AA, TI, TA = [record_code(x) for x in ("BS", "BX", "LO", "LI", "LT", "AA", "TI", "TA")]
+
+schedule_columns = {
+    'uid': 'S6', 'date_from': 'i4', 'date_to': 'i4', 'days': 'u1', 'stp': 'S1', 'status': 'S1',
+    'category': 'S2', 'headcode': 'S4', 'service_code': 'S8', 'operator': 'S2',
+    'first_location': 'i8', 'locations': 'i4',
+}
+location_columns = {
+    'schedule': 'i8', 'seq': 'i2', 'kind': 'S1', 'tiploc': 'S7', 'suffix': 'S1',
+    'arrival': 'i4', 'departure': 'i4', 'pass': 'i4', 'public_arrival': 'i4', 'public_departure': 'i4',
+    'platform': 'S3', 'activity': 'S12',
+}
+association_columns = {
+    'main_uid': 'S6', 'assoc_uid': 'S6', 'date_from': 'i4', 'date_to': 'i4', 'days': 'u1',
+    'category': 'S2', 'date_ind': 'S1', 'tiploc': 'S7', 'stp': 'S1',
+}
+tiploc_columns = {'tiploc': 'S7', 'nalco': 'S6', 'stanox': 'i4', 'crs': 'S3', 'name': 'S26'}
+
+# table -> index -> columns of its key
+indexes = {
+    'schedules': {'uid': ['uid'], 'validity': ['date_from']},
+    'locations': {'tiploc': ['tiploc']},
+    'associations': {'uid': ['main_uid'], 'tiploc': ['tiploc']},
+    'tiplocs': {'tiploc': ['tiploc'], 'crs': ['crs']},
+}
+
+
+def to_day(value):
+    """Days since 1970-01-01 of a date, datetime or "YYYY-MM-DD" string"""
+    if isinstance(value, datetime):
+        value = value.date()
+    return int((np.datetime64(value, 'D') - np.datetime64('1970-01-01', 'D')).astype(np.int64))
+
+
+def from_day(day):
+    """date of a number of days since 1970-01-01 (None for OPEN_END)"""
+    if day == OPEN_END or day < 0:
+        return None
+    return (np.datetime64('1970-01-01', 'D') + np.timedelta64(int(day), 'D')).astype(date)
+
+
+def text(rec, start, end):
+    """Field of the records as bytes, spaces (the padding) removed"""
+    field = rec[:, start:end].copy()
+    field[field == 32] = 0
+    return field.view(f'S{end - start}').ravel()
+
+
+def raw(rec, start, end):
+    """Field of the records as bytes, as it is"""
+    return np.ascontiguousarray(rec[:, start:end]).view(f'S{end - start}').ravel()
+
+
+def number(rec, start, end):
+    """Digits of a field as integers, -1 where blank or not a number"""
+    digits = rec[:, start:end] - np.uint8(48)
+    # anything but a digit wrapped around to over 9
+    valid = (digits <= 9).all(axis=1)
+    values = digits[:, 0].astype(np.int32)
+    for col in range(1, end - start):
+        values *= 10
+        values += digits[:, col]
+    values[~valid] = -1
+    return values
+
+
+def day_number(rec, start):
+    """yymmdd dates of the records as days since 1970-01-01 (-1 if blank, OPEN_END for 999999)"""
+    yymmdd = number(rec, start, start + 6)
+    year, mon, day = yymmdd // 10000, yymmdd // 100 % 100, yymmdd % 100
+    valid = (yymmdd >= 0) & (mon >= 1) & (mon <= 12) & (day >= 1) & (day <= 31)
+    months = np.where(valid, (np.where(year < 60, 2000 + year, 1900 + year) - 1970) * 12 + mon - 1, 0)
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + day - 1
+    days = np.where(valid, days, -1).astype(np.int32)
+    days[yymmdd == 999999] = OPEN_END
+    return days
+
+
+def seconds(rec, start, half=True):
+    """HHMM (and H for the half minute) times as seconds after midnight, -1 if blank"""
+    hhmm = number(rec, start, start + 4)
+    secs = (hhmm // 100 * 60 + hhmm % 100) * 60
+    if half:
+        secs += np.where(rec[:, start + 4] == ord('H'), 30, 0).astype(np.int32)
+    return np.where(hhmm >= 0, secs, -1).astype(np.int32)
+
+
+def days_run(rec, start):
+    """Days run (1 or 0 from Monday to Sunday) as a bit mask"""
+    bits = (rec[:, start:start + 7] == ord('1')).astype(np.uint8)
+    return (bits @ (1 << np.arange(7, dtype=np.uint8))).astype(np.uint8)
+
+
+def to_records(data):
+    """Lines of fixed-width records as an (n, 80) array of bytes"""
+    buf = np.frombuffer(data, np.uint8)
+    for width in (RECORD_LEN + 1, RECORD_LEN + 2):
+        # every line 80 characters and \n or \r\n: no copy needed
+        if len(buf) % width == 0 and (buf[width - 1::width] == 10).all():
+            return buf.reshape(-1, width)[:, :RECORD_LEN]
+    lines = np.array(data.splitlines(), dtype=f'S{RECORD_LEN}')
+    return lines.view(np.uint8).reshape(-1, RECORD_LEN)
+
+
+def iter_batches(fd, batch_bytes=BATCH_BYTES):
+    """Records of a CIF stream, a batch of whole lines at a time (see to_records())"""
+    for data in iter_lines(fd, batch_bytes):
+        yield to_records(data)
+
+
+def find_mca(names):
+    """Name of the .MCA file among the members of a timetable archive"""
+    for name in names:
+        if name.upper().endswith(".MCA"):
+            return name
+    raise Exception(f"No .MCA file in timetable archive ({', '.join(names)})")
+
+
+@contextmanager
+def open_mca(filepath, cfg=None):
+    """Opens the .MCA file of an archived timetable (ZIP, compressed tar or the file itself)
+
+       Args:
+           filepath: Path of the archived file
+           cfg: Block of the flow, to read the decompressed copy in the cache if enabled
+
+       Returns: binary file object
+    """
+    source = filepath
+    if cfg is not None and cfg.settings.cache_dir:
+        source = cached_path(cfg, filepath, "atoc")
+    with open(source, 'rb') as fd:
+        is_zip = fd.read(4) == b'PK\x03\x04'
+    if is_zip:
+        with zipfile.ZipFile(source) as zfile:
+            with zfile.open(find_mca(zfile.namelist())) as member:
+                yield member
+        return
+    with open_file(source) as fd:
+        if ".tar" not in os.path.basename(filepath):
+            yield fd
+            return
+        # a stream: members are read in order without seeking
+        with tarfile.open(fileobj=fd, mode='r|') as tar:
+            names = []
+            for member in tar:
+                names.append(member.name)
+                if member.isfile() and member.name.upper().endswith(".MCA"):
+                    yield tar.extractfile(member)
+                    return
+        find_mca(names)
+
+
+class TimetableWriter:
+    """Writes the tables of a timetable from batches of records"""
+
+    def __init__(self, path):
+        self.path = path
+        self.schedules = TableWriter(os.path.join(path, "schedules"), schedule_columns)
+        self.locations = TableWriter(os.path.join(path, "locations"), location_columns)
+        self.associations = TableWriter(os.path.join(path, "associations"), association_columns)
+        self.tiplocs = TableWriter(os.path.join(path, "tiplocs"), tiploc_columns)
+        self.writers = [self.schedules, self.locations, self.associations, self.tiplocs]
+
+    def add_batch(self, rec):
+        """Writes a batch of records, the records of each schedule all in the batch"""
+        kinds = rec[:, 0].astype(np.uint16) << 8 | rec[:, 1]
+        self.add_tiplocs(rec[(kinds == TI) | (kinds == TA)])
+        self.add_associations(rec[kinds == AA])
+
+        is_bs = kinds == BS
+        # schedule of each record (its row in the batch), -1 before the first BS
+        owner = np.cumsum(is_bs) - 1
+        bs = rec[is_bs]
+        is_bx = (kinds == BX) & (owner >= 0)
+        is_loc = ((kinds == LO) | (kinds == LI) | (kinds == LT)) & (owner >= 0)
+        loc = rec[is_loc]
+        loc_owner = owner[is_loc]
+        first = np.searchsorted(loc_owner, np.arange(len(bs)))
+        count = np.diff(np.append(first, len(loc_owner)))
+
+        operator = np.zeros(len(bs), 'S2')
+        operator[owner[is_bx]] = text(rec[is_bx], 11, 13)
+        self.schedules.append(
+            uid=text(bs, 3, 9), date_from=day_number(bs, 9), date_to=day_number(bs, 15), days=days_run(bs, 21),
+            stp=raw(bs, 79, 80), status=text(bs, 29, 30), category=text(bs, 30, 32), headcode=text(bs, 32, 36),
+            service_code=text(bs, 41, 49), operator=operator,
+            first_location=self.locations.rows + first, locations=count)
+        self.add_locations(loc, kinds[is_loc], self.schedules.rows - len(bs) + loc_owner,
+                           np.arange(len(loc)) - first[loc_owner])
+
+    def add_locations(self, loc, kinds, schedule, seq):
+        rows = len(loc)
+        columns = {
+            'schedule': schedule, 'seq': seq, 'kind': raw(loc, 1, 2), 'tiploc': text(loc, 2, 9),
+            'suffix': text(loc, 9, 10), 'platform': np.zeros(rows, 'S3'), 'activity': np.zeros(rows, 'S12'),
+        }
+        for name in ('arrival', 'departure', 'pass', 'public_arrival', 'public_departure'):
+            columns[name] = np.full(rows, -1, np.int32)
+        # fields of each type of location record: (column, start, parser)
+        layouts = {
+            LO: [('departure', 10, seconds), ('public_departure', 15, False), ('platform', 19, 22),
+                 ('activity', 29, 41)],
+            LI: [('arrival', 10, seconds), ('departure', 15, seconds), ('pass', 20, seconds),
+                 ('public_arrival', 25, False), ('public_departure', 29, False), ('platform', 33, 36),
+                 ('activity', 42, 54)],
+            LT: [('arrival', 10, seconds), ('public_arrival', 15, False), ('platform', 19, 22),
+                 ('activity', 25, 37)],
+        }
+        for kind, fields in layouts.items():
+            mask = kinds == kind
+            sub = loc[mask]
+            for name, start, end in fields:
+                if end is seconds:
+                    columns[name][mask] = seconds(sub, start)
+                elif end is False:
+                    columns[name][mask] = seconds(sub, start, half=False)
+                elif name == 'activity':
+                    columns[name][mask] = raw(sub, start, end)
+                else:
+                    columns[name][mask] = text(sub, start, end)
+        self.locations.append(**columns)
+
+    def add_associations(self, aa):
+        self.associations.append(
+            main_uid=text(aa, 3, 9), assoc_uid=text(aa, 9, 15), date_from=day_number(aa, 15),
+            date_to=day_number(aa, 21), days=days_run(aa, 27), category=text(aa, 34, 36),
+            date_ind=text(aa, 36, 37), tiploc=text(aa, 37, 44), stp=raw(aa, 79, 80))
+
+    def add_tiplocs(self, ti):
+        self.tiplocs.append(
+            tiploc=text(ti, 2, 9), nalco=text(ti, 11, 17), stanox=number(ti, 44, 49), crs=text(ti, 53, 56),
+            name=np.char.rstrip(raw(ti, 18, 44)))
+
+    def close(self, **meta):
+        for writer in self.writers:
+            writer.meta.update(meta)
+            writer.close()
+        for table, table_indexes in indexes.items():
+            for name, columns in table_indexes.items():
+                add_index(os.path.join(self.path, table), name, columns)
+
+    def abort(self):
+        for writer in self.writers:
+            writer.abort()
+
+
+def build_timetable(filepath, path, cfg=None, batch_bytes=BATCH_BYTES):
+    """Parses the .MCA file of an archived timetable into a timetable at path
+
+       The timetable is written next to path and renamed into place once complete.
+
+       Args:
+           filepath: Archived RJTTF*.ZIP or tar
+           path: Directory of the timetable (replaced if it exists)
+           cfg: Block of the flow, to read the file from the cache if enabled
+
+       Returns: dict of the number of rows of each table
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmpdir = mkdtemp(prefix=".tmp-", dir=os.path.dirname(os.path.abspath(path)))
+    os.chmod(tmpdir, 0o755)
+    writer = TimetableWriter(tmpdir)
+    try:
+        pending = np.empty((0, RECORD_LEN), np.uint8)
+        with open_mca(filepath, cfg) as fd:
+            for batch in iter_batches(fd, batch_bytes):
+                rec = np.concatenate([pending, batch]) if len(pending) else batch
+                # the records after the last BS may belong to a schedule continuing in the next batch
+                starts = np.flatnonzero((rec[:, 0] == ord('B')) & (rec[:, 1] == ord('S')))
+                cut = starts[-1] if len(starts) else len(rec)
+                writer.add_batch(rec[:cut])
+                pending = rec[cut:].copy()
+        writer.add_batch(pending)
+        writer.close(source=filepath)
+    except BaseException:
+        writer.abort()
+        rmtree(tmpdir, ignore_errors=True)
+        raise
+    if os.path.exists(path):
+        rmtree(path)
+    os.rename(tmpdir, path)
+    return {x.path.split(os.sep)[-1]: x.rows for x in writer.writers}
+
+
+class Timetable:
+    """Queries of a timetable written by build_timetable()
+
+       Dates can be given as date, datetime or "YYYY-MM-DD", the rows of the tables
+       returned as dicts of arrays (see columnar.Table.take()).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.schedules = Table(os.path.join(path, "schedules"))
+        self.locations = Table(os.path.join(path, "locations"))
+        self.associations = Table(os.path.join(path, "associations"))
+        self.tiplocs = Table(os.path.join(path, "tiplocs"))
+
+    def runs_on(self, rows, day):
+        """Which of the schedules at rows are valid and run on the day (days since 1970-01-01)"""
+        weekday = (day + 3) % 7
+        return ((self.schedules['date_from'][rows] <= day) & (self.schedules['date_to'][rows] >= day)
+                & ((self.schedules['days'][rows] >> weekday) & 1).astype(bool))
+
+    def select_stp(self, rows):
+        """Keeps, of schedules running on the same day, the one of each train taking precedence
+           (cancellation, new, overlay then permanent) and drops the cancelled trains
+        """
+        if not len(rows):
+            return rows
+        uids = np.asarray(self.schedules['uid'][rows])
+        rank = stp_rank[np.asarray(self.schedules['stp'][rows]).view(np.uint8)]
+        order = np.lexsort((rank, uids))
+        first = np.ones(len(order), bool)
+        first[1:] = uids[order][1:] != uids[order][:-1]
+        chosen = rows[order[first]]
+        return np.sort(chosen[self.schedules['stp'][chosen] != b'C'])
+
+    def running_on(self, when):
+        """Rows of the schedules of the trains running on a date"""
+        day = to_day(when)
+        rows = self.schedules.index('validity').find_range((np.iinfo(np.int32).min,), (day,))
+        rows = np.sort(rows)
+        return self.select_stp(rows[self.runs_on(rows, day)])
+
+    def get_schedules(self, uid, when=None):
+        """Rows of the schedules of a train UID (only the one applying on the date if given)"""
+        rows = np.sort(self.schedules.index('uid').find(uid.encode()))
+        if when is None:
+            return rows
+        return self.select_stp(rows[self.runs_on(rows, to_day(when))])
+
+    def get_locations(self, schedule):
+        """Rows of the locations of a schedule, in order"""
+        first = int(self.schedules['first_location'][schedule])
+        return np.arange(first, first + int(self.schedules['locations'][schedule]))
+
+    def calls_at(self, tiploc, when, passing=False):
+        """Trains calling (or passing too) at a TIPLOC on a date, ordered by time
+
+           Returns: dict of arrays of the columns of the locations and of their schedules
+                    (uid, headcode, operator, stp, category)
+        """
+        day = to_day(when)
+        rows = self.locations.index('tiploc').find(tiploc.encode())
+        if not passing:
+            rows = rows[self.locations['pass'][rows] < 0]
+        schedules = np.asarray(self.locations['schedule'][rows])
+        running = self.runs_on(schedules, day)
+        rows, schedules = rows[running], schedules[running]
+        # the schedule of each train that applies may be another one (e.g. an overlay not calling here)
+        others = np.sort(self.schedules.index('uid').find_many(self.schedules['uid'][schedules]))
+        applying = self.select_stp(others[self.runs_on(others, day)])
+        keep = np.isin(schedules, applying)
+        rows, schedules = rows[keep], schedules[keep]
+        times = np.asarray(self.locations['departure'][rows])
+        times = np.where(times >= 0, times, np.maximum(self.locations['arrival'][rows], self.locations['pass'][rows]))
+        order = np.argsort(times, kind='stable')
+        result = self.locations.take(rows[order])
+        result.update(self.schedules.take(schedules[order], ['uid', 'headcode', 'operator', 'stp', 'category']))
+        return result
+
+    def get_associations(self, uid, when=None):
+        """Rows of the associations of a (main) train UID, valid on the date if given"""
+        rows = np.sort(self.associations.index('uid').find(uid.encode()))
+        if when is None:
+            return rows
+        day = to_day(when)
+        table = self.associations
+        valid = ((table['date_from'][rows] <= day) & (table['date_to'][rows] >= day)
+                 & ((table['days'][rows] >> ((day + 3) % 7)) & 1).astype(bool))
+        return rows[valid]
+
+    def get_tiploc(self, code):
+        """Row of a TIPLOC, or of the main TIPLOC of a CRS code, None if unknown"""
+        code = code.upper()
+        rows = self.tiplocs.index('tiploc').find(code.encode())
+        if not len(rows) and len(code) == 3:
+            rows = self.tiplocs.index('crs').find(code.encode())
+        return int(rows[0]) if len(rows) else None
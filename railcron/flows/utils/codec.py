@@ -0,0 +1,122 @@
+"""
+Functions to detect the compression of archived files and decompress them natively
+
+The codec is detected from the magic bytes of the data rather than the file extension,
+and the Python decompressors (gzip, bz2, lzma, zstandard if installed) are used so that
+no subprocesses or temporary files are needed. Without the zstandard module, zstd data
+is decompressed by piping it through the zstd command.
+"""
+import bz2
+import gzip
+import lzma
+import subprocess
+import zlib
+
+from .bzip2 import open_bzip2
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# largest zstd window accepted, that of --long=31 (recompacted and delta files)
+ZSTD_MAX_WINDOW = 2**31
+
+
+magics = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bzip2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'PK\x03\x04', 'zip'),
+]
+
+decompress_errors = (OSError, EOFError, lzma.LZMAError, zlib.error, ValueError)
+if zstandard is not None:
+    decompress_errors += (zstandard.ZstdError,)
+
+
+def detect_codec(fd):
+    """Detects the compression of a (seekable) binary file object from its magic bytes
+
+       Returns: gzip, bzip2, xz, zstd, zip or None if not compressed/recognized
+    """
+    position = fd.tell()
+    head = fd.read(6)
+    fd.seek(position)
+    for magic, codec in magics:
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+def open_decompressed(fd, codec):
+    """Opens a streaming decompressor of a binary file object (None if codec is not supported)"""
+    if codec == 'xz':
+        return lzma.open(fd)
+    if codec == 'bzip2':
+        return bz2.open(fd)
+    if codec == 'gzip':
+        return gzip.open(fd)
+    if codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor(max_window_size=ZSTD_MAX_WINDOW).stream_reader(fd, read_across_frames=True)
+    return None
+
+
+class PipeReader:
+    """Decompresses a file through an external command (e.g. zstd without the zstandard module)"""
+
+    def __init__(self, filepath, cmd):
+        self.proc = subprocess.Popen(cmd + [filepath], stdout=subprocess.PIPE)
+
+    def read(self, size=-1):
+        return self.proc.stdout.read(size)
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_file(filepath):
+    """Opens a file for reading its decompressed contents
+
+       Large bzip2 files are decompressed across a pool of processes (see utils/bzip2.py)
+
+       Returns: binary file object (the file itself if it is not compressed)
+    """
+    fd = open(filepath, 'rb')
+    codec = detect_codec(fd)
+    if codec == 'bzip2':
+        fd.close()
+        return open_bzip2(filepath)
+    decomp = open_decompressed(fd, codec)
+    if decomp is not None:
+        return decomp
+    if codec == 'zstd':
+        fd.close()
+        return PipeReader(filepath, ["zstd", "-d", "-q", "-c", "--long=31"])
+    return fd
+
+
+def iter_lines(fd, batch_bytes):
+    """Data of a stream about batch_bytes at a time, cut after the last whole line of each batch"""
+    rest = b''
+    while True:
+        data = fd.read(batch_bytes)
+        if not data:
+            break
+        data = rest + data
+        cut = data.rfind(b'\n') + 1
+        rest = data[cut:]
+        if cut:
+            yield data[:cut]
+    if rest.strip():
+        yield rest
@@ -0,0 +1,270 @@
+"""
+Compact column stores of the data processed out of the archives
+
+A table is a directory holding one raw file per column ({column}.bin, the values of
+the column back to back in native byte order) and a meta.json of its number of rows,
+the dtype of each column, its indexes and whatever else describes it (source file...).
+Columns are opened as read-only memory maps, so opening a table reads nothing and
+queries only touch the pages they need.
+
+Tables are written by appending chunks of columns (TableWriter) to a temporary
+directory that is renamed into place once complete, so readers never see a partial
+table and a failed run leaves nothing behind.
+
+An index of a table ({index}.keys.bin, {index}.rows.bin) holds the values of one or
+more of its columns, combined into one fixed-width key, in sorted order along with the
+row of each, so the rows of a key, key prefix or range of keys are found with binary
+searches (numpy.searchsorted) over the memory maps.
+"""
+import json
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+
+
+META_NAME = "meta.json"
+STORE_NAME = ".store"
+
+
+def get_store_path(cfg, *names):
+    """Where the processed data of a flow is kept: store_dir setting, else .store/{archive
+       directory} next to the archive_path (not in it, so the rsync of the archive does not
+       replicate it)
+
+       Args:
+           cfg: Block of the flow
+           names: Sub-directories of the store (e.g. the flow and the day)
+    """
+    root = getattr(cfg.settings, 'store_dir', None)
+    if not root:
+        archive_path = os.path.abspath(cfg.archive_path)
+        root = os.path.join(os.path.dirname(archive_path), STORE_NAME, os.path.basename(archive_path))
+    return os.path.join(root, *names)
+
+
+def make_key(*columns):
+    """Combines columns into one sortable fixed-width bytes key per row
+
+       Bytes columns are used as they are, integers as big-endian unsigned values
+       (signed ones offset) so that the bytes of the keys sort like the values.
+
+       Returns: array of dtype S<total width>
+    """
+    parts = []
+    for column in columns:
+        column = np.asarray(column)
+        if column.ndim == 0:
+            column = column.reshape(1)
+        if column.dtype.kind == 'S':
+            parts.append(np.ascontiguousarray(column).view(np.uint8).reshape(len(column), column.dtype.itemsize))
+        elif column.dtype.kind in 'iu':
+            width = column.dtype.itemsize
+            if column.dtype.kind == 'i':
+                column = column.astype(f'i{width}').view(f'u{width}') ^ np.array(1 << (width * 8 - 1), f'u{width}')
+            parts.append(column.astype(f'>u{width}').view(np.uint8).reshape(len(column), width))
+        else:
+            raise Exception(f"Can not make keys of columns of {column.dtype}")
+    if len(parts) == 1 and np.asarray(columns[0]).dtype.kind == 'S':
+        return np.asarray(columns[0]).reshape(-1)
+    data = np.ascontiguousarray(np.hstack(parts))
+    return data.view(f'S{data.shape[1]}').ravel()
+
+
+def pad_keys(keys, width, fill):
+    """Keys (prefixes) lengthened to width with fill bytes"""
+    if keys.dtype.itemsize == width:
+        return keys
+    data = np.ascontiguousarray(keys).view(np.uint8).reshape(len(keys), keys.dtype.itemsize)
+    data = np.hstack([data, np.full((len(keys), width - keys.dtype.itemsize), fill, np.uint8)])
+    return np.ascontiguousarray(data).view(f'S{width}').ravel()
+
+
+def read_meta(path):
+    with open(os.path.join(path, META_NAME), encoding='utf8') as fd:
+        return json.load(fd)
+
+
+def write_meta(path, meta):
+    """Writes the meta.json of a table (replaced at once)"""
+    tmpfile = os.path.join(path, META_NAME + ".tmp")
+    with open(tmpfile, 'w', encoding='utf8') as fd:
+        json.dump(meta, fd, indent=1)
+    os.replace(tmpfile, os.path.join(path, META_NAME))
+
+
+def open_array(filepath, dtype, rows):
+    """Read-only memory map of a raw array file (memmap can not map empty files)"""
+    if rows == 0:
+        return np.empty(0, dtype)
+    return np.memmap(filepath, dtype=dtype, mode='r', shape=(rows,))
+
+
+class TableWriter:
+    """Writes a table chunk by chunk
+
+       with TableWriter(path, {'uid': 'S6', 'days': 'u1'}) as table:
+           table.append(uid=uids, days=days)
+           table.meta['source'] = filepath
+    """
+
+    def __init__(self, path, dtypes):
+        self.path = path
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in dtypes.items()}
+        self.rows = 0
+        self.meta = {}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.tmpdir = mkdtemp(prefix=".tmp-", dir=os.path.dirname(os.path.abspath(path)))
+        os.chmod(self.tmpdir, 0o755)
+        self.files = {name: open(os.path.join(self.tmpdir, f"{name}.bin"), 'wb') for name in self.dtypes}
+
+    def append(self, **columns):
+        """Appends rows, given as one array (or list) per column, all of the same length"""
+        if set(columns) != set(self.dtypes):
+            raise Exception(f"Columns {sorted(columns)} do not match {sorted(self.dtypes)}")
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) != 1:
+            raise Exception(f"Columns of different lengths {sorted(lengths)}")
+        for name, values in columns.items():
+            self.files[name].write(np.ascontiguousarray(values, dtype=self.dtypes[name]).tobytes())
+        self.rows += lengths.pop()
+
+    def close(self):
+        """Completes the table and moves it into place (replacing any older one)
+
+           Returns: path of the table
+        """
+        for fd in self.files.values():
+            fd.close()
+        meta = dict(self.meta, rows=self.rows, columns={name: dtype.str for name, dtype in self.dtypes.items()},
+                    indexes={})
+        write_meta(self.tmpdir, meta)
+        if os.path.exists(self.path):
+            rmtree(self.path)
+        os.rename(self.tmpdir, self.path)
+        return self.path
+
+    def abort(self):
+        for fd in self.files.values():
+            fd.close()
+        rmtree(self.tmpdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_table(path, columns, **meta):
+    """Writes a whole table at once from a dict of column name -> array"""
+    with TableWriter(path, {name: np.asarray(values).dtype for name, values in columns.items()}) as table:
+        table.append(**columns)
+        table.meta.update(meta)
+    return path
+
+
+def add_index(path, name, columns):
+    """Indexes a table by the key made of some of its columns (see make_key())
+
+       Args:
+           path: Directory of the table
+           name: Name of the index
+           columns: Columns of the key, in order of significance
+    """
+    table = Table(path)
+    if table.rows:
+        keys = make_key(*[np.asarray(table[column]) for column in columns])
+    else:
+        keys = make_key(*[np.empty(0, table.meta['columns'][column]) for column in columns])
+    order = np.argsort(keys, kind='stable')
+    keys[order].tofile(os.path.join(path, f"{name}.keys.bin"))
+    order.astype(np.int64).tofile(os.path.join(path, f"{name}.rows.bin"))
+    meta = read_meta(path)
+    meta['indexes'][name] = {'columns': list(columns), 'dtype': keys.dtype.str}
+    write_meta(path, meta)
+
+
+class Index:
+    """Sorted keys of an index and the row of each"""
+
+    def __init__(self, path, name, meta):
+        self.name = name
+        self.columns = meta['indexes'][name]['columns']
+        self.dtypes = [np.dtype(meta['columns'][x]) for x in self.columns]
+        self.keys = open_array(os.path.join(path, f"{name}.keys.bin"), meta['indexes'][name]['dtype'], meta['rows'])
+        self.rows = open_array(os.path.join(path, f"{name}.rows.bin"), np.int64, meta['rows'])
+
+    def get_key(self, values, fill=0):
+        """Key of the values of the first columns of the index, the others filled with fill bytes"""
+        if len(values) > len(self.columns):
+            raise Exception(f"Index {self.name} has only {len(self.columns)} columns")
+        key = make_key(*[np.array([value], dtype) for value, dtype in zip(values, self.dtypes)])
+        width = self.keys.dtype.itemsize - key.dtype.itemsize
+        return np.frombuffer(key.tobytes() + bytes([fill]) * width, f'S{self.keys.dtype.itemsize}')[0]
+
+    def find_range(self, low, high):
+        """Rows whose key is from low to high (both inclusive), in the order of their keys
+
+           Args:
+               low, high: tuples of values of the (first) columns of the index
+        """
+        start = np.searchsorted(self.keys, self.get_key(low, 0), side='left')
+        end = np.searchsorted(self.keys, self.get_key(high, 255), side='right')
+        return np.asarray(self.rows[start:end])
+
+    def find(self, *values):
+        """Rows whose key starts with the values (all or the first columns of the index)"""
+        return self.find_range(values, values)
+
+    def find_many(self, values):
+        """Rows whose key starts with any of the values (of the first column of the index), by value"""
+        keys = np.unique(make_key(np.asarray(values, self.dtypes[0])))
+        starts = np.searchsorted(self.keys, pad_keys(keys, self.keys.dtype.itemsize, 0), side='left')
+        ends = np.searchsorted(self.keys, pad_keys(keys, self.keys.dtype.itemsize, 255), side='right')
+        lengths = ends - starts
+        # positions of all the ranges, without a loop over them
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return np.asarray(self.rows[offsets + np.arange(lengths.sum())])
+
+
+class Table:
+    """Memory mapped columns of a table, e.g. Table(path)['uid'][rows]"""
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = read_meta(path)
+        self.rows = self.meta['rows']
+        self.columns = list(self.meta['columns'].keys())
+        self._arrays = {}
+        self._indexes = {}
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            if name not in self.meta['columns']:
+                raise KeyError(f"No column {name} in table {self.path}")
+            self._arrays[name] = open_array(os.path.join(self.path, f"{name}.bin"),
+                                            self.meta['columns'][name], self.rows)
+        return self._arrays[name]
+
+    def __len__(self):
+        return self.rows
+
+    def index(self, name):
+        """Index of the table (see add_index())"""
+        if name not in self._indexes:
+            if name not in self.meta['indexes']:
+                raise KeyError(f"No index {name} in table {self.path}")
+            self._indexes[name] = Index(self.path, name, self.meta)
+        return self._indexes[name]
+
+    def take(self, rows, columns=None):
+        """Values of (some) columns at rows
+
+           Returns: dict of column name -> array
+        """
+        return {name: np.asarray(self[name][rows]) for name in (columns or self.columns)}
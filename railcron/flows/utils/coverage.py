@@ -0,0 +1,246 @@
+"""
+Functions to determine which periods of data are missing from the archives
+
+Each type of flow is expected to produce files at a certain cadence:
+    sched_ / data_   a file a day:        .../year/mon/day.filetype
+    nrdp_            a directory a day:   .../year/mon/day/*
+    incidents        a file an hour:      .../year/mon/day/hour.incidents.*
+    atoc_timetable   a file a month:      .../year/mon/RJTTF*
+    a51_             a file a day in monthly directories:
+                                          .../year/mon/day.tbz2 or yearmonday*.gz
+(nrdp_ and incidents day directories may have been packed into .../year/mon/day.pack.tar)
+
+Note: data_ files are only kept when they change so their gaps are not necessarily errors
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+
+from .blocks import block_types
+from .misc import get_current_ymd, get_date_range
+from .pack import PACK_EXT, read_index
+
+
+cadences = {
+    'nrdatafeeds': 'daily',
+    'nrdfs3': 'daily',
+    'a51': 'daily',
+    'incidents': 'hourly',
+    'atoc': 'monthly',
+}
+
+def get_archive_kind(fname):
+    """Determines the kind of archive a flow produces (None if it has no fixed cadence)"""
+    prefix = fname.split('_')[0]
+    kind = block_types.get(prefix)
+    if kind == 'opendata':
+        kind = prefix
+    return kind if kind in cadences else None
+
+
+def get_month_path(kind, cfg, year, mon):
+    """Path of the directory holding a month's files"""
+    if kind in ('nrdatafeeds', 'a51'):
+        return cfg.get_filepath_prefix(year, mon)
+    return os.path.join(cfg.archive_path, str(year), str(mon))
+
+
+def scan_month(kind, cfg, year, mon):
+    """Finds the periods of data present in a month's directory
+
+       Args:
+           kind: Kind of archive (see get_archive_kind)
+           cfg: Block of the flow
+           year / mon: Zero padded strings of the month
+
+       Returns: set of "year-mon", "year-mon-day" or "year-mon-day hour" strings
+    """
+    present = set()
+    dirpath = get_month_path(kind, cfg, year, mon)
+    if not os.path.isdir(dirpath):
+        return present
+    for entry in os.scandir(dirpath):
+        name = entry.name
+        if kind == 'nrdatafeeds':
+            # e.g. 01.full.cif.gz -> 01.full.cif.xz
+            stem = os.path.splitext(cfg.filetype)[0]
+            if entry.is_file() and name[:2].isdigit() and name[2:].startswith('.' + stem):
+                present.add(f"{year}-{mon}-{name[:2]}")
+        elif kind == 'nrdfs3':
+            if entry.is_dir() and name.isdigit() and any(os.scandir(entry.path)):
+                present.add(f"{year}-{mon}-{name}")
+            elif entry.is_file() and name.endswith(PACK_EXT):
+                present.add(f"{year}-{mon}-{name[:2]}")
+        elif kind == 'incidents':
+            hours = []
+            if entry.is_dir() and name.isdigit():
+                hours = [hour.name for hour in os.scandir(entry.path)]
+            elif entry.is_file() and name.endswith(PACK_EXT):
+                hours = list(read_index(entry.path))
+            for hour in hours:
+                if hour[:2].isdigit() and ".incidents." in hour:
+                    present.add(f"{year}-{mon}-{name[:2]} {hour[:2]}")
+        elif kind == 'atoc':
+            if entry.is_file():
+                present.add(f"{year}-{mon}")
+        elif kind == 'a51':
+            firstpart = name.split('.')[0]
+            if not entry.is_file() or not firstpart[:2].isdigit():
+                continue
+            if len(firstpart) == 2:
+                present.add(f"{year}-{mon}-{firstpart}")
+            elif firstpart.startswith(f"{year}{mon}"):
+                present.add(f"{year}-{mon}-{firstpart[6:8]}")
+    return present
+
+
+def get_archived_months(archive_path):
+    """Sorted list of [year, mon] of the month directories under archive_path"""
+    months = []
+    if not os.path.isdir(archive_path):
+        return months
+    for year in os.scandir(archive_path):
+        if not (year.is_dir() and year.name.isdigit() and len(year.name) == 4):
+            continue
+        for mon in os.scandir(year.path):
+            if mon.is_dir() and mon.name.isdigit():
+                months.append([year.name, mon.name])
+    return sorted(months)
+
+
+def get_expected(kind, first, last):
+    """List of all periods that should be present from first to last date (inclusive)"""
+    expected = []
+    for year, mon, day in get_date_range(first, last):
+        if kind == 'monthly':
+            if not expected or expected[-1] != f"{year}-{mon}":
+                expected.append(f"{year}-{mon}")
+        elif kind == 'hourly':
+            expected.extend([f"{year}-{mon}-{day} {hour:02d}" for hour in range(24)])
+        else:
+            expected.append(f"{year}-{mon}-{day}")
+    return expected
+
+
+def get_missing_ranges(expected, present):
+    """Collapses consecutive missing periods into [first, last] pairs"""
+    ranges = []
+    for idx, period in enumerate(expected):
+        if period in present:
+            continue
+        if ranges and ranges[-1][2] == idx - 1:
+            ranges[-1][1] = period
+            ranges[-1][2] = idx
+        else:
+            ranges.append([period, period, idx])
+    return [r[0:2] for r in ranges]
+
+
+def scan_archives(flow_cfgs, since=None, until=None, workers=8):
+    """Builds a coverage report of the archives of a set of flows
+
+       All month directories of all flows are scanned in parallel.
+
+       Args:
+           flow_cfgs: Dictionary of flow name -> Block of the flow
+           since: "year-mon-day" of first date to check
+                  Default of None means the first month in each archive
+           until: "year-mon-day" of last date to check
+                  Default of None means yesterday
+           workers: Number of threads scanning directories
+
+       Returns: dictionary of flow name -> coverage report of the flow
+    """
+    last = until.split('-') if until else get_current_ymd(yesterday=True)
+    plans = {}
+    for fname, cfg in flow_cfgs.items():
+        kind = get_archive_kind(fname)
+        if kind is None or not cfg.archive_path:
+            continue
+        if since:
+            first = since.split('-')
+        else:
+            months = get_archived_months(cfg.archive_path)
+            if not months:
+                plans[fname] = (kind, None, [])
+                continue
+            first = months[0] + ['01']
+        if datetime(*map(int, first)) > datetime(*map(int, last)):
+            plans[fname] = (kind, None, [])
+            continue
+        months = sorted({(y, m) for y, m, _ in get_date_range(first, last)})
+        plans[fname] = (kind, first, months)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {(fname, y, m): pool.submit(scan_month, plan[0], flow_cfgs[fname], y, m)
+                   for fname, plan in plans.items() for y, m in plan[2]}
+        found = {key: future.result() for key, future in futures.items()}
+
+    report = {}
+    for fname, (kind, first, months) in plans.items():
+        present = set()
+        for year, mon in months:
+            present |= found[(fname, year, mon)]
+        cadence = cadences[kind]
+        if first is None:
+            report[fname] = {'cadence': cadence, 'first': None, 'last': None,
+                             'expected': 0, 'present': 0, 'coverage': 0.0, 'missing': []}
+            continue
+        expected = get_expected(cadence, first, last)
+        if not since:
+            # archive started with the first period actually present
+            present_expected = [p for p in expected if p in present]
+            if present_expected:
+                expected = expected[expected.index(present_expected[0]):]
+        got = len([p for p in expected if p in present])
+        report[fname] = {
+            'cadence': cadence,
+            'first': expected[0] if expected else None,
+            'last': expected[-1] if expected else None,
+            'expected': len(expected),
+            'present': got,
+            'coverage': round(100.0 * got / len(expected), 2) if expected else 0.0,
+            'missing': get_missing_ranges(expected, present),
+        }
+    return report
+
+
+def get_repair_parameters(fname, missing):
+    """Parameters of the flow runs needed to refetch a flow's missing periods
+
+       Only NRDP (day ranges) and A51 (whole months) flows can fetch past data.
+
+       Args:
+           fname: Name of the flow
+           missing: List of [first, last] missing "year-mon-day" ranges
+
+       Returns: list of dictionaries of flow parameters
+    """
+    kind = get_archive_kind(fname)
+    runs = []
+    if kind == 'nrdfs3':
+        for first, last in missing:
+            year, mon, day = [int(x) for x in first.split('-')]
+            end_year, end_mon, end_day = [int(x) for x in last.split('-')]
+            runs.append({'year': year, 'mon': mon, 'day': day,
+                         'end_year': end_year, 'end_mon': end_mon, 'end_day': end_day})
+    elif kind == 'a51':
+        # A51 flows get all ungotten files of a month, keys use unpadded months
+        months = []
+        for first, last in missing:
+            for year, mon, _ in get_date_range(first.split('-'), last.split('-')):
+                if [int(year), int(mon)] not in months:
+                    months.append([int(year), int(mon)])
+        runs = [{'year': year, 'mon': mon} for year, mon in months]
+    return runs
+
+
+def format_report(report):
+    """Formats a coverage report as lines of text"""
+    lines = [f"{'Flow':<24} {'Cadence':<8} {'First':<14} {'Last':<14} {'Present':>8} {'Expected':>8} {'Coverage':>9}"]
+    for fname, info in sorted(report.items()):
+        lines.append(f"{fname:<24} {info['cadence']:<8} {str(info['first']):<14} {str(info['last']):<14} "
+                     f"{info['present']:>8} {info['expected']:>8} {info['coverage']:>8}%")
+        for first, last in info['missing']:
+            lines.append(f"    missing {first}" + (f" .. {last}" if last != first else ""))
+    return lines
@@ -0,0 +1,103 @@
+"""
+Functions for a content-addressed store of the files of an archive
+
+When enabled (dedup setting), every archived file is also stored once in the
+.blobs directory of its archive_path under its SHA-256, and identical files in the
+year/mon/day layout are replaced by hardlinks (or reflinks) to that single blob.
+
+Note: use rsync's -H option to preserve the hardlinks when backing up
+"""
+import os
+import subprocess
+from tempfile import mkstemp
+
+from .manifest import connect, get_file_record, record_file
+
+
+BLOB_DIR = ".blobs"
+
+
+def get_blob_path(archive_path, sha256):
+    """Path of a blob in the content-addressed store of an archive"""
+    return os.path.join(archive_path, BLOB_DIR, sha256[:2], sha256)
+
+
+def link_file(src, dst):
+    """Makes dst the same file as src, as a hardlink or failing that a reflink
+
+       Returns: True if dst now shares its data with src
+    """
+    fdesc, tmppath = mkstemp(dir=os.path.dirname(dst), prefix=".dedup")
+    os.close(fdesc)
+    os.unlink(tmppath)
+    try:
+        os.link(src, tmppath)
+    except OSError:
+        # e.g. different file systems or too many links
+        proc = subprocess.run(["cp", "--reflink=always", src, tmppath], capture_output=True)
+        if proc.returncode != 0:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            return False
+    os.replace(tmppath, dst)
+    return True
+
+
+def dedup_file(cfg, filepath):
+    """Stores a file in the archive's content-addressed store or links it to an identical blob
+
+       Args:
+           cfg: Block of the flow (settings.dedup must be True)
+           filepath: Path of a file in its final form (i.e. after any recompression)
+
+       Returns: path of the file
+    """
+    if not cfg.settings.dedup or filepath is None:
+        return filepath
+    record = get_file_record(cfg.archive_path, filepath)
+    if record is None or record['size'] != os.path.getsize(filepath):
+        record = record_file(cfg.archive_path, filepath)
+    blobpath = get_blob_path(cfg.archive_path, record['sha256'])
+    if os.path.exists(blobpath):
+        if not os.path.samefile(blobpath, filepath) and link_file(blobpath, filepath):
+            # mtime of the blob is now that of the file
+            record_file(cfg.archive_path, filepath, source=record.get('source'),
+                        etag=record.get('etag'), digests=record)
+    else:
+        os.makedirs(os.path.dirname(blobpath), mode=0o755, exist_ok=True)
+        link_file(filepath, blobpath)
+    return filepath
+
+
+def prune_blobs(archive_path):
+    """Removes blobs no longer linked to from the archive (hardlinks only)
+
+       Returns: number of bytes freed
+    """
+    freed = 0
+    blob_root = os.path.join(archive_path, BLOB_DIR)
+    if not os.path.isdir(blob_root):
+        return freed
+    for dirpath, _, filenames in os.walk(blob_root):
+        for filename in filenames:
+            blobpath = os.path.join(dirpath, filename)
+            stat = os.stat(blobpath)
+            if stat.st_nlink == 1:
+                freed += stat.st_size
+                os.unlink(blobpath)
+    return freed
+
+
+def get_dedup_report(archive_path):
+    """Compares the size of the files of an archive to the size of their distinct contents
+
+       Returns: dict of files, logical_bytes, unique_files, stored_bytes and ratio
+    """
+    conn = connect(archive_path)
+    files, logical = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+    unique, stored = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM (SELECT sha256, MAX(size) AS size FROM files GROUP BY sha256)"
+    ).fetchone()
+    conn.close()
+    return {'files': files, 'logical_bytes': logical, 'unique_files': unique, 'stored_bytes': stored,
+            'ratio': round(logical / stored, 3) if stored else 1.0}
@@ -0,0 +1,151 @@
+"""
+Functions for delta encoded storage of daily full snapshot files (CORPUS, SMART, TPS, full schedules)
+
+Every keyframe_days a day's file is stored in full (a keyframe, recompressed as usual).
+On the other days only a binary delta (zstd --patch-from) of the uncompressed file
+against the uncompressed keyframe is stored, as day.filetype.zdelta. As every delta is
+against its keyframe, any day can be rebuilt by applying a single delta.
+
+The uncompressed latest keyframe is cached in .delta/{archive directory}/{flow name}.ref
+next to the archive_path, not in it, so the rsync of the archive does not replicate it,
+and the keyframe of each day is recorded in the deltas table of the manifest.
+"""
+from datetime import date
+import os
+import shutil
+import subprocess
+from tempfile import mkstemp
+
+from .files import recompress
+from .manifest import connect, replace_file
+
+
+DELTA_DIR = ".delta"
+DELTA_EXT = ".zdelta"
+
+# --long=31 lets references/windows be up to 2GB
+zstd_patch = "zstd -q -f --long=31 -19"
+zstd_unpatch = "zstd -q -d -f --long=31"
+decompressors = {
+    '.gz': 'gzip -d -c',
+    '.bz2': 'bzip2 -d -c',
+    '.tbz2': 'bzip2 -d -c',
+    '.xz': 'xz -d -c',
+    '.zst': 'zstd -d -c --long=31',
+}
+
+
+def decompress_to(filepath, outpath):
+    """Writes the uncompressed contents of a file to outpath"""
+    tool = decompressors.get(os.path.splitext(filepath)[1])
+    if tool is None:
+        shutil.copyfile(filepath, outpath)
+        return outpath
+    with open(outpath, 'wb') as out:
+        subprocess.run(f"{tool} \"{filepath}\"", shell=True, stdout=out, check=True)
+    return outpath
+
+
+def get_ref_path(cfg, fname):
+    """Path of the cached uncompressed latest keyframe of a flow (outside the archive_path)"""
+    archive_path = os.path.abspath(cfg.archive_path)
+    return os.path.join(os.path.dirname(archive_path), DELTA_DIR, os.path.basename(archive_path), f"{fname}.ref")
+
+
+def get_last_keyframe(cfg, fname):
+    """Relative path and day of the latest keyframe of a flow (None if there is none)"""
+    conn = connect(cfg.archive_path)
+    row = conn.execute("SELECT path, day FROM deltas WHERE flow = ? AND path = keyframe "
+                       "ORDER BY day DESC LIMIT 1", (fname,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def record_delta(cfg, fname, filepath, day, keyframe):
+    """Records which keyframe the file of a day depends on"""
+    conn = connect(cfg.archive_path)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO deltas VALUES (?, ?, ?, ?)",
+                     (os.path.relpath(filepath, cfg.archive_path), fname, day, keyframe))
+    conn.close()
+
+
+def store_delta(cfg, fname, filepath, year, mon, day):
+    """Stores a newly downloaded file as a keyframe or as a delta against the last keyframe
+
+       Args:
+           cfg: NrdatafeedsBlock of the flow (delta and keyframe_days settings)
+           fname: Name of the flow
+           filepath: Path of the downloaded (compressed) file
+           year / mon / day: Date of the file
+
+       Returns: path of the keyframe or delta file now in the archive
+    """
+    the_day = f"{year}-{mon}-{day}"
+    refpath = get_ref_path(cfg, fname)
+    os.makedirs(os.path.dirname(refpath), mode=0o755, exist_ok=True)
+    stem = os.path.splitext(filepath)[0]
+    if filepath.endswith('.tbz2'):
+        stem += ".tar"
+    rawpath = decompress_to(filepath, stem + ".raw")
+
+    last = get_last_keyframe(cfg, fname)
+    keyframe_due = (last is None or not os.path.exists(refpath)
+                    or not os.path.exists(os.path.join(cfg.archive_path, last['path']))
+                    or (date.fromisoformat(the_day) - date.fromisoformat(last['day'])).days >= cfg.keyframe_days)
+    if keyframe_due:
+        os.replace(rawpath, refpath)
+        newpath = recompress(cfg, filepath) if cfg.settings.recompress else filepath
+        keyframe = os.path.relpath(newpath, cfg.archive_path)
+    else:
+        newpath = stem + DELTA_EXT
+        subprocess.run(f"{zstd_patch} --patch-from=\"{refpath}\" \"{rawpath}\" -o \"{newpath}\"",
+                       shell=True, check=True, capture_output=True)
+        os.unlink(rawpath)
+        os.unlink(filepath)
+        replace_file(cfg.archive_path, filepath, newpath)
+        keyframe = last['path']
+    record_delta(cfg, fname, newpath, the_day, keyframe)
+    return newpath
+
+
+def reconstruct(cfg, fname, year, mon, day, outpath=None):
+    """Rebuilds the uncompressed file of a day of a delta encoded flow
+
+       Args:
+           cfg: NrdatafeedsBlock of the flow
+           fname: Name of the flow
+           year / mon / day: Date of the file (zero padded strings)
+           outpath: Where to write the file, default is a new temporary file
+
+       Returns: path of the rebuilt file
+    """
+    the_day = f"{year}-{mon}-{day}"
+    conn = connect(cfg.archive_path)
+    row = conn.execute("SELECT path, keyframe FROM deltas WHERE flow = ? AND day = ?",
+                       (fname, the_day)).fetchone()
+    conn.close()
+    if row is None:
+        raise Exception(f"No file of {fname} for {the_day}")
+    if outpath is None:
+        fdesc, outpath = mkstemp(prefix=f"{fname}-{the_day}-")
+        os.close(fdesc)
+    keypath = os.path.join(cfg.archive_path, row['keyframe'])
+    if row['path'] == row['keyframe']:
+        return decompress_to(keypath, outpath)
+
+    tmpref = None
+    refpath = get_ref_path(cfg, fname)
+    last = get_last_keyframe(cfg, fname)
+    if last is None or last['path'] != row['keyframe'] or not os.path.exists(refpath):
+        fdesc, tmpref = mkstemp(prefix=f"{fname}-ref-")
+        os.close(fdesc)
+        refpath = decompress_to(keypath, tmpref)
+    try:
+        subprocess.run(f"{zstd_unpatch} --patch-from=\"{refpath}\" "
+                       f"\"{os.path.join(cfg.archive_path, row['path'])}\" -o \"{outpath}\"",
+                       shell=True, check=True, capture_output=True)
+    finally:
+        if tmpref is not None:
+            os.unlink(tmpref)
+    return outpath
@@ -5,15 +5,23 @@ LocalFileSystem block not used as extra steps involved in writing files.
 TODO: Use RemoteFileSystem to support SSH based backup instead of rsync?
       Or for archiving original copies to any remote file system?
 """
+import asyncio
+import base64
 import hashlib
 import os
-import pathlib
+import re
 from shutil import rmtree
 from tempfile import mkdtemp
 
-from prefect_shell import shell_run_command
+from prefect import get_run_logger
+from prefect.utilities.asyncutils import sync_compatible
 
+from .bzip2 import decompress_file
+from .manifest import record_file, replace_file
+from .metrics import count_retry, stage, timed
 from .misc import get_current_ymd
+from .runner import run_command
+from .seekable import recompress_seekable
 
 
 compressions = {'xz': ('xz -9 -T2', '.xz'),
@@ -27,40 +35,18 @@ compressions = {'xz': ('xz -9 -T2', '.xz'),
                 '.zst': 'zstd'
 }
 
-async def async_recompress(cfg, filepath):
-    """Recompresses the specified file to desired format (async version)
 
-       Can't use @sync_compatible because shell_run_command is async task and
-       return value is not return value of shell_run_command
+# bytes read/written at a time when streaming data, so memory does not grow with file sizes
+CHUNK_SIZE = 1024*1024
 
-       Args:
-           cfg: Block with configuration info
-           filepath: Path of original file
 
-       Returns: path to the new file
-    """
-    if cfg.settings.recompress not in compressions.keys():
-        raise Exception("Unsupported compression scheme")
-    oldext = os.path.splitext(os.path.basename(filepath))[1]
-    dirpath = os.path.dirname(filepath)
-    newname = os.path.splitext(os.path.basename(filepath))[0]
-    if oldext in compressions.keys():
-        tool = compressions[oldext]
-        if oldext == '.tbz2': newname += ".tar"
-        cmd = f"{tool} {filepath} ; {compressions[cfg.settings.recompress][0]} {newname}"
-        # handle when ext of original file does not need to be stripped off
-        if cfg.filetype == '--':
-            cmd = f"{compressions[cfg.settings.recompress][0]} {filepath}"
-            newname = filepath
-    else:
-        # original file is not recognized as being compressed
-        newname = filepath
-        cmd = f"{compressions[cfg.settings.recompress][0]} {newname}"
-    await shell_run_command(command=cmd, helper_command=f"cd {dirpath}", return_all=True)
-    return os.path.join(dirpath, newname + compressions[cfg.settings.recompress][1])
+class IntegrityError(Exception):
+    """Raised when downloaded data does not match what its source says it should be"""
 
 
-def recompress(cfg, filepath):
+@sync_compatible
+@timed('recompress', size=lambda cfg, filepath: os.path.getsize(filepath))
+async def recompress(cfg, filepath):
     """Recompresses the specified file to desired format
 
        Args:
@@ -71,6 +57,9 @@ def recompress(cfg, filepath):
     """
     if cfg.settings.recompress not in compressions.keys():
         raise Exception("Unsupported compression scheme")
+    loop = asyncio.get_running_loop()
+    if cfg.settings.recompress == 'zstd' and cfg.settings.seekable:
+        return await loop.run_in_executor(None, recompress_seekable, cfg, filepath)
     oldext = os.path.splitext(os.path.basename(filepath))[1]
     dirpath = os.path.dirname(filepath)
     newname = os.path.splitext(os.path.basename(filepath))[0]
@@ -82,26 +71,33 @@ def recompress(cfg, filepath):
         if cfg.filetype == '--':
             cmd = f"{compressions[cfg.settings.recompress][0]} {filepath}"
             newname = filepath
+        elif oldext in ('.tbz2', '.bz2'):
+            # bunzip2 only uses one core
+            await loop.run_in_executor(None, decompress_file, filepath, os.path.join(dirpath, newname))
+            os.unlink(filepath)
+            cmd = f"{compressions[cfg.settings.recompress][0]} {newname}"
     else:
         # original file is not recognized as being compressed
         newname = filepath
         cmd = f"{compressions[cfg.settings.recompress][0]} {newname}"
-    shell_run_command(command=cmd, helper_command=f"cd {dirpath}", return_all=True)
-    return os.path.join(dirpath, newname + compressions[cfg.settings.recompress][1])
+    await run_command(cmd, cwd=dirpath)
+    newpath = os.path.join(dirpath, newname + compressions[cfg.settings.recompress][1])
+    await loop.run_in_executor(None, replace_file, cfg.archive_path, filepath, newpath)
+    return newpath
 
 
-def unzip_file(zipfile):
+@sync_compatible
+@timed('recompress', size=os.path.getsize)
+async def unzip_file(zipfile):
     """Unzips fullpath ZIP file to tmp directory"""
     tmpdir = mkdtemp(dir="/tmp")
-    dirpath = os.path.dirname(zipfile)
-    shell_run_command(
-        command=f"unzip \"{zipfile}\" -d {tmpdir}",
-        helper_command=f"cd \"{dirpath}\"",
-        return_all=True)
+    await run_command(f"unzip \"{zipfile}\" -d {tmpdir}", cwd=os.path.dirname(zipfile))
     return tmpdir
 
 
-def tar_and_compress(compressor, filepath, tmpdir):
+@sync_compatible
+@timed('recompress', size=lambda compressor, filepath, tmpdir: os.path.getsize(filepath))
+async def tar_and_compress(compressor, filepath, tmpdir):
     """Tar and recompresss a collection of files
 
        Args:
@@ -116,37 +112,139 @@ def tar_and_compress(compressor, filepath, tmpdir):
     newname = os.path.splitext(filepath)[0]
     newname += ".tar" + compressions[compressor][1]
     # UNIX vs BSD?
-    cmd = f"tar -I '{compressions[compressor][0]}' -c -f \"{newname}\" *"
-    shell_run_command(command=cmd, helper_command=f"cd {tmpdir}",
-                      return_all=True)
+    await run_command(f"tar -I '{compressions[compressor][0]}' -c -f \"{newname}\" *", cwd=tmpdir)
     os.unlink(filepath)
     rmtree(tmpdir)
     return newname
 
 
-def archive_data_to_file(resp, filepath_prefix, filename, streaming=True):
+def get_expected_digests(resp):
+    """What the headers of a HTTP response say its data should be
+
+       Nothing can be checked when the data was decoded (Content-Encoding) by requests
+    """
+    if resp.headers.get('Content-Encoding') not in (None, '', 'identity'):
+        return {}
+    return {'size': resp.headers.get('Content-Length'),
+            'etag': resp.headers.get('ETag'),
+            'content_md5': resp.headers.get('Content-MD5')}
+
+
+def check_digests(digests, expected):
+    """Compares the digests of downloaded data to what was expected
+
+       Args:
+           digests: dict of md5, sha256 and size of the data
+           expected: dict of any of size, etag (S3 style) or content_md5 (base64)
+
+       Returns: description of the mismatch or None if data is as expected
+    """
+    if not expected:
+        return None
+    if expected.get('size') not in (None, '') and int(expected['size']) != digests['size']:
+        return f"size {digests['size']} instead of {expected['size']}"
+    # ETags of multipart uploads (with a '-') or non S3 sources are not MD5s
+    etag = (expected.get('etag') or '').replace('W/', '').strip('"')
+    if re.fullmatch('[0-9a-f]{32}', etag) and etag != digests['md5']:
+        return f"MD5 {digests['md5']} instead of ETag {etag}"
+    if expected.get('content_md5'):
+        content_md5 = base64.b64decode(expected['content_md5']).hex()
+        if content_md5 != digests['md5']:
+            return f"MD5 {digests['md5']} instead of Content-MD5 {content_md5}"
+    return None
+
+
+def write_chunks(chunks, filepath, expected=None):
+    """Writes data to a file, computing its digests on the fly
+
+       Args:
+           chunks: Iterable of the bytes of the data
+           filepath: Path of the new file
+           expected: Optional dict of size/etag/content_md5 of the data to verify against
+
+       Returns: dict of md5, sha256 and size of the data
+       Raises: IntegrityError if data is not as expected (file is removed)
+    """
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    size = 0
+    with stage('download') as record, open(filepath, 'wb') as fd:
+        for chunk in chunks:
+            fd.write(chunk)
+            md5.update(chunk)
+            sha256.update(chunk)
+            size += len(chunk)
+        record.add(size, 1)
+    digests = {'md5': md5.hexdigest(), 'sha256': sha256.hexdigest(), 'size': size}
+    problem = check_digests(digests, expected)
+    if problem is not None:
+        os.unlink(filepath)
+        raise IntegrityError(f"Corrupt download of {filepath}: {problem}")
+    return digests
+
+
+def iter_stream(resp, chunk_size=100*1024):
+    """Chunks of the data of a streaming HTTP response or S3 object body (botocore StreamingBody)"""
+    if hasattr(resp, 'iter_content'):
+        return resp.iter_content(chunk_size=chunk_size)
+    return resp.iter_chunks(chunk_size=chunk_size)
+
+
+def archive_data_to_file(resp, filepath_prefix, filename, streaming=True,
+                         expected=None, archive_path=None, source=None):
     """Saves data from a HTTP response into a file
 
        Args:
            resp: HTTP response object (or its data)
            prefix: Prefix of the file's path
            filename: Name to use for the new file
-           streaming: True if the HTTP response is a streaming one
+           streaming: True if the HTTP response (or S3 object body) is a streaming one
+           expected: dict of size/etag/content_md5 to verify the data against
+                     Default of None means use the headers of a streaming response
+           archive_path: Root of the archive whose manifest records the file
+           source: URL or S3 key of the data
 
        Returns: path of new file
+       Raises: IntegrityError if the data is not what the source says it is
     """
     os.makedirs(filepath_prefix, mode=0o755, exist_ok=True)
     filepath = os.path.join(filepath_prefix, filename)
     if not streaming:
-        with open(filepath, 'wb') as fd:
-            fd.write(resp)
+        digests = write_chunks([resp], filepath, expected)
     else:
-        with open(filepath, 'wb') as fd:
-            for chunk in resp.iter_content(chunk_size=100*1024):
-                fd.write(chunk)
+        if expected is None:
+            expected = get_expected_digests(resp)
+        digests = write_chunks(iter_stream(resp), filepath, expected)
+    if archive_path:
+        record_file(archive_path, filepath, source=source,
+                    etag=(expected or {}).get('etag'), digests=digests)
     return filepath
 
 
+def retry_corrupt(func, *args, retries=3, **kwargs):
+    """Calls a function that downloads data until the data is not corrupt"""
+    for attempt in range(1, retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except IntegrityError as err:
+            if attempt == retries:
+                raise
+            count_retry('download')
+            get_run_logger().warning(f"{err}, retrying ({attempt}/{retries - 1})")
+
+
+async def async_retry_corrupt(func, *args, retries=3, **kwargs):
+    """Awaits a coroutine function that downloads data until the data is not corrupt"""
+    for attempt in range(1, retries + 1):
+        try:
+            return await func(*args, **kwargs)
+        except IntegrityError as err:
+            if attempt == retries:
+                raise
+            count_retry('download')
+            get_run_logger().warning(f"{err}, retrying ({attempt}/{retries - 1})")
+
+
 def file_changed(fname, filepath, file_hash):
     """Determines if saved hash of a file equals the hash of the lastest version
 
@@ -158,7 +256,11 @@ def file_changed(fname, filepath, file_hash):
 
        Returns: hash(old_file) == hash(new_file)
     """
-    hash_value = hashlib.md5(pathlib.Path(filepath).read_bytes()).hexdigest()
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    hash_value = md5.hexdigest()
     if hash_value != file_hash.value["last_hash"]:
         file_hash.value["last_hash"] = hash_value
         file_hash.save(name=f"{fname}-hash".replace('_','-'), overwrite=True)
@@ -166,7 +268,9 @@ def file_changed(fname, filepath, file_hash):
     return False
 
 
-async def async_exec_rsync(cfg):
+@sync_compatible
+@timed('replicate')
+async def exec_rsync(cfg):
     """Executes the rsync command in the supplied cfg Block
 
        Templated variables in rsync command updated based on the date:
@@ -174,26 +278,8 @@ async def async_exec_rsync(cfg):
            yyear / ymon / yday:  Yesterday
 
        Note: Directory first changed to that specified by 'archive_path'
-    """
-    output = None
-    if cfg.settings.BACKUP_HOST not in (None, ""):
-        cyear, cmon, cday = get_current_ymd(yesterday=False)
-        yyear, ymon, yday = get_current_ymd(yesterday=True)
-        cmd = cfg.rsync.replace("$BACKUP_HOST", cfg.settings.BACKUP_HOST).replace("$BACKUP_ROOT", cfg.settings.BACKUP_ROOT)
-        cmd  = cmd.replace("$cyear", cyear).replace("$cmon", cmon).replace("$cday", cday)
-        cmd  = cmd.replace("$yyear", yyear).replace("$ymon", ymon).replace("$yday", yday)
-        output = await shell_run_command(command=cmd, helper_command=f"cd {cfg.archive_path}", return_all=True)
-    return output
-
 
-def exec_rsync(cfg):
-    """Executes the rsync command in the supplied cfg Block
-
-       Templated variables in rsync command updated based on the date:
-           cyear / cmon / cday:  Current date
-           yyear / ymon / yday:  Yesterday
-
-       Note: Directory first changed to that specified by 'archive_path'
+       Returns: output of rsync (None if backups are disabled)
     """
     output = None
     if cfg.settings.BACKUP_HOST not in (None, ""):
@@ -202,5 +288,5 @@ def exec_rsync(cfg):
         cmd = cfg.rsync.replace("$BACKUP_HOST", cfg.settings.BACKUP_HOST).replace("$BACKUP_ROOT", cfg.settings.BACKUP_ROOT)
         cmd  = cmd.replace("$cyear", cyear).replace("$cmon", cmon).replace("$cday", cday)
         cmd  = cmd.replace("$yyear", yyear).replace("$ymon", ymon).replace("$yday", yday)
-        output = shell_run_command(command=cmd, helper_command=f"cd {cfg.archive_path}", return_all=True)
+        output = (await run_command(cmd, cwd=cfg.archive_path)).output
     return output
@@ -0,0 +1,169 @@
+"""
+Functions to maintain the manifest of the files stored under an archive_path
+
+The manifest is a SQLite database, .manifest/{archive directory}.db next to the
+archive_path rather than in it, so the rsync of the archive never copies a database
+being written (one still in the root of the archive_path is moved there). It records
+the size and MD5/SHA-256 digests of every archived file, as well as the
+source and ETag it was fetched from, so that the integrity of the archive can be
+checked later without having to refetch anything. The results of the last scrub
+of each file, which keyframe each delta encoded file depends on, which files were
+recompacted to a stronger codec and which were packed into day containers are kept too.
+"""
+from datetime import datetime
+import hashlib
+import os
+import sqlite3
+
+
+MANIFEST_NAME = ".manifest.db"
+MANIFEST_DIR = ".manifest"
+
+schema = [
+    """CREATE TABLE IF NOT EXISTS files (
+           path TEXT PRIMARY KEY,
+           size INTEGER,
+           mtime REAL,
+           md5 TEXT,
+           sha256 TEXT,
+           source TEXT,
+           etag TEXT,
+           recorded TEXT)""",
+    """CREATE TABLE IF NOT EXISTS scrubs (
+           path TEXT PRIMARY KEY,
+           size INTEGER,
+           mtime REAL,
+           scrubbed TEXT,
+           ok INTEGER,
+           error TEXT)""",
+    """CREATE TABLE IF NOT EXISTS deltas (
+           path TEXT PRIMARY KEY,
+           flow TEXT,
+           day TEXT,
+           keyframe TEXT)""",
+    """CREATE TABLE IF NOT EXISTS recompactions (
+           path TEXT PRIMARY KEY,
+           codec TEXT,
+           recompacted TEXT)""",
+    """CREATE TABLE IF NOT EXISTS packed (
+           path TEXT PRIMARY KEY,
+           container TEXT,
+           offset INTEGER,
+           size INTEGER)""",
+]
+
+
+def get_manifest_path(archive_path):
+    """Path of the manifest of an archive_path (outside of it)"""
+    archive_path = os.path.abspath(archive_path)
+    return os.path.join(os.path.dirname(archive_path), MANIFEST_DIR, os.path.basename(archive_path) + ".db")
+
+
+def connect(archive_path):
+    """Opens (and creates if needed) the manifest of an archive_path"""
+    path = get_manifest_path(archive_path)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+        legacy = os.path.join(archive_path, MANIFEST_NAME)
+        if os.path.exists(legacy):
+            # a manifest from before it was moved out of the archive_path (with its journals)
+            for suffix in ("-wal", "-shm", "-journal", ""):
+                if os.path.exists(legacy + suffix):
+                    os.replace(legacy + suffix, path + suffix)
+    conn = sqlite3.connect(path, timeout=60)
+    conn.row_factory = sqlite3.Row
+    for statement in schema:
+        conn.execute(statement)
+    return conn
+
+
+def get_file_digests(filepath, chunk_size=1024*1024):
+    """Computes the MD5 and SHA-256 of a file without reading it all into memory"""
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(filepath, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(chunk_size), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+            size += len(chunk)
+    return {'md5': md5.hexdigest(), 'sha256': sha256.hexdigest(), 'size': size}
+
+
+def record_file(archive_path, filepath, source=None, etag=None, digests=None):
+    """Records the digests of an archived file in the manifest
+
+       Args:
+           archive_path: Root of the archive the file is in
+           filepath: Path of the file
+           source: URL or S3 key the file (or its original) was fetched from
+           etag: ETag of the source
+           digests: Digests of the file if already known, otherwise they are computed
+
+       Returns: the digests of the file
+    """
+    if digests is None:
+        digests = get_file_digests(filepath)
+    relpath = os.path.relpath(filepath, archive_path)
+    conn = connect(archive_path)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (relpath, digests['size'], os.path.getmtime(filepath), digests['md5'],
+                      digests['sha256'], source, etag, datetime.now().isoformat()))
+    conn.close()
+    return digests
+
+
+def replace_file(archive_path, oldpath, newpath):
+    """Records a file (e.g. recompressed) that replaces another in the archive
+
+       The source and ETag of the old file are carried over to the new one
+    """
+    if not archive_path:
+        return None
+    old = get_file_record(archive_path, oldpath)
+    if oldpath != newpath:
+        forget_file(archive_path, oldpath)
+    return record_file(archive_path, newpath, source=(old or {}).get('source'),
+                       etag=(old or {}).get('etag'))
+
+
+def get_file_record(archive_path, filepath):
+    """Gets the manifest entry of an archived file (None if it is not recorded)"""
+    conn = connect(archive_path)
+    row = conn.execute("SELECT * FROM files WHERE path = ?",
+                       (os.path.relpath(filepath, archive_path),)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def forget_file(archive_path, filepath):
+    """Removes an archived file from the manifest"""
+    conn = connect(archive_path)
+    with conn:
+        conn.execute("DELETE FROM files WHERE path = ?", (os.path.relpath(filepath, archive_path),))
+    conn.close()
+
+
+def get_records(archive_path, table="files"):
+    """Gets all entries of a table of the manifest as a dict keyed by relative path"""
+    conn = connect(archive_path)
+    rows = conn.execute(f"SELECT * FROM {table}").fetchall()
+    conn.close()
+    return {row['path']: dict(row) for row in rows}
+
+
+def record_scrubs(archive_path, results):
+    """Records the results of scrubbing files of the archive
+
+       Args:
+           archive_path: Root of the archive
+           results: List of dicts of path (relative), size, mtime, ok and error
+    """
+    now = datetime.now().isoformat()
+    conn = connect(archive_path)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO scrubs VALUES (?, ?, ?, ?, ?, ?)",
+                         [(r['path'], r['size'], r['mtime'], now, int(r['ok']), r['error'])
+                          for r in results])
+    conn.close()
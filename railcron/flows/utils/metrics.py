@@ -0,0 +1,190 @@
+"""
+Per-stage metrics of the flow runs
+
+The stages of a flow (list, download, recompress, replicate, process (of archived
+files into the stores), block_io, the Prefect block loads/saves, and cache, warming
+the decompressed cache with new files) record their durations, bytes, objects and
+retries here, through the stage() context manager or the @timed decorator. At the
+end of a run publish_metrics() logs a summary of them and, when the "metrics_dir"
+setting is set, writes them to a Prometheus textfile collector file
+({metrics_dir}/railcron_{flow}.prom, read by the node_exporter's
+--collector.textfile.directory) so throughput per source can be charted and alerted on.
+"""
+from contextlib import contextmanager
+import functools
+import inspect
+import os
+import threading
+import time
+
+from prefect import get_run_logger
+from prefect.context import FlowRunContext
+
+from .runner import log_command_summary
+
+
+stages = ['list', 'download', 'recompress', 'replicate', 'process', 'block_io', 'cache']
+
+_stats = {}
+_lock = threading.Lock()
+
+
+class StageRecord:
+    """What a call of a stage processed"""
+
+    def __init__(self):
+        self.bytes = 0
+        self.objects = 0
+
+    def add(self, nbytes=0, objects=0):
+        self.bytes += nbytes
+        self.objects += objects
+
+
+def get_stat(name):
+    """Totals of a stage (created if needed, call with _lock held)"""
+    if name not in _stats:
+        _stats[name] = {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'objects': 0, 'retries': 0}
+    return _stats[name]
+
+
+@contextmanager
+def stage(name):
+    """Measures a stage of a flow, yielding a StageRecord to add bytes/objects to"""
+    record = StageRecord()
+    started = time.monotonic()
+    try:
+        yield record
+    finally:
+        elapsed = time.monotonic() - started
+        with _lock:
+            stat = get_stat(name)
+            stat['calls'] += 1
+            stat['seconds'] += elapsed
+            stat['bytes'] += record.bytes
+            stat['objects'] += record.objects
+
+
+def count_retry(name):
+    """Records a retry of a stage"""
+    with _lock:
+        get_stat(name)['retries'] += 1
+
+
+def timed(name, size=None, objects=1):
+    """Decorator measuring every call of a (sync or async) function as a stage
+
+       Args:
+           name: Stage of the function
+           size: Optional function of the call's arguments giving the bytes processed
+                 (called before the function, e.g. for files it replaces)
+           objects: Objects counted per call
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name) as record:
+                    record.add(size(*args, **kwargs) if size else 0, objects)
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name) as record:
+                record.add(size(*args, **kwargs) if size else 0, objects)
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_metrics(clear=True):
+    """Totals of each stage recorded since the last call
+
+       Returns: dict of stage -> dict of calls, seconds, bytes, objects and retries
+    """
+    with _lock:
+        metrics = {name: dict(stat) for name, stat in _stats.items()}
+        if clear:
+            _stats.clear()
+    return metrics
+
+
+def format_textfile(flow_name, metrics, commands, run_seconds, failed):
+    """Prometheus text exposition of the metrics of a flow run"""
+    lines = []
+
+    def add(metric, help_text, values):
+        lines.append(f"# HELP railcron_{metric} {help_text}")
+        lines.append(f"# TYPE railcron_{metric} gauge")
+        for labels, value in values:
+            label_text = ",".join(f'{k}="{v}"' for k, v in [('flow', flow_name)] + labels)
+            lines.append(f"railcron_{metric}{{{label_text}}} {value}")
+
+    for key, help_text in [('seconds', "Seconds spent in each stage of the last run"),
+                           ('bytes', "Bytes processed by each stage of the last run"),
+                           ('objects', "Objects (files, listed keys, blocks) handled by each stage of the last run"),
+                           ('calls', "Calls of each stage in the last run"),
+                           ('retries', "Retries of each stage in the last run")]:
+        add(f"stage_{key}", help_text,
+            [([('stage', name)], round(stat[key], 3)) for name, stat in sorted(metrics.items())])
+    add("commands", "External commands run in the last run", [([], commands['commands'])])
+    add("commands_failed", "External commands that failed in the last run", [([], commands['failed'])])
+    add("command_seconds", "Seconds spent running external commands in the last run", [([], commands['seconds'])])
+    add("run_seconds", "Duration of the last run", [([], round(run_seconds, 3))])
+    add("run_success", "1 if the last run succeeded", [([], 0 if failed else 1)])
+    add("run_timestamp_seconds", "Time the last run ended", [([], round(time.time(), 3))])
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(metrics_dir, flow_name, text):
+    """Atomically replaces the textfile of a flow (the collector must never see a partial file)
+
+       Returns: path of the file
+    """
+    os.makedirs(metrics_dir, exist_ok=True)
+    filepath = os.path.join(metrics_dir, f"railcron_{flow_name}.prom")
+    with open(filepath + ".tmp", 'w', encoding='utf8') as fd:
+        fd.write(text)
+    os.replace(filepath + ".tmp", filepath)
+    return filepath
+
+
+def publish_metrics(flow_name, cfg=None, failed=False):
+    """Logs a summary of the stages of the current flow run and writes its textfile
+
+       Called at the end of every flow run (also logs the summary of the commands it ran)
+
+       Args:
+           flow_name: Name of the flow (label of the metrics)
+           cfg: Block of the flow, whose settings.metrics_dir is where to write the textfile
+           failed: True if the run failed
+
+       Returns: dict of the metrics of each stage
+    """
+    logger = get_run_logger()
+    metrics = get_metrics()
+    commands = log_command_summary()
+    run_seconds = 0.0
+    context = FlowRunContext.get()
+    if context is not None and context.flow_run.start_time is not None:
+        run_seconds = time.time() - context.flow_run.start_time.timestamp()
+    summary = []
+    for name in stages + sorted(set(metrics) - set(stages)):
+        if name in metrics:
+            stat = metrics[name]
+            rate = f", {stat['bytes'] / 1024**2 / stat['seconds']:.2f} MB/s" \
+                if stat['bytes'] and stat['seconds'] else ""
+            retries = f", {stat['retries']} retries" if stat['retries'] else ""
+            summary.append(f"{name} {stat['seconds']:.2f}s ({stat['objects']} objects, "
+                           f"{stat['bytes'] / 1024**2:.1f} MB{rate}{retries})")
+    if summary:
+        logger.info(f"Stages of {flow_name}: " + "; ".join(summary))
+    metrics_dir = getattr(getattr(cfg, 'settings', None), 'metrics_dir', None)
+    if metrics_dir:
+        try:
+            write_textfile(metrics_dir, flow_name,
+                           format_textfile(flow_name, metrics, commands, run_seconds, failed))
+        except OSError as exc:
+            logger.warning(f"Could not write metrics of {flow_name}: {exc}")
+    return metrics
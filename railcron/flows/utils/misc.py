@@ -5,9 +5,12 @@ from datetime import datetime, timedelta
 import os
 import yaml
 
-from prefect import flow, get_run_logger
-from prefect_email import EmailServerCredentials, email_send_message, SMTPType
-from prefect_shell import shell_run_command
+from prefect import get_run_logger
+from prefect.client import get_client
+from prefect.orion.schemas.filters import FlowFilter
+from prefect.utilities.asyncutils import sync_compatible
+
+from .alerts import flush_alerts, mail_enabled, queue_alert, send_email
 
 ### loc of cfg file
 def create_flows(flow_generator, filters):
@@ -20,15 +23,51 @@ def create_flows(flow_generator, filters):
        Returns: dict of new Prefect flow functions
                 globals() also updated with new functions
     """
+    prefect_flows = {}
+    for fname in get_flow_names(filters):
+        prefect_flows[fname] = flow_generator(fname)
+    return prefect_flows
+
+
+def defer_flows(flow_generator, filters, module_name):
+    """Module __getattr__ creating the flows of a module only when they are looked up
+
+       The config file is not read and no flow is made when the module is imported, only
+       the flow a deployment runs (found with getattr(module, name)) is made when used
+
+       Args:
+           flow_generator: Generator function that creates flows
+           filters: List of prefixes to search for in blocks/config file that define flows' parameters
+           module_name: Name of the module (for errors)
+
+       Returns: function to set as the module's __getattr__
+    """
+    made = {}
+
+    def get_flow(name):
+        if name not in made:
+            # other lookups (dunders, misspellings) must not read the config file
+            if not any(name.startswith(prefix) for prefix in filters) \
+                    or name not in get_flow_names(filters):
+                raise AttributeError(f"module {module_name!r} has no attribute {name!r}")
+            made[name] = flow_generator(name)
+        return made[name]
+    return get_flow
+
+
+def get_flow_names(filters):
+    """Names of the flows defined in the config file
+
+       Args:
+           filters: List of prefixes to search for in blocks/config file that define flows' parameters
+
+       Returns: list of flow names (the sections of the config file)
+    """
     # read list of known blocks (names) and/or config file
     config_file = os.getenv('RAILCRON_CFG', '.') + "/railcron.yml"
     with open(config_file, mode="rb") as file:
         config_data = yaml.safe_load(file)
-    prefect_flows = {}
-    flow_names = [x for prefix in filters for x in config_data.keys() if x.startswith(prefix)]
-    for fname in flow_names:
-        prefect_flows[fname] = flow_generator(fname)
-    return prefect_flows
+    return [x for prefix in filters for x in config_data.keys() if x.startswith(prefix)]
 
 
 def load_config(config_file, root):
@@ -70,39 +109,71 @@ def get_current_ymd(yesterday=False, strip_zeros=False):
     return [cyear, cmon, cday]
 
 
-@flow
+def get_date_range(start, end):
+    """Returns list of numerical parts of every date from start to end (inclusive)
+
+       Args:
+           start: [year, mon, day] of first date (ints or strings)
+           end: [year, mon, day] of last date
+
+       Returns: list of [year, mon, day] string lists, zero padded
+    """
+    the_date = datetime(int(start[0]), int(start[1]), int(start[2]))
+    last_date = datetime(int(end[0]), int(end[1]), int(end[2]))
+    if last_date < the_date:
+        raise Exception("End of date range is before its start")
+    dates = []
+    while the_date <= last_date:
+        dates.append([the_date.strftime('%Y'), the_date.strftime('%m'), the_date.strftime('%d')])
+        the_date = the_date + timedelta(days=1)
+    return dates
+
+
+def get_headers_signature(headers):
+    """Combines the HTTP headers identifying a version of a file into one string"""
+    keys = ['ETag', 'Last-Modified', 'Content-Length', 'Content-Disposition']
+    return '|'.join([headers.get(key, '') for key in keys])
+
+
+@sync_compatible
+async def queue_flow_run(fname, parameters=None):
+    """Schedules a run of the deployment of a flow so an agent executes it
+
+       Args:
+           fname: Name of the flow (as in the config file)
+           parameters: Dictionary of the flow's parameters
+
+       Returns: id of the new flow run
+    """
+    async with get_client() as client:
+        deployments = await client.read_deployments(flow_filter=FlowFilter(name={"any_": [fname]}))
+        if not deployments:
+            raise Exception(f"No deployment found for flow {fname}")
+        flow_run = await client.create_flow_run_from_deployment(deployments[0].id,
+                                                                parameters=parameters or {})
+    return flow_run.id
+
+
 def email_message(cfg, subject, msg):
-    """Flow to send an email through localhost or specified mail server"""
-    if cfg.settings.MAIL_FROM in (None, "") or cfg.settings.MAIL_TO in (None, ""):
+    """Emails an error of a flow, or spools it for the next digest (see utils/alerts.py)
+
+       Args:
+           cfg: Block of the flow (its settings have the mail and alert settings)
+           subject: Subject of the email, also the source of the error in digests
+           msg: HTML message (traceback)
+
+       Returns: output of the mail command, the subject or "" if nothing sent yet
+    """
+    if not mail_enabled(cfg.settings):
+        return ""
+    try:
+        if not cfg.settings.alert_window:
+            return send_email(cfg.settings, subject, msg)
+        count = queue_alert(cfg.settings, subject, msg)
+        get_run_logger().info(f"Error spooled for the next digest ({count} x)")
+        return "" if not flush_alerts(cfg.settings) else subject
+    except Exception as exc:
+        logger = get_run_logger()
+        logger.error("Failure to email message")
+        logger.error(exc)
         return ""
-    if cfg.settings.MAIL_SRV in (None, "", "sendmail"):
-        parts = [[cfg.settings.MAIL_CC, "-c ", ""],
-                 [cfg.settings.MAIL_BCC, "-b ", ""],
-                 [cfg.settings.MAIL_FROM, "-r ", ""]]
-        for mailcc in parts:
-            if mailcc[0]: mailcc[2] = mailcc[1] + mailcc[0]
-        cmd = f"echo \"{msg}\" | mail {parts[2][2]} -s \"{subject}\" {parts[0][2]} {parts[1][2]} \"{cfg.settings.MAIL_TO}\" "
-        output = shell_run_command(command=cmd, return_all=True)
-    else:
-        email_server_credentials = EmailServerCredentials(
-            username=cfg.settings.MAIL_LOGIN.strip(),
-            password=cfg.settings.MAIL_PWD.strip(),
-            smtp_server=cfg.settings.MAIL_SRV.strip(),
-            smtp_type=getattr(SMTPType, cfg.settings.MAIL_TYPE.strip()),
-            smtp_port=cfg.settings.MAIL_PORT,
-        )
-        try:
-            subject = email_send_message(
-                subject=subject,
-                msg=msg,
-                email_server_credentials=email_server_credentials,
-                email_to=cfg.settings.MAIL_TO.strip(),
-                email_to_cc=(cfg.settings.MAIL_CC.strip() if cfg.settings.MAIL_CC else None),
-                email_to_bcc=(cfg.settings.MAIL_BCC.strip() if cfg.settings.MAIL_BCC else None),
-            )
-        except Exception as exc:
-            logger = get_run_logger()
-            logger.error("Failure to email message")
-            logger.error(exc)
-        output = subject
-    return output
@@ -0,0 +1,206 @@
+"""
+Functions to pack the many small files of a completed day into one seekable container
+
+Flows like incidents (24 files a day) and the NRDP logs (hundreds of objects a day)
+create millions of small files over the years, which makes rsync and walking the
+archive slow. A day directory year/mon/day/ is packed into year/mon/day.pack.tar,
+an uncompressed tar whose first member (.index.json) maps every member name to its
+offset and size. The offsets are relative to the end of the index so a member can be
+read with one read of the header and index and one seek, and the container is still
+a plain tar file.
+
+The original paths are recorded in the packed table of the manifest, so they can still
+be resolved (see open_archived()).
+"""
+from datetime import date, timedelta
+from functools import lru_cache
+import io
+import json
+import os
+import tarfile
+from tempfile import mkstemp
+
+from .manifest import connect
+from .seekable import IDX_EXT
+
+
+PACK_EXT = ".pack.tar"
+INDEX_NAME = ".index.json"
+BLOCK = tarfile.BLOCKSIZE
+
+
+def padded(size):
+    """Size of data in a tar file including its padding to a whole block"""
+    return (size + BLOCK - 1) // BLOCK * BLOCK
+
+
+def get_pack_path(daypath):
+    """Path of the container of a day directory"""
+    return daypath.rstrip(os.sep) + PACK_EXT
+
+
+def get_day_files(daypath):
+    """Sorted list of (name relative to the day directory, full path) of the files of a day
+
+       Seekable files (see utils/seekable.py) and their indexes are not packed
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(daypath):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in filenames:
+            if filename.startswith('.') or filename.endswith(IDX_EXT) or filename + IDX_EXT in filenames:
+                continue
+            fullpath = os.path.join(dirpath, filename)
+            files.append((os.path.relpath(fullpath, daypath), fullpath))
+    return sorted(files)
+
+
+def pack_day(archive_path, daypath):
+    """Packs the files of a day directory into a container and removes them
+
+       Args:
+           archive_path: Root of the archive
+           daypath: Directory of the day (year/mon/day)
+
+       Returns: path of the container or None if there was nothing to pack
+    """
+    files = get_day_files(daypath)
+    if not files:
+        return None
+    packpath = get_pack_path(daypath)
+    if os.path.exists(packpath):
+        raise Exception(f"{packpath} already exists, not packing {daypath}")
+
+    # offsets relative to the end of the index member, each member has a one block (ustar) header
+    index = {}
+    offset = 0
+    infos = []
+    for name, fullpath in files:
+        info = tarfile.TarInfo(name)
+        stat = os.stat(fullpath)
+        info.size = stat.st_size
+        info.mtime = stat.st_mtime
+        info.mode = 0o644
+        infos.append((info, fullpath))
+        index[name] = [offset + BLOCK, info.size]
+        offset += BLOCK + padded(info.size)
+    index_data = json.dumps({'members': index}, separators=(',', ':')).encode('utf8')
+    base = BLOCK + padded(len(index_data))
+
+    fdesc, tmppath = mkstemp(dir=os.path.dirname(packpath), prefix=".pack")
+    os.close(fdesc)
+    try:
+        with tarfile.open(tmppath, 'w', format=tarfile.USTAR_FORMAT) as tar:
+            info = tarfile.TarInfo(INDEX_NAME)
+            info.size = len(index_data)
+            tar.addfile(info, io.BytesIO(index_data))
+            for info, fullpath in infos:
+                with open(fullpath, 'rb') as fd:
+                    tar.addfile(info, fd)
+        with tarfile.open(tmppath, 'r') as tar:
+            for member in tar.getmembers()[1:]:
+                if index[member.name][0] + base != member.offset_data:
+                    raise Exception(f"Offset of {member.name} in {packpath} does not match its index")
+        os.replace(tmppath, packpath)
+    except Exception:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+
+    day_rel = os.path.relpath(daypath, archive_path)
+    conn = connect(archive_path)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO packed VALUES (?, ?, ?, ?)",
+                         [(os.path.join(day_rel, name), os.path.relpath(packpath, archive_path),
+                           base + index[name][0], index[name][1]) for name in index])
+    conn.close()
+    for _, fullpath in files:
+        os.unlink(fullpath)
+    # remove the directories left empty
+    for dirpath, _, _ in sorted(os.walk(daypath), reverse=True):
+        if not os.listdir(dirpath):
+            os.rmdir(dirpath)
+    return packpath
+
+
+@lru_cache(maxsize=64)
+def _read_index(packpath, mtime):
+    with open(packpath, 'rb') as fd:
+        header = tarfile.TarInfo.frombuf(fd.read(BLOCK), tarfile.ENCODING, "surrogateescape")
+        if header.name != INDEX_NAME:
+            raise Exception(f"{packpath} has no index")
+        members = json.loads(fd.read(header.size))['members']
+    base = BLOCK + padded(header.size)
+    return {name: (base + rel, size) for name, (rel, size) in members.items()}
+
+
+def read_index(packpath):
+    """Reads the member index of a container
+
+       Returns: dict of member name -> (absolute offset, size)
+    """
+    return _read_index(packpath, os.path.getmtime(packpath))
+
+
+def read_member(packpath, name):
+    """Reads a member of a container (one seek once the index is cached)"""
+    offset, size = read_index(packpath)[name]
+    with open(packpath, 'rb') as fd:
+        fd.seek(offset)
+        return fd.read(size)
+
+
+def resolve(archive_path, relpath):
+    """Finds where the file archived at relpath is now
+
+       Returns: (path of the container, offset, size) or None if the file was not packed
+    """
+    conn = connect(archive_path)
+    row = conn.execute("SELECT container, offset, size FROM packed WHERE path = ?",
+                       (relpath,)).fetchone()
+    conn.close()
+    if row is None:
+        return None
+    return os.path.join(archive_path, row['container']), row['offset'], row['size']
+
+
+def open_archived(archive_path, filepath):
+    """Opens an archived file for reading, whether it is still a file or has been packed
+
+       Args:
+           archive_path: Root of the archive
+           filepath: Original path of the file (absolute or relative to archive_path)
+
+       Returns: binary file object
+    """
+    fullpath = os.path.join(archive_path, filepath)
+    if os.path.exists(fullpath):
+        return open(fullpath, 'rb')
+    location = resolve(archive_path, os.path.relpath(fullpath, archive_path))
+    if location is None:
+        raise FileNotFoundError(fullpath)
+    packpath, offset, size = location
+    with open(packpath, 'rb') as fd:
+        fd.seek(offset)
+        return io.BytesIO(fd.read(size))
+
+
+def get_packable_days(archive_path, min_age_days=2):
+    """Sorted list of the day directories (year/mon/day) older than min_age_days not yet packed"""
+    cutoff = date.today() - timedelta(days=min_age_days)
+    days = []
+    if not os.path.isdir(archive_path):
+        return days
+    for year in os.scandir(archive_path):
+        if not (year.is_dir() and year.name.isdigit()):
+            continue
+        for mon in os.scandir(year.path):
+            if not (mon.is_dir() and mon.name.isdigit()):
+                continue
+            for day in os.scandir(mon.path):
+                if not (day.is_dir() and day.name.isdigit()):
+                    continue
+                if date(int(year.name), int(mon.name), int(day.name)) < cutoff \
+                        and not os.path.exists(get_pack_path(day.path)):
+                    days.append(day.path)
+    return sorted(days)
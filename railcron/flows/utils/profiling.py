@@ -0,0 +1,165 @@
+"""
+Opt-in profiling of flow runs
+
+A flow run is profiled when the RAILCRON_PROFILE environment variable is "1" or "all",
+or a comma separated list of flow names including it, or when the "profile" attribute of
+its block is set. The CPU time of the run's thread is profiled with cProfile and its
+memory allocations traced with tracemalloc, a snapshot being taken close to the peak of
+the traced memory.
+
+Each capture is written next to the flow run logs (the directory of the file handler of
+the "prefect.flow_runs" logger, else RAILCRON_PROFILE_DIR or the temp directory), under
+profiles/, as:
+    {flow}-{time}.prof      cProfile stats (python -m pstats, snakeviz...)
+    {flow}-{time}.snapshot  tracemalloc snapshot (tracemalloc.Snapshot.load())
+    {flow}-{time}.txt       top functions by own and cumulative time, top allocations
+and the top functions are logged.
+
+Work done in other threads (run_in_executor, thread pools) or commands is not in the
+CPU profile, only the time the flow waited for it.
+
+cProfile and pstats are only imported when a run is profiled.
+"""
+from datetime import datetime
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from prefect import get_run_logger
+
+
+# functions listed in the summaries
+TOP_FUNCTIONS = 25
+# seconds between checks of the traced memory for a new peak
+PEAK_INTERVAL = 0.5
+
+
+def profile_enabled(flow_name, cfg=None):
+    """Whether a run of a flow is to be profiled (RAILCRON_PROFILE or the block's profile)"""
+    wanted = os.getenv('RAILCRON_PROFILE', '').strip()
+    if wanted.lower() in ('1', 'all', 'true', 'yes'):
+        return True
+    if flow_name in [x.strip() for x in wanted.split(',')]:
+        return True
+    return bool(getattr(cfg, 'profile', False))
+
+
+def get_profile_dir():
+    """Directory where the captures are written (next to the flow run logs)"""
+    for handler in logging.getLogger("prefect.flow_runs").handlers:
+        if isinstance(handler, logging.FileHandler):
+            return os.path.join(os.path.dirname(handler.baseFilename), "profiles")
+    return os.path.join(os.getenv('RAILCRON_PROFILE_DIR', tempfile.gettempdir()), "profiles")
+
+
+class FlowProfiler:
+    """CPU profile and memory allocation snapshot of a flow run"""
+
+    def __init__(self, flow_name, outdir=None):
+        import cProfile
+
+        self.flow_name = flow_name
+        self.outdir = outdir or get_profile_dir()
+        # CPU time of the thread, so waiting (epoll, locks) is not counted as hot
+        self.profile = cProfile.Profile(time.thread_time)
+        self.snapshot = None
+        self.snapshot_size = 0
+        self.stopping = threading.Event()
+        self.watcher = threading.Thread(target=self.watch_peak, daemon=True)
+        self.started_tracing = False
+
+    def watch_peak(self):
+        """Takes a snapshot of the allocations whenever the traced memory reaches a new peak"""
+        while not self.stopping.wait(PEAK_INTERVAL):
+            self.check_peak()
+
+    def check_peak(self, force=False):
+        current, peak = tracemalloc.get_traced_memory()
+        # 10% above the last snapshot and close to the peak so far
+        if force or (current > self.snapshot_size * 1.1 and current >= peak * 0.9):
+            self.snapshot = tracemalloc.take_snapshot()
+            self.snapshot_size = current
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        tracemalloc.reset_peak()
+        self.watcher.start()
+        self.profile.enable()
+        return self
+
+    def stop(self):
+        """Stops profiling and writes the captures
+
+           Returns: path of the summary
+        """
+        import pstats
+
+        self.profile.disable()
+        self.stopping.set()
+        self.watcher.join()
+        # short runs may have ended before any check
+        self.check_peak(force=self.snapshot is None)
+        _, peak = tracemalloc.get_traced_memory()
+        if self.started_tracing:
+            tracemalloc.stop()
+
+        os.makedirs(self.outdir, exist_ok=True)
+        prefix = os.path.join(self.outdir, f"{self.flow_name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+        self.profile.dump_stats(prefix + ".prof")
+        lines = [f"Profile of {self.flow_name}, traced memory peak {peak / 1024**2:.1f} MB", ""]
+        for sort_key, title in [('tottime', "own"), ('cumulative', "cumulative")]:
+            out = io.StringIO()
+            pstats.Stats(self.profile, stream=out).sort_stats(sort_key).print_stats(TOP_FUNCTIONS)
+            lines += [f"Top functions by {title} time", out.getvalue()]
+        if self.snapshot is not None:
+            self.snapshot.dump(prefix + ".snapshot")
+            lines.append(f"Top allocations at {self.snapshot_size / 1024**2:.1f} MB traced")
+            for stat in self.snapshot.statistics('lineno')[:TOP_FUNCTIONS]:
+                lines.append(f"    {stat}")
+        with open(prefix + ".txt", 'w', encoding='utf8') as fd:
+            fd.write("\n".join(lines) + "\n")
+        return prefix + ".txt"
+
+    def get_hot_functions(self, count=10):
+        """Functions with the most own time as (seconds, calls, name)"""
+        import pstats
+
+        stats = pstats.Stats(self.profile).stats
+        hot = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:count]
+        return [(round(tottime, 3), calls, f"{os.path.basename(func[0])}:{func[1]}({func[2]})")
+                for func, (_, calls, tottime, _, _) in hot]
+
+
+def start_profile(flow_name, cfg=None):
+    """Starts profiling the current flow run if enabled for it
+
+       Args:
+           flow_name: Name of the flow
+           cfg: Block of the flow (its profile attribute enables profiling)
+
+       Returns: FlowProfiler to pass to stop_profile() or None
+    """
+    if not profile_enabled(flow_name, cfg):
+        return None
+    return FlowProfiler(flow_name).start()
+
+
+def stop_profile(profiler):
+    """Writes the captures of a profiled flow run and logs its hot functions"""
+    if profiler is None:
+        return None
+    logger = get_run_logger()
+    try:
+        summary = profiler.stop()
+    except OSError as exc:
+        logger.warning(f"Could not write profile of {profiler.flow_name}: {exc}")
+        return None
+    hot = "; ".join(f"{name} {seconds}s/{calls}" for seconds, calls, name in profiler.get_hot_functions())
+    logger.info(f"Profile of {profiler.flow_name} in {summary}, hot functions: {hot}")
+    return summary
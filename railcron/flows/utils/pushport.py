@@ -0,0 +1,326 @@
+"""
+Ingestion of the DARWIN Push Port logs (nrdp_logs) into partitioned column stores
+
+Each log (e.g. 202207210815001_PP.txt.gz, one Push Port message per line) is streamed
+through an incremental XML parser (ElementTree.XMLPullParser, the messages wrapped in
+one synthetic root), so no DOM of the log is built: every element is dropped once its
+message is handled. Of the updates:
+    forecasts:      the arr/dep/pass forecasts and actuals of each Location of a TS
+    schedules:      each calling point (OR, IP, PP, DT, OPOR...) of a schedule
+    deactivations:  the deactivated RIDs
+are extracted into typed columns (times as seconds after midnight, -1 if not given;
+"ts" as milliseconds since the epoch; "ssd" as days since 1970-01-01) along with the
+byte "offset" of the message in the decompressed log, so the original message can be
+read back from the archived file named in the meta.json "source" of the table.
+
+Tables (see utils/columnar.py) are partitioned by the date and hour of the messages:
+    {store}/YYYY/MM/DD/HH/{table}/{name of the log}
+one per log, so that the logs of a day are ingested in parallel by a pool of
+processes (ingest_day()). The logs ingested are listed in {store}/.ingested/YYYY-MM-DD.json
+and skipped by later runs. read_partition() concatenates the parts of an hour or day.
+"""
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from functools import lru_cache
+import json
+import os
+import re
+from xml.etree import ElementTree
+
+import numpy as np
+
+from .columnar import Table, TableWriter
+from .reader import get_day_sources, open_source
+
+
+INGESTED_DIR = ".ingested"
+# rows of a partition kept in memory before they are written
+BATCH_ROWS = 100000
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+tables = {
+    'forecasts': {
+        'ts': 'i8', 'rid': 'S16', 'uid': 'S6', 'ssd': 'i4', 'tpl': 'S7', 'event': 'S1',
+        'wtime': 'i4', 'ptime': 'i4', 'et': 'i4', 'at': 'i4', 'src': 'S8', 'platform': 'S3', 'offset': 'i8',
+    },
+    'schedules': {
+        'ts': 'i8', 'rid': 'S16', 'uid': 'S6', 'train_id': 'S4', 'ssd': 'i4', 'toc': 'S2', 'seq': 'i2',
+        'kind': 'S4', 'tpl': 'S7', 'act': 'S12', 'wta': 'i4', 'wtd': 'i4', 'wtp': 'i4', 'pta': 'i4',
+        'ptd': 'i4', 'cancelled': 'u1', 'offset': 'i8',
+    },
+    'deactivations': {'ts': 'i8', 'rid': 'S16', 'offset': 'i8'},
+}
+# forecast child element -> event, working and public time attributes of its Location
+forecast_events = {'arr': ('A', 'wta', 'pta'), 'dep': ('D', 'wtd', 'ptd'), 'pass': ('P', 'wtp', None)}
+
+
+@lru_cache(maxsize=None)
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+@lru_cache(maxsize=None)
+def to_seconds(value):
+    """HH:MM or HH:MM:SS as seconds after midnight (-1 for None)"""
+    if not value:
+        return -1
+    parts = value.split(':')
+    return int(parts[0]) * 3600 + int(parts[1]) * 60 + (int(parts[2]) if len(parts) > 2 else 0)
+
+
+@lru_cache(maxsize=1024)
+def to_day(value):
+    """YYYY-MM-DD as days since 1970-01-01 (-1 for None)"""
+    if not value:
+        return -1
+    return date.fromisoformat(value).toordinal() - EPOCH_ORDINAL
+
+
+def to_millis(value):
+    """Push Port timestamp (2022-07-21T08:15:01.8741405+01:00) as milliseconds since the epoch"""
+    value = re.sub(r"(\.\d{6})\d+", r"\1", value)
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+def get_source_name(source):
+    """Name of the parts of a log (its file name without extensions)"""
+    filepath = source[1] if isinstance(source, tuple) else source
+    return os.path.basename(filepath).split('.')[0]
+
+
+def get_source_key(source):
+    """How a log is recorded in the list of ingested logs (path or container#member)"""
+    return f"{source[0]}#{source[1]}" if isinstance(source, tuple) else source
+
+
+class PartitionWriter:
+    """Rows of a log buffered and written to the tables of their partitions"""
+
+    def __init__(self, store_path, name, source):
+        self.store_path = store_path
+        self.name = name
+        self.source = source
+        self.buffers = defaultdict(list)
+        self.writers = {}
+        self.rows = defaultdict(int)
+
+    def add(self, partition, table, row):
+        buffer = self.buffers[(partition, table)]
+        buffer.append(row)
+        if len(buffer) >= BATCH_ROWS:
+            self.flush(partition, table)
+
+    def flush(self, partition, table):
+        rows = self.buffers.pop((partition, table), None)
+        if not rows:
+            return
+        writer = self.writers.get((partition, table))
+        if writer is None:
+            path = os.path.join(self.store_path, *partition, table, self.name)
+            writer = self.writers[(partition, table)] = TableWriter(path, tables[table])
+            writer.meta['source'] = self.source
+        columns = tables[table]
+        writer.append(**{name: np.array(values, dtype=columns[name])
+                         for name, values in zip(columns, zip(*rows))})
+        self.rows[table] += len(rows)
+
+    def close(self):
+        for partition, table in list(self.buffers.keys()):
+            self.flush(partition, table)
+        for writer in self.writers.values():
+            writer.close()
+        return len(self.writers)
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.abort()
+
+
+def add_forecasts(out, partition, ts, offset, elem):
+    """Rows of the forecasts of the Locations of a TS"""
+    rid, uid, ssd = elem.get('rid'), elem.get('uid'), to_day(elem.get('ssd'))
+    for location in elem:
+        if local_name(location.tag) != 'Location':
+            continue
+        platform = ""
+        times = []
+        for child in location:
+            tag = local_name(child.tag)
+            if tag == 'plat':
+                platform = (child.text or "").strip()
+            elif tag in forecast_events:
+                times.append((tag, child))
+        for tag, child in times:
+            event, working, public = forecast_events[tag]
+            out.add(partition, 'forecasts', (
+                ts, rid, uid, ssd, location.get('tpl'), event, to_seconds(location.get(working)),
+                to_seconds(location.get(public)) if public else -1, to_seconds(child.get('et')),
+                to_seconds(child.get('at')), child.get('src') or "", platform, offset))
+
+
+def add_schedule(out, partition, ts, offset, elem):
+    """Rows of the calling points of a schedule"""
+    rid, uid, ssd = elem.get('rid'), elem.get('uid'), to_day(elem.get('ssd'))
+    train_id, toc = elem.get('trainId') or "", elem.get('toc') or ""
+    seq = 0
+    for point in elem:
+        kind = local_name(point.tag)
+        if 'tpl' not in point.attrib:
+            # e.g. cancelReason
+            continue
+        out.add(partition, 'schedules', (
+            ts, rid, uid, train_id, ssd, toc, seq, kind, point.get('tpl'), point.get('act') or "",
+            to_seconds(point.get('wta')), to_seconds(point.get('wtd')), to_seconds(point.get('wtp')),
+            to_seconds(point.get('pta')), to_seconds(point.get('ptd')),
+            1 if point.get('can') == 'true' else 0, offset))
+        seq += 1
+
+
+def add_message(out, elem, offset):
+    """Rows of the updates (uR) and snapshots (sR) of a Pport message"""
+    stamp = elem.get('ts')
+    if not stamp:
+        return
+    partition = (stamp[:4], stamp[5:7], stamp[8:10], stamp[11:13])
+    ts = to_millis(stamp)
+    for update in elem:
+        for child in update:
+            tag = local_name(child.tag)
+            if tag == 'TS':
+                add_forecasts(out, partition, ts, offset, child)
+            elif tag == 'schedule':
+                add_schedule(out, partition, ts, offset, child)
+            elif tag == 'deactivated':
+                out.add(partition, 'deactivations', (ts, child.get('rid'), offset))
+
+
+def ingest_log(source, store_path):
+    """Parses a Push Port log into the tables of the partitions of its messages
+
+       Runs in the worker processes of ingest_day(). A log cut short (e.g. by a failed
+       upload) keeps the rows of the messages before the error.
+
+       Args:
+           source: Path of the log, or (container, member) of a packed one
+           store_path: Directory of the store
+
+       Returns: dict of source, bytes parsed, messages, rows of each table, parts written and error
+    """
+    out = PartitionWriter(store_path, get_source_name(source), get_source_key(source))
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    parser.feed(b"<log>")
+    root = None
+    messages, offset, msg_offset, error = 0, 0, 0, None
+    try:
+        with open_source(source) as fd:
+            for line in fd:
+                line_offset = offset
+                offset += len(line)
+                if line.startswith(b"<?xml"):
+                    line = line[line.find(b"?>") + 2:]
+                try:
+                    parser.feed(line)
+                    events = list(parser.read_events())
+                except ElementTree.ParseError as err:
+                    error = f"{err} at offset {line_offset}"
+                    break
+                # only the messages are looked at, their elements are read when complete
+                for event, elem in events:
+                    if not elem.tag.endswith('Pport'):
+                        if root is None:
+                            root = elem
+                    elif event == 'start':
+                        msg_offset = line_offset
+                    else:
+                        add_message(out, elem, msg_offset)
+                        messages += 1
+                        root.clear()
+        parts = out.close()
+    except BaseException:
+        out.abort()
+        raise
+    return {'source': get_source_key(source), 'bytes': offset, 'messages': messages, 'rows': dict(out.rows),
+            'parts': parts, 'error': error}
+
+
+def get_ingested_path(store_path, year, mon, day):
+    return os.path.join(store_path, INGESTED_DIR, f"{year}-{mon}-{day}.json")
+
+
+def read_ingested(store_path, year, mon, day):
+    """Logs of a day already ingested: dict of source -> size and rows"""
+    try:
+        with open(get_ingested_path(store_path, year, mon, day), encoding='utf8') as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return {}
+
+
+def write_ingested(store_path, year, mon, day, ingested):
+    filepath = get_ingested_path(store_path, year, mon, day)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath + ".tmp", 'w', encoding='utf8') as fd:
+        json.dump(ingested, fd, indent=1)
+    os.replace(filepath + ".tmp", filepath)
+
+
+def get_source_size(source):
+    return os.path.getsize(source[0] if isinstance(source, tuple) else source)
+
+
+def ingest_day(fname, cfg, store_path, year, mon, day, workers=None, force=False):
+    """Ingests the logs of a day not ingested yet, in a pool of processes
+
+       Args:
+           fname: Name of the flow (nrdp_logs)
+           cfg: Block of the flow
+           store_path: Directory of the store
+           year / mon / day: Zero padded strings of the date the logs were archived under
+           workers: Number of processes (default is number of CPUs)
+           force: Ingest all the logs of the day again
+
+       Returns: list of the results of ingest_log() of the logs ingested
+    """
+    ingested = {} if force else read_ingested(store_path, year, mon, day)
+    todo = [x for x in get_day_sources(fname, cfg, year, mon, day)
+            if ingested.get(get_source_key(x), {}).get('size') != get_source_size(x)]
+    if not todo:
+        return []
+    results = []
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        try:
+            for source, result in zip(todo, pool.map(ingest_log, todo, [store_path] * len(todo))):
+                ingested[result['source']] = {'size': get_source_size(source), 'rows': result['rows'],
+                                              'error': result['error']}
+                results.append(result)
+        finally:
+            write_ingested(store_path, year, mon, day, ingested)
+    return results
+
+
+def read_partition(store_path, table, year, mon, day, hour=None, columns=None):
+    """Rows of a table for a day or hour, all the parts concatenated
+
+       Args:
+           store_path: Directory of the store
+           table: forecasts, schedules or deactivations
+           year / mon / day / hour: Zero padded strings (all the hours of the day if no hour)
+           columns: Columns to read (default all)
+
+       Returns: dict of column -> array, plus "part" (index of the part of each row) and
+                "sources" (archived file of each part)
+    """
+    hours = [hour] if hour is not None else [f"{x:02d}" for x in range(24)]
+    parts = []
+    for the_hour in hours:
+        dirpath = os.path.join(store_path, year, mon, day, the_hour, table)
+        if os.path.isdir(dirpath):
+            parts.extend(Table(os.path.join(dirpath, x)) for x in sorted(os.listdir(dirpath))
+                         if not x.startswith('.'))
+    columns = columns or list(tables[table].keys())
+    result = {name: np.concatenate([np.asarray(x[name]) for x in parts] or [np.empty(0, tables[table][name])])
+              for name in columns}
+    result['part'] = np.repeat(np.arange(len(parts), dtype=np.int32), [x.rows for x in parts])
+    result['sources'] = [x.meta['source'] for x in parts]
+    return result
@@ -0,0 +1,243 @@
+"""
+Functions to read the archived data of a flow
+
+iter_archive() streams the decompressed data of a flow for a range of dates, finding
+the files through the flow's archive layout (including days packed into containers),
+detecting their codecs and decompressing them natively while the next files are
+prefetched on a pool of threads.
+
+open_range() returns the data of a flow for a time range of a day. Files that were
+written seekable (see utils/seekable.py) only have the frames covering the range
+decompressed, others (and the members of packed days) are decompressed whole.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+from queue import Full, Queue
+import tarfile
+from threading import Event
+
+from .blocks import block_types, load_block
+from .cache import open_cached
+from .codec import detect_codec, open_decompressed, open_file
+from .coverage import get_archive_kind
+from .delta import DELTA_EXT, reconstruct
+from .misc import get_date_range
+from .pack import get_pack_path, read_index, read_member
+from .seekable import FrameReader, IDX_EXT, read_frame_index, select_frames
+
+
+# extensions of the archived files that are tars
+TAR_EXTS = ('.tar', '.tbz2', '.tgz')
+
+
+def get_day_dir(kind, cfg, year, mon, day):
+    """Directory of the files of a day of the flows that have one per day (nrdp_, incidents)"""
+    if kind == 'nrdfs3':
+        return cfg.get_filepath_prefix(year, mon, day)
+    return os.path.join(cfg.archive_path, year, mon, day)
+
+
+def get_day_files(fname, cfg, year, mon, day):
+    """Sorted list of the archived files of a flow for a day
+
+       Args:
+           fname: Name of the flow
+           cfg: Block of the flow
+           year / mon / day: Zero padded strings of the date
+
+       Returns: list of full paths
+    """
+    kind = get_archive_kind(fname)
+    if kind is None:
+        raise Exception(f"Files of {fname} are not organized by date")
+    dirpath = get_day_dir(kind, cfg, year, mon, day) if kind in ('nrdfs3', 'incidents') \
+        else os.path.join(cfg.archive_path, year, mon)
+    if not os.path.isdir(dirpath):
+        return []
+    files = []
+    for entry in os.scandir(dirpath):
+        name = entry.name
+        if not entry.is_file() or name.startswith('.') or name.endswith(IDX_EXT):
+            continue
+        firstpart = name.split('.')[0]
+        if kind == 'nrdatafeeds' and firstpart != day:
+            continue
+        if kind == 'a51' and firstpart != day and not firstpart.startswith(f"{year}{mon}{day}"):
+            continue
+        files.append(entry.path)
+    return sorted(files)
+
+
+def open_range(flow, date, start_time="00:00:00", end_time="23:59:59"):
+    """Opens the data of a flow between two times of a day
+
+       Only whole frames are read, so the stream can start a little before start_time and
+       end a little after end_time; consumers filter the records they get. Times are
+       compared to the timestamps found in the data (epoch times are taken as UTC).
+
+       Args:
+           flow: Name of the flow (section of the config file)
+           date: Day as "YYYY-MM-DD"
+           start_time / end_time: Times of the day as "HH:MM" or "HH:MM:SS"
+
+       Returns: binary file object of the decompressed data
+    """
+    year, mon, day = date.split('-')
+    cfg = load_block(block_types[flow.split('_')[0]], flow)
+    start = f"{date}T{start_time}"
+    end = f"{date}T{end_time}" + (":59" if len(end_time) == 5 else "")
+    segments = []
+    for source in get_day_sources(flow, cfg, year, mon, day):
+        # seekable files are never packed
+        index = read_frame_index(source) if not isinstance(source, tuple) else None
+        frames = None if index is None else select_frames(index['frames'], start, end, index.get('last'))
+        segments.append((source, frames))
+    return io.BufferedReader(FrameReader(segments, lambda source: open_source(source, flow, cfg)))
+
+
+def get_day_sources(fname, cfg, year, mon, day):
+    """Archived files of a flow for a day, including the members of a packed day
+
+       Returns: list of full paths and (container path, member name) tuples
+    """
+    sources = get_day_files(fname, cfg, year, mon, day)
+    kind = get_archive_kind(fname)
+    if kind in ('nrdfs3', 'incidents'):
+        packpath = get_pack_path(get_day_dir(kind, cfg, year, mon, day))
+        if os.path.exists(packpath):
+            sources.extend([(packpath, name) for name in sorted(read_index(packpath))])
+    return sources
+
+
+def open_source(source, fname=None, cfg=None):
+    """Opens a file or packed member for reading its decompressed contents
+
+       fname and cfg of the flow are needed to rebuild delta encoded files
+    """
+    if isinstance(source, tuple):
+        fd = io.BytesIO(read_member(*source))
+        decomp = open_decompressed(fd, detect_codec(fd))
+        return decomp if decomp is not None else fd
+    if source.endswith(DELTA_EXT):
+        # .../year/mon/day.filetype.zdelta
+        year, mon = source.split(os.sep)[-3:-1]
+        rebuilt = reconstruct(cfg, fname, year, mon, os.path.basename(source).split('.')[0])
+        fd = open(rebuilt, 'rb')
+        os.unlink(rebuilt)
+        return fd
+    return open_file(source)
+
+
+def iter_members(filepath, fname, cfg=None):
+    """Decompressed files of an archived file: the members of a tar (A51 DD.tbz2) or the file itself
+
+       Args:
+           filepath: Path of the archived file
+           fname: Name of the flow, needed for delta encoded files
+           cfg: Block of the flow, to read the decompressed copy in the cache if enabled
+
+       Returns: generator of binary file objects, each valid until the next is yielded
+    """
+    if cfg is not None and cfg.settings.cache_dir:
+        # a memory map of the cache entry (re-filled if evicted in between)
+        source = open_cached(cfg, filepath, fname)
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+    else:
+        source = open_source(filepath, fname, cfg)
+    with source as fd:
+        if not any(x in os.path.basename(filepath) for x in TAR_EXTS):
+            yield fd
+            return
+        # a stream: members are read in order without seeking
+        with tarfile.open(fileobj=fd, mode='r|') as tar:
+            for member in tar:
+                if member.isfile():
+                    yield tar.extractfile(member)
+
+
+def _put(out, item, stop):
+    """Puts an item on a queue unless the consumer has stopped"""
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _produce(source, out, chunk_size, stop, fname, cfg):
+    """Decompresses a source into a bounded queue (None marks the end, exceptions are passed on)"""
+    try:
+        with open_source(source, fname, cfg) as fd:
+            for chunk in iter(lambda: fd.read(chunk_size), b''):
+                if not _put(out, chunk, stop):
+                    return
+    except Exception as exc:
+        _put(out, exc, stop)
+    _put(out, None, stop)
+
+
+def iter_archive(flow_name, date_range, lines=False, chunk_size=1024*1024, prefetch=2, queue_chunks=8):
+    """Streams the decompressed data of a flow for a range of dates
+
+       Args:
+           flow_name: Name of the flow (section of the config file)
+           date_range: (first, last) days as "YYYY-MM-DD" (inclusive)
+           lines: Yield lines (bytes, with their line ending) instead of chunks
+           chunk_size: Size of the chunks read from the decompressors
+           prefetch: Number of files decompressed ahead on the thread pool
+           queue_chunks: Number of chunks buffered per prefetched file
+
+       Returns: generator of (source, data), source being the path of the file or
+                (container path, member name) of a packed file
+    """
+    cfg = load_block(block_types[flow_name.split('_')[0]], flow_name)
+    first, last = date_range
+    sources = []
+    for year, mon, day in get_date_range(first.split('-'), last.split('-')):
+        for source in get_day_sources(flow_name, cfg, year, mon, day):
+            # monthly files are found for every day of their month
+            if source not in sources:
+                sources.append(source)
+
+    stop = Event()
+    pending = iter(sources)
+    queues = deque()
+    with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as pool:
+
+        def start_next():
+            source = next(pending, None)
+            if source is not None:
+                out = Queue(maxsize=queue_chunks)
+                pool.submit(_produce, source, out, chunk_size, stop, flow_name, cfg)
+                queues.append((source, out))
+
+        for _ in range(max(prefetch, 1)):
+            start_next()
+        try:
+            while queues:
+                source, out = queues.popleft()
+                rest = b''
+                while True:
+                    item = out.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    if not lines:
+                        yield source, item
+                        continue
+                    parts = (rest + item).split(b'\n')
+                    rest = parts.pop()
+                    for line in parts:
+                        yield source, line + b'\n'
+                if rest:
+                    yield source, rest
+                start_next()
+        finally:
+            # let the producers still running give up
+            stop.set()
@@ -0,0 +1,226 @@
+"""
+Functions to recompress (recompact) cold months of an archive with stronger codecs
+
+Fresh files are compressed quickly so nightly runs finish in time. Once a month is old
+enough, its files are recompressed with the strongest codec whose decompression speed
+(measured on a sample of the month) still meets a target. Each file is streamed from
+its old decompressor into the new compressor, verified by comparing the checksums of
+the uncompressed data, and then atomically swapped into place.
+
+Files hardlinked into the content-addressed store (dedup), delta files and seekable
+files (which have a frame index) are left alone.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import hashlib
+import os
+import shutil
+import subprocess
+from tempfile import mkstemp
+import time
+
+from .manifest import connect, replace_file
+from .seekable import decompressors, get_idx_path
+
+
+# strongest first: name, compress cmd, decompress cmd, extension
+tiers = [
+    ('xz', 'xz -9e -T1 -c', 'xz -d -c', '.xz'),
+    ('zstd', 'zstd --ultra -22 --long=31 -q -c', 'zstd -d -q -c --long=31', '.zst'),
+]
+
+# run compression at the lowest CPU and IO priorities
+idle_prefix = "nice -n 19" + (" ionice -c 3" if shutil.which("ionice") else "")
+
+
+def get_cold_months(archive_path, min_age_days):
+    """Sorted list of [year, mon] of the month directories entirely older than min_age_days"""
+    cutoff = datetime.now() - timedelta(days=min_age_days)
+    months = []
+    if not os.path.isdir(archive_path):
+        return months
+    for year in os.scandir(archive_path):
+        if not (year.is_dir() and year.name.isdigit() and len(year.name) == 4):
+            continue
+        for mon in os.scandir(year.path):
+            if not (mon.is_dir() and mon.name.isdigit()):
+                continue
+            # first day of the following month
+            month_end = datetime(int(year.name) + int(mon.name) // 12, int(mon.name) % 12 + 1, 1)
+            if month_end <= cutoff:
+                months.append([year.name, mon.name])
+    return sorted(months)
+
+
+def get_month_files(archive_path, year, mon, done):
+    """Compressed files of a month (including day subdirectories) not yet recompacted"""
+    files = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(archive_path, year, mon)):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in sorted(filenames):
+            fullpath = os.path.join(dirpath, filename)
+            if (filename.startswith('.') or os.path.splitext(filename)[1] not in decompressors
+                    or os.path.relpath(fullpath, archive_path) in done
+                    or os.stat(fullpath).st_nlink > 1
+                    or os.path.exists(get_idx_path(fullpath))):
+                continue
+            files.append(fullpath)
+    return files
+
+
+def get_new_path(filepath, ext):
+    """Path of a file once recompressed to a codec with extension ext"""
+    base, oldext = os.path.splitext(filepath)
+    if oldext == '.tbz2':
+        base += ".tar"
+    return base + ext
+
+
+def pipe_through(filepath, compress_cmd, outpath, limit=None):
+    """Streams a file from its decompressor into a compressor
+
+       Args:
+           filepath: Compressed file
+           compress_cmd: Command of the new compressor (writing to stdout)
+           outpath: Where the compressor's output is written
+           limit: Optional maximum number of uncompressed bytes to pipe through
+
+       Returns: (sha256 of the uncompressed data, number of uncompressed bytes)
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    decomp_cmd = decompressors[os.path.splitext(filepath)[1]]
+    with open(outpath, 'wb') as out:
+        decomp = subprocess.Popen(f"{decomp_cmd} \"{filepath}\"", shell=True, stdout=subprocess.PIPE)
+        comp = subprocess.Popen(f"{idle_prefix} {compress_cmd}", shell=True, stdin=subprocess.PIPE, stdout=out)
+        for chunk in iter(lambda: decomp.stdout.read(1024*1024), b''):
+            if limit is not None and size >= limit:
+                break
+            sha256.update(chunk)
+            size += len(chunk)
+            comp.stdin.write(chunk)
+        comp.stdin.close()
+        if limit is not None:
+            decomp.kill()
+        decomp.stdout.close()
+        decomp_rc = decomp.wait()
+        if comp.wait() != 0 or (limit is None and decomp_rc != 0):
+            raise Exception(f"Failed to recompress {filepath}")
+    return sha256.hexdigest(), size
+
+
+def get_uncompressed_digest(filepath, decomp_cmd):
+    """sha256 and size of the decompressed contents of a file"""
+    sha256 = hashlib.sha256()
+    size = 0
+    proc = subprocess.Popen(f"{decomp_cmd} \"{filepath}\"", shell=True, stdout=subprocess.PIPE)
+    for chunk in iter(lambda: proc.stdout.read(1024*1024), b''):
+        sha256.update(chunk)
+        size += len(chunk)
+    if proc.wait() != 0:
+        raise Exception(f"Failed to decompress {filepath}")
+    return sha256.hexdigest(), size
+
+
+def choose_tier(sample_path, min_decompress_mbps, sample_bytes=64*1024*1024):
+    """Picks the codec giving the smallest output that decompresses at least at min_decompress_mbps
+
+       Measured by compressing up to sample_bytes of the sample file with each codec.
+
+       Returns: entry of tiers or None if no codec is fast enough
+    """
+    best = None
+    for tier in tiers:
+        fdesc, tmppath = mkstemp(dir=os.path.dirname(sample_path), prefix=".sample")
+        os.close(fdesc)
+        try:
+            _, size = pipe_through(sample_path, tier[1], tmppath, limit=sample_bytes)
+            started = time.monotonic()
+            get_uncompressed_digest(tmppath, tier[2])
+            mbps = size / (1024*1024) / max(time.monotonic() - started, 1e-6)
+            compressed = os.path.getsize(tmppath)
+        finally:
+            os.unlink(tmppath)
+        if mbps >= min_decompress_mbps and (best is None or compressed < best[1]):
+            best = (tier, compressed)
+    return best[0] if best else None
+
+
+def recompact_file(filepath, tier):
+    """Recompresses a file with a codec, verifies it and swaps it into place
+
+       Returns: (old size, new path, new size)
+    """
+    newpath = get_new_path(filepath, tier[3])
+    fdesc, tmppath = mkstemp(dir=os.path.dirname(filepath), prefix=".recompact")
+    os.close(fdesc)
+    try:
+        digest, _ = pipe_through(filepath, tier[1], tmppath)
+        if get_uncompressed_digest(tmppath, tier[2])[0] != digest:
+            raise Exception(f"Verification of recompressed {filepath} failed")
+        oldsize = os.path.getsize(filepath)
+        os.replace(tmppath, newpath)
+    except Exception:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+    if newpath != filepath:
+        os.unlink(filepath)
+    return oldsize, newpath, os.path.getsize(newpath)
+
+
+def update_references(archive_path, oldpath, newpath, codec):
+    """Updates the manifest (files, deltas) after a file was recompacted"""
+    replace_file(archive_path, oldpath, newpath)
+    old = os.path.relpath(oldpath, archive_path)
+    new = os.path.relpath(newpath, archive_path)
+    conn = connect(archive_path)
+    with conn:
+        conn.execute("UPDATE deltas SET path = ? WHERE path = ?", (new, old))
+        conn.execute("UPDATE deltas SET keyframe = ? WHERE keyframe = ?", (new, old))
+        conn.execute("INSERT OR REPLACE INTO recompactions VALUES (?, ?, ?)",
+                     (new, codec, datetime.now().isoformat()))
+    conn.close()
+
+
+def recompact_archive(archive_path, min_age_days=90, min_decompress_mbps=50, workers=2,
+                      max_load=None, logger=None):
+    """Recompacts all cold months of an archive
+
+       Args:
+           archive_path: Root of the archive
+           min_age_days: Only months that ended more than this many days ago are recompacted
+           min_decompress_mbps: Decompression speed (MB/s) the chosen codec must achieve
+           workers: Number of files recompressed at the same time
+           max_load: Stop starting new files when the 1 minute load average exceeds this
+           logger: Optional logger
+
+       Returns: dict of old path -> new path of the recompacted files
+    """
+    conn = connect(archive_path)
+    done = {row['path'] for row in conn.execute("SELECT path FROM recompactions").fetchall()}
+    conn.close()
+    renamed = {}
+    for year, mon in get_cold_months(archive_path, min_age_days):
+        files = get_month_files(archive_path, year, mon, done)
+        if not files:
+            continue
+        tier = choose_tier(files[0], min_decompress_mbps)
+        if tier is None:
+            if logger: logger.info(f"No codec fast enough for {archive_path} {year}-{mon}")
+            continue
+
+        def work(filepath):
+            if max_load is not None and os.getloadavg()[0] > max_load:
+                return filepath, None
+            return filepath, recompact_file(filepath, tier)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for filepath, result in pool.map(work, files):
+                if result is None:
+                    continue
+                oldsize, newpath, newsize = result
+                update_references(archive_path, filepath, newpath, tier[0])
+                renamed[filepath] = newpath
+                if logger: logger.info(f"Recompacted {filepath} ({oldsize} -> {newsize} bytes, {tier[0]})")
+    return renamed
@@ -0,0 +1,142 @@
+"""
+Internal runner of external commands (compressors, unzip, tar, rsync)
+
+Commands are run as asyncio subprocesses rather than as Prefect shell tasks, so a flow
+handling hundreds of files does not create a task run (and its database records) per
+command. At most max_concurrency commands run at the same time, their output is
+streamed (only the last lines are kept), they can be given a timeout and they return a
+CommandResult. Each result is also kept, per flow run, so that a flow can log a single
+summary of the commands it ran (log_command_summary()).
+
+The max_concurrency limit is process-wide: a sync flow runs every call in a new event
+loop, so the slots are a threading.BoundedSemaphore handed out by one waiting thread
+rather than an asyncio.Semaphore of a loop.
+"""
+import asyncio
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import os
+import threading
+import time
+
+from prefect import get_run_logger
+from prefect.context import FlowRunContext
+from prefect.utilities.asyncutils import sync_compatible
+
+
+CommandResult = namedtuple('CommandResult', ['command', 'returncode', 'output', 'duration', 'timed_out'])
+
+max_concurrency = os.cpu_count() or 2
+# lines of output kept per command
+max_output_lines = 200
+
+_slots = threading.BoundedSemaphore(max_concurrency)
+# acquires the slots in turn for the commands waiting for one, whatever their thread or loop
+_slot_waiter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="command-slots")
+# results of the commands of each flow run (those run outside of flow runs are not kept)
+_results = {}
+_lock = threading.Lock()
+
+
+class CommandError(Exception):
+    """Raised when a command fails or times out"""
+
+    def __init__(self, result):
+        reason = "timed out" if result.timed_out else f"exited with {result.returncode}"
+        super().__init__(f"Command {reason}: {result.command}\n{result.output}")
+        self.result = result
+
+
+@asynccontextmanager
+async def command_slot():
+    """Holds one of the max_concurrency slots of the commands of the process"""
+    if not _slots.acquire(blocking=False):
+        future = _slot_waiter.submit(_slots.acquire)
+        try:
+            await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # a slot acquired after all is given back
+            if not future.cancel():
+                future.add_done_callback(lambda _: _slots.release())
+            raise
+    try:
+        yield
+    finally:
+        _slots.release()
+
+
+def get_run_id():
+    """Id of the current flow run (None outside of flow runs)"""
+    context = FlowRunContext.get()
+    return context.flow_run.id if context is not None else None
+
+
+@sync_compatible
+async def run_command(command, cwd=None, timeout=None, check=True, on_output=None):
+    """Runs a shell command
+
+       Args:
+           command: Command line (run by the shell)
+           cwd: Directory to run it in
+           timeout: Seconds after which the command is killed
+           check: Raise CommandError if the command fails or times out
+           on_output: Optional function called with every line of output as it is produced
+
+       Returns: CommandResult of the command, output being its last lines (stdout and stderr)
+    """
+    async with command_slot():
+        started = time.monotonic()
+        proc = await asyncio.create_subprocess_shell(command, cwd=cwd, stdout=asyncio.subprocess.PIPE,
+                                                     stderr=asyncio.subprocess.STDOUT)
+        lines = deque(maxlen=max_output_lines)
+
+        async def pump():
+            async for line in proc.stdout:
+                line = line.decode('utf8', errors='replace').rstrip('\n')
+                lines.append(line)
+                if on_output is not None:
+                    on_output(line)
+
+        timed_out = False
+        try:
+            await asyncio.wait_for(asyncio.gather(pump(), proc.wait()), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            proc.kill()
+            await proc.wait()
+        result = CommandResult(command, proc.returncode, "\n".join(lines),
+                               time.monotonic() - started, timed_out)
+    run_id = get_run_id()
+    if run_id is not None:
+        # kept until the summary of the run, nothing would ever clear them otherwise
+        with _lock:
+            _results.setdefault(run_id, []).append(result)
+    if check and (timed_out or result.returncode != 0):
+        raise CommandError(result)
+    return result
+
+
+def get_command_summary(clear=True):
+    """Summary of the commands run by the current flow run since its last summary
+
+       Returns: dict of commands, failed, seconds (total), slowest (command) and slowest_seconds
+    """
+    with _lock:
+        results = list(_results.pop(get_run_id(), []) if clear else _results.get(get_run_id(), []))
+    slowest = max(results, key=lambda r: r.duration, default=None)
+    return {'commands': len(results),
+            'failed': len([r for r in results if r.timed_out or r.returncode != 0]),
+            'seconds': round(sum([r.duration for r in results]), 3),
+            'slowest': slowest.command if slowest else None,
+            'slowest_seconds': round(slowest.duration, 3) if slowest else 0}
+
+
+def log_command_summary():
+    """Logs one summary of the commands run by the current flow run"""
+    summary = get_command_summary()
+    if summary['commands']:
+        get_run_logger().info(f"Ran {summary['commands']} commands ({summary['failed']} failed) "
+                              f"in {summary['seconds']}s, slowest {summary['slowest_seconds']}s: "
+                              f"{summary['slowest']}")
+    return summary
@@ -0,0 +1,157 @@
+"""
+Functions to scrub an archive: check that its compressed files still decompress
+and that their checksums still match those recorded in the manifest (bit-rot)
+
+Scrubbing is incremental: only files that are new, have changed (size/mtime) or
+were last scrubbed more than a given number of days ago are checked, and the
+amount checked per run can be limited so a full pass is spread over several runs.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import hashlib
+import os
+import subprocess
+import zipfile
+
+from .codec import decompress_errors, detect_codec, open_decompressed, zstandard
+from .delta import DELTA_EXT
+from .manifest import MANIFEST_NAME, get_records, record_file, record_scrubs
+
+
+class HashingReader:
+    """File object wrapper that computes the checksums of everything read through it"""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fd.read(size)
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+
+def test_file(filepath, chunk_size=1024*1024):
+    """Decompresses a file (output discarded) while computing its checksums
+
+       Returns: dict of md5, sha256, size of the file and error (None if it decompressed)
+    """
+    error = None
+    with open(filepath, 'rb') as rawfd:
+        # deltas can only be decompressed with their keyframe
+        codec = detect_codec(rawfd) if not filepath.endswith(DELTA_EXT) else None
+        reader = HashingReader(rawfd)
+        try:
+            decomp = open_decompressed(reader, codec)
+            if decomp is not None:
+                while decomp.read(chunk_size):
+                    pass
+        except decompress_errors as exc:
+            error = str(exc) or exc.__class__.__name__
+        # checksum whatever the decompressor did not need to read
+        while reader.read(chunk_size):
+            pass
+    if error is None and codec == 'zip':
+        try:
+            with zipfile.ZipFile(filepath) as zfd:
+                bad = zfd.testzip()
+            if bad is not None:
+                error = f"bad member {bad}"
+        except zipfile.BadZipFile as exc:
+            error = str(exc)
+    if error is None and codec == 'zstd' and zstandard is None:
+        proc = subprocess.run(["zstd", "-t", "-q", "--long=31", filepath], capture_output=True, text=True)
+        if proc.returncode != 0:
+            error = proc.stderr.strip()
+    return {'md5': reader.md5.hexdigest(), 'sha256': reader.sha256.hexdigest(),
+            'size': reader.size, 'error': error}
+
+
+def get_scrub_candidates(archive_path, max_age_days=30, max_bytes=None):
+    """Selects the files of an archive that need scrubbing, least recently scrubbed first
+
+       Args:
+           archive_path: Root of the archive
+           max_age_days: Files last scrubbed longer ago than this are rescanned
+           max_bytes: Optional limit of the total size of the selected files
+
+       Returns: list of dicts of path (relative), size and mtime
+    """
+    scrubs = get_records(archive_path, "scrubs")
+    oldest = (datetime.now() - timedelta(days=max_age_days)).isoformat()
+    candidates = []
+    for dirpath, dirnames, filenames in os.walk(archive_path):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in filenames:
+            if filename.startswith('.') or filename.startswith(MANIFEST_NAME):
+                continue
+            fullpath = os.path.join(dirpath, filename)
+            stat = os.stat(fullpath)
+            relpath = os.path.relpath(fullpath, archive_path)
+            last = scrubs.get(relpath)
+            if (last is not None and last['size'] == stat.st_size and last['mtime'] == stat.st_mtime
+                    and last['scrubbed'] >= oldest):
+                continue
+            candidates.append({'path': relpath, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                               'scrubbed': last['scrubbed'] if last else ''})
+    candidates.sort(key=lambda c: c['scrubbed'])
+    if max_bytes is not None:
+        total = 0
+        for idx, cand in enumerate(candidates):
+            total += cand['size']
+            if total > max_bytes:
+                candidates = candidates[:max(idx, 1)]
+                break
+    return candidates
+
+
+def scrub_archive(archive_path, max_age_days=30, max_bytes=None, workers=None):
+    """Scrubs the files of an archive across a pool of processes
+
+       Files not in the manifest yet (e.g. archived before it existed) have their
+       digests recorded so later scrubs can detect changes to them.
+
+       Args:
+           archive_path: Root of the archive
+           max_age_days: Files last scrubbed longer ago than this are rescanned
+           max_bytes: Optional limit of the total size of files scrubbed in this run
+           workers: Number of processes (default is number of CPUs)
+
+       Returns: list of dicts of the results of each scrubbed file
+    """
+    candidates = get_scrub_candidates(archive_path, max_age_days, max_bytes)
+    if not candidates:
+        return []
+    manifest = get_records(archive_path, "files")
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        fullpaths = [os.path.join(archive_path, c['path']) for c in candidates]
+        for cand, tested in zip(candidates, pool.map(test_file, fullpaths, chunksize=4)):
+            error = tested['error']
+            known = manifest.get(cand['path'])
+            if known is None:
+                record_file(archive_path, os.path.join(archive_path, cand['path']),
+                            digests=tested)
+            elif error is None and known['sha256'] != tested['sha256']:
+                if known['mtime'] == cand['mtime'] and known['size'] == cand['size']:
+                    error = f"SHA-256 {tested['sha256']} instead of {known['sha256']}"
+                else:
+                    # file was rewritten outside of railcron, adopt its new digests
+                    record_file(archive_path, os.path.join(archive_path, cand['path']),
+                                source=known['source'], etag=known['etag'], digests=tested)
+            results.append({'path': cand['path'], 'size': cand['size'], 'mtime': cand['mtime'],
+                            'ok': error is None, 'error': error})
+    record_scrubs(archive_path, results)
+    return results
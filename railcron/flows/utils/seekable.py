@@ -0,0 +1,252 @@
+"""
+Functions to write and read seekable, multi-frame zstd files
+
+A seekable file is a sequence of independent zstd frames (each about frame_size bytes
+of uncompressed data, ending at a line boundary), so it is still a normal .zst file
+for any zstd tool. A sidecar index (file.zst.idx, JSON) lists for every frame its
+compressed offset and size, its uncompressed offset and size and the first timestamp
+found in it, along with the last timestamp of the file, so a time range can be read by
+decompressing only the frames covering it.
+
+The zstandard module is used when installed, otherwise the zstd command.
+"""
+from datetime import datetime, timezone
+import io
+import json
+import os
+import re
+import subprocess
+from tempfile import mkstemp
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .codec import ZSTD_MAX_WINDOW, open_file
+from .manifest import replace_file
+
+
+decompressors = {
+    '.gz': 'gzip -d -c',
+    '.bz2': 'bzip2 -d -c',
+    '.tbz2': 'bzip2 -d -c',
+    '.xz': 'xz -d -c',
+    '.zst': 'zstd -d -q -c --long=31',
+}
+
+IDX_EXT = ".idx"
+FRAME_SIZE = 4 * 1024 * 1024
+LEVEL = 19
+
+# searched for at the start of each frame, first match wins
+timestamp_patterns = [
+    # ISO 8601, e.g. DARWIN Push Port ts="2022-10-16T00:00:01.123+01:00"
+    re.compile(rb'(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})'),
+    # epoch milliseconds, e.g. TD/TRUST JSON "time":"1665878401000"
+    re.compile(rb'"(?:time|timestamp|msg_queue_timestamp)"\s*:\s*"?(\d{13})'),
+]
+
+
+def get_idx_path(filepath):
+    """Path of the sidecar index of a seekable file"""
+    return filepath + IDX_EXT
+
+
+def get_timestamp(data, window=64*1024, last=False):
+    """First timestamp found near the start of data (last near its end with last)
+       as YYYY-MM-DDTHH:MM:SS (None if none)
+    """
+    head = data[-window:] if last else data[:window]
+    for pattern in timestamp_patterns:
+        found = None
+        if last:
+            for found in pattern.finditer(head):
+                pass
+        else:
+            found = pattern.search(head)
+        if found is None:
+            continue
+        if len(found.groups()) == 2:
+            return f"{found.group(1).decode()}T{found.group(2).decode()}"
+        stamp = datetime.fromtimestamp(int(found.group(1)) / 1000, tz=timezone.utc)
+        return stamp.strftime("%Y-%m-%dT%H:%M:%S")
+    return None
+
+
+def compress_frame(data, level=LEVEL):
+    """Compresses data as one standalone zstd frame"""
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return subprocess.run(["zstd", "-q", "-c", f"-{level}"], input=data,
+                          capture_output=True, check=True).stdout
+
+
+def decompress_frame(data):
+    """Decompresses one zstd frame"""
+    if zstandard is not None:
+        return zstandard.ZstdDecompressor(max_window_size=ZSTD_MAX_WINDOW).decompress(data)
+    return subprocess.run(["zstd", "-d", "-q", "-c", "--long=31"], input=data,
+                          capture_output=True, check=True).stdout
+
+
+def write_seekable(filepath, outpath, frame_size=FRAME_SIZE, level=LEVEL):
+    """Writes the (uncompressed) contents of a file as a seekable zstd file and its index
+
+       Args:
+           filepath: Source file, decompressed according to its extension
+           outpath: Path of the seekable file, the index is written next to it
+           frame_size: Approximate amount of uncompressed data per frame
+
+       Returns: list of frames [compressed offset, compressed size, offset, size, timestamp]
+    """
+    tool = decompressors.get(os.path.splitext(filepath)[1], "cat")
+    proc = subprocess.Popen(f"{tool} \"{filepath}\"", shell=True, stdout=subprocess.PIPE)
+    frames = []
+    coffset = uoffset = 0
+    last = None
+    with open(outpath, 'wb') as out:
+        while True:
+            data = proc.stdout.read(frame_size)
+            if not data:
+                break
+            # end frames at a line boundary so each starts with a whole record
+            if not data.endswith(b'\n'):
+                data += proc.stdout.readline(1024*1024)
+            frame = compress_frame(data, level)
+            out.write(frame)
+            frames.append([coffset, len(frame), uoffset, len(data), get_timestamp(data)])
+            last = get_timestamp(data, last=True) or last
+            coffset += len(frame)
+            uoffset += len(data)
+    if proc.wait() != 0:
+        raise Exception(f"Failed to decompress {filepath}")
+    with open(get_idx_path(outpath), 'w', encoding='utf8') as fd:
+        json.dump({'frames': frames, 'last': last}, fd)
+    return frames
+
+
+def recompress_seekable(cfg, filepath):
+    """Recompresses a file to a seekable .zst with a sidecar index
+
+       Args:
+           cfg: Block with configuration info
+           filepath: Path of original file
+
+       Returns: path to the new file
+    """
+    base, oldext = os.path.splitext(filepath)
+    if oldext not in decompressors or cfg.filetype == '--':
+        base = filepath
+    elif oldext == '.tbz2':
+        base += ".tar"
+    newpath = base + ".zst"
+    fdesc, tmppath = mkstemp(dir=os.path.dirname(filepath), prefix=".seekable")
+    os.close(fdesc)
+    try:
+        write_seekable(filepath, tmppath)
+        os.replace(get_idx_path(tmppath), get_idx_path(newpath))
+        os.replace(tmppath, newpath)
+    except Exception:
+        for path in (tmppath, get_idx_path(tmppath)):
+            if os.path.exists(path):
+                os.unlink(path)
+        raise
+    if newpath != filepath:
+        os.unlink(filepath)
+    replace_file(cfg.archive_path, filepath, newpath)
+    return newpath
+
+
+def read_frame_index(filepath):
+    """Reads the index of a seekable file, {'frames': [...], 'last': timestamp} (None if it has none)"""
+    idx_path = get_idx_path(filepath)
+    if not os.path.exists(idx_path):
+        return None
+    with open(idx_path, encoding='utf8') as fd:
+        return json.load(fd)
+
+
+def select_frames(frames, start, end, last=None):
+    """Frames holding the records between the timestamps start and end (inclusive)
+
+       A frame without a timestamp is taken to start at the timestamp of the previous one.
+       A frame is kept when it starts no later than end and the next one (for the last
+       frame, the last timestamp of the file, else its own) is no earlier than start, so
+       a file whose records all precede start gives no frames.
+    """
+    stamps = []
+    current = ""
+    for frame in frames:
+        current = frame[4] or current
+        stamps.append(current)
+    ends = stamps[1:] + [max(last or "", stamps[-1])] if stamps else []
+    selected = []
+    for frame, stamp, next_stamp in zip(frames, stamps, ends):
+        if stamp and stamp > end:
+            break
+        if next_stamp and next_stamp < start:
+            continue
+        selected.append(frame)
+    return selected
+
+
+class FrameReader(io.RawIOBase):
+    """Readable stream over the decompressed contents of selected frames of seekable files
+
+       Args:
+           segments: list of (source, frames), frames being None to read the whole source
+           opener: Function opening the decompressed contents of a whole source
+                   (default open_file(), for paths)
+    """
+
+    def __init__(self, segments, opener=open_file):
+        super().__init__()
+        self.segments = [(path, None if frames is None else list(frames)) for path, frames in segments]
+        self.opener = opener
+        self.buffer = b''
+        self.pos = 0
+        self.stream = None
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        if self.pos >= len(self.buffer):
+            self.buffer = b''
+            self.pos = 0
+        while not self.buffer:
+            if self.stream is not None:
+                self.buffer = self.stream.read(1024*1024)
+                if self.buffer:
+                    return
+                self.stream.close()
+                self.stream = None
+            if not self.segments:
+                return
+            filepath, frames = self.segments[0]
+            if frames is None:
+                # not seekable, decompress the whole file
+                self.segments.pop(0)
+                self.stream = self.opener(filepath)
+                continue
+            if not frames:
+                self.segments.pop(0)
+                continue
+            frame = frames.pop(0)
+            with open(filepath, 'rb') as fd:
+                fd.seek(frame[0])
+                self.buffer = decompress_frame(fd.read(frame[1]))
+
+    def readinto(self, buf):
+        self._fill()
+        size = min(len(buf), len(self.buffer) - self.pos)
+        buf[:size] = self.buffer[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        super().close()
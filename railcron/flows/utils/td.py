@@ -0,0 +1,209 @@
+"""
+TD berth steps of the A51 archives as a sorted, indexed table
+
+A day of a51_td (DD.tbz2 of hourly files, or gzipped) holds lines of Train Describer
+messages in JSON, each line an array of messages as sent by the feed. Only the C-class
+messages, the movements of train descriptions (headcodes) between the berths of the
+signalling areas, are kept:
+    CA  berth step (from, to)     CB  cancel (from)     CC  interpose (to)
+so a day is a fraction of its messages. The fields of the C-class messages are extracted
+a batch at a time by one regular expression over the whole batch rather than decoding
+every message (batches with messages not as the feed sends them are decoded with json,
+line by line, skipping malformed lines such as one truncated at the end of an hourly file).
+
+decode_day() writes the steps of a day into a table (see utils/columnar.py) sorted by
+time, with the columns:
+    area:       S2 TD area (e.g. SK)
+    from_berth: S4 berth stepped from (blank for CC)
+    to_berth:   S4 berth stepped to (blank for CB)
+    headcode:   S4 train description (e.g. 1A23)
+    time:       i8 milliseconds since the epoch
+    kind:       S2 CA, CB or CC
+and the indexes:
+    headcode:   headcode, time
+    to / from:  area, to_berth / from_berth, time
+so BerthSteps answers "where was 1A23 between 08:00 and 09:00" (where()) or "what
+went through berth SK 0202" (at_berth()) with binary searches over the memory maps.
+The table is kept in {store}/a51_td/YYYY-MM-DD and decoded again only when the archived
+files of the day change (get_steps()).
+"""
+from datetime import date, datetime, time
+import json
+import os
+import re
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from .codec import iter_lines
+from .columnar import Table, add_index, get_store_path, write_table
+from .reader import get_day_files, iter_members
+
+
+# bytes of lines decoded at once
+BATCH_BYTES = 8 * 1024**2
+# times given as HH:MM are of the day in the UK
+TIMEZONE = ZoneInfo("Europe/London")
+
+columns = {'area': 'S2', 'from_berth': 'S4', 'to_berth': 'S4', 'headcode': 'S4', 'time': 'i8', 'kind': 'S2'}
+# message fields of each column
+fields = {'area': 'area_id', 'from_berth': 'from', 'to_berth': 'to', 'headcode': 'descr', 'time': 'time'}
+indexes = {
+    'headcode': ['headcode', 'time'],
+    'to': ['area', 'to_berth', 'time'],
+    'from': ['area', 'from_berth', 'time'],
+}
+# C-class messages with their fields in the order the feed sends them, e.g.
+# {"CA_MSG":{"time":"1349696911000","area_id":"SK","msg_type":"CA","from":"3647","to":"3649","descr":"1F42"}}
+c_class = re.compile(rb'"(C[ABC])_MSG":\{"time":"(\d+)","area_id":"(\w*)","msg_type":"C[ABC]",'
+                     rb'(?:"from":"(\w*)",)?(?:"to":"(\w*)",)?"descr":"([^"]*)"\}')
+c_count = re.compile(rb'"C[ABC]_MSG"')
+
+
+def extract_steps(data):
+    """Columns of the C-class messages of a batch of lines, extracted by one regular expression
+
+       Returns: dict of column -> array, or None if a message is not as expected
+    """
+    found = c_class.findall(data)
+    if len(found) != len(c_count.findall(data)):
+        return None
+    if not found:
+        return {name: np.empty(0, dtype) for name, dtype in columns.items()}
+    values = np.array(found, 'S16')
+    return {'area': values[:, 2].astype('S2'), 'from_berth': values[:, 3].astype('S4'),
+            'to_berth': values[:, 4].astype('S4'), 'headcode': values[:, 5].astype('S4'),
+            'time': values[:, 1].astype(np.int64), 'kind': values[:, 0].astype('S2')}
+
+
+def decode_steps(data):
+    """Columns of the C-class messages of a batch of lines, decoding each message
+
+       Returns: (dict of column -> array, number of malformed lines skipped)
+    """
+    steps = {name: [] for name in columns}
+    skipped = 0
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            messages = json.loads(line)
+        except ValueError:
+            skipped += 1
+            continue
+        for message in messages if isinstance(messages, list) else (messages,):
+            if not isinstance(message, dict):
+                continue
+            for key, body in message.items():
+                if key not in ("CA_MSG", "CB_MSG", "CC_MSG") or not isinstance(body, dict):
+                    continue
+                for name, field in fields.items():
+                    steps[name].append(body.get(field, ""))
+                steps['kind'].append(key[:2])
+    return {name: np.array(values, columns[name] if name != 'time' else 'U16').astype(columns[name])
+            for name, values in steps.items()}, skipped
+
+
+def get_sources(filepaths):
+    """How the archived files of a day are recorded in its table (to detect changes)"""
+    return {x: os.path.getsize(x) for x in filepaths}
+
+
+def decode_day(filepaths, path, day, fname="a51_td", cfg=None, batch_bytes=BATCH_BYTES):
+    """Decodes the berth steps of archived TD files into a table sorted by time, and indexes it
+
+       Args:
+           filepaths: Archived files of the day
+           path: Directory of the table
+           day: YYYY-MM-DD of the day (the day of times given as HH:MM)
+           fname: Name of the flow (a51_td)
+           cfg: Block of the flow, to read decompressed copies in the cache if enabled
+           batch_bytes: Bytes of lines decoded at once
+
+       Returns: number of steps
+    """
+    batches = []
+    skipped = 0
+    for filepath in filepaths:
+        for member in iter_members(filepath, fname, cfg):
+            for data in iter_lines(member, batch_bytes):
+                steps = extract_steps(data)
+                if steps is None:
+                    steps, bad = decode_steps(data)
+                    skipped += bad
+                batches.append(steps)
+    steps = {name: np.concatenate([x[name] for x in batches] or [np.empty(0, dtype)])
+             for name, dtype in columns.items()}
+    order = np.argsort(steps['time'], kind='stable')
+    write_table(path, {name: steps[name][order] for name in columns}, sources=get_sources(filepaths), day=day,
+                skipped_lines=skipped)
+    for name, key in indexes.items():
+        add_index(path, name, key)
+    return len(order)
+
+
+def get_steps(cfg, year, mon, day, fname="a51_td", refresh=False):
+    """Berth steps of a day, decoded from the archived files unless already cached
+
+       Args:
+           cfg: Block of the flow
+           year / mon / day: Zero padded strings of the date
+           fname: Name of the flow (a51_td)
+           refresh: Decode the day even if its cache is up to date
+
+       Returns: BerthSteps, or None if nothing is archived for the day
+    """
+    filepaths = get_day_files(fname, cfg, year, mon, day)
+    if not filepaths:
+        return None
+    path = get_store_path(cfg, fname, f"{year}-{mon}-{day}")
+    if not refresh and os.path.exists(path):
+        steps = BerthSteps(path)
+        if steps.meta.get('sources') == get_sources(filepaths):
+            return steps
+    decode_day(filepaths, path, f"{year}-{mon}-{day}", fname, cfg)
+    return BerthSteps(path)
+
+
+class BerthSteps(Table):
+    """Table of the berth steps of a day with the queries of its indexes
+
+       Times are given as milliseconds since the epoch, datetimes (UK time if naive) or
+       "HH:MM[:SS]" of the day of the table in UK time. Ranges include both ends and
+       None leaves a range open. Queries return a dict of column -> array in time order.
+    """
+
+    def get_time(self, value):
+        """Milliseconds since the epoch of a time"""
+        if value is None or isinstance(value, (int, np.integer)):
+            return value
+        if isinstance(value, str):
+            value = datetime.combine(date.fromisoformat(self.meta['day']), time.fromisoformat(value))
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=TIMEZONE)
+        return int(value.timestamp() * 1000)
+
+    def find(self, index, values, start=None, end=None):
+        """Rows of the steps of the values of the first columns of an index, in a time range"""
+        start, end = self.get_time(start), self.get_time(end)
+        low = tuple(values) if start is None else tuple(values) + (start,)
+        high = tuple(values) if end is None else tuple(values) + (end,)
+        return self.index(index).find_range(low, high)
+
+    def where(self, headcode, start=None, end=None, columns=None):
+        """Steps of a train description (e.g. 1A23), e.g. where("1A23", "08:00", "09:00")"""
+        return self.take(self.find('headcode', (headcode.encode(),), start, end), columns)
+
+    def at_berth(self, area, berth, start=None, end=None, columns=None):
+        """Steps into or out of a berth of an area (e.g. "SK", "0202")"""
+        values = (area.encode(), berth.encode())
+        rows = np.union1d(self.find('to', values, start, end), self.find('from', values, start, end))
+        # the table is in time order, so are the rows
+        return self.take(rows, columns)
+
+    def during(self, start=None, end=None, columns=None):
+        """All the steps of a time range"""
+        times = self['time']
+        first = 0 if start is None else np.searchsorted(times, self.get_time(start), side='left')
+        last = self.rows if end is None else np.searchsorted(times, self.get_time(end), side='right')
+        return self.take(np.arange(first, last), columns)
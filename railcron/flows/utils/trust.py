@@ -0,0 +1,240 @@
+"""
+TRUST train movements of the A51 archives as columns, and analyses of their delays
+
+A day of a51_trust (DD.tbz2, a tar of hourly files, or a gzipped file) holds lines of
+TRUST messages in JSON, each line one message or an array of them as sent by the feed.
+decode_day() decodes the train movements (msg_type 0003) of a day into a table of
+columns (see utils/columnar.py), a batch of lines at a time in one json.loads() (line by
+line if the batch has a malformed line, e.g. one truncated at the end of an hourly file,
+which is skipped):
+    train_id:   S10 TRUST train id (e.g. 892A12MQ21)
+    stanox:     i4 STANOX of the location (-1 if none)
+    toc:        S2 TOC id (operator, e.g. 88)
+    event:      S1 A(rrival) or D(eparture)
+    planned:    i8 planned time, milliseconds since the epoch (-1 if off route)
+    actual:     i8 actual time, milliseconds since the epoch
+    variation:  i2 minutes late (negative when early), as reported by TRUST
+    status:     S1 O(n time), L(ate), E(arly) or R (off route)
+
+The table is kept in {store}/a51_trust/YYYY-MM-DD as a cache of the day: get_movements()
+only decodes the day again when its archived files changed, otherwise it just opens
+the memory maps, so repeated analyses skip the parsing entirely.
+
+Movements answers the analyses with NumPy over whole columns, e.g.
+    movements = get_movements(cfg, "2022", "07", "21")
+    movements.on_time(by='toc')
+    movements.delay_distribution(by='stanox', mask=movements.mask(event='A'))
+"""
+import json
+import os
+
+import numpy as np
+
+from .codec import iter_lines
+from .columnar import Table, TableWriter, get_store_path
+from .reader import get_day_files, iter_members
+
+
+# bytes of lines decoded at once
+BATCH_BYTES = 8 * 1024**2
+MOVEMENT = "0003"
+# upper bounds (exclusive) of the minutes late of each bin of delay_distribution()
+DELAY_EDGES = (-5, 0, 1, 3, 6, 11, 16, 31, 61)
+
+columns = {
+    'train_id': 'S10', 'stanox': 'i4', 'toc': 'S2', 'event': 'S1',
+    'planned': 'i8', 'actual': 'i8', 'variation': 'i2', 'status': 'S1',
+}
+statuses = {'ON TIME': 'O', 'LATE': 'L', 'EARLY': 'E', 'OFF ROUTE': 'R'}
+
+
+def decode_lines(lines):
+    """Decodes lines of JSON one by one, skipping malformed ones
+
+       Returns: (list of the decoded lines, number of lines skipped)
+    """
+    items = []
+    for line in lines:
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            continue
+    return items, len(lines) - len(items)
+
+
+def get_messages(lines):
+    """Bodies of the movement messages of lines of JSON (one json.loads() for all)
+
+       Returns: (list of the bodies, number of malformed lines skipped)
+    """
+    lines = [x for x in (line.strip() for line in lines) if x]
+    if not lines:
+        return [], 0
+    try:
+        items, skipped = json.loads(b"[" + b",".join(lines) + b"]"), 0
+    except ValueError:
+        items, skipped = decode_lines(lines)
+    messages = []
+    for item in items:
+        messages.extend(item if isinstance(item, list) else (item,))
+    bodies = [x.get('body') for x in messages
+              if isinstance(x, dict) and (x.get('header') or {}).get('msg_type') == MOVEMENT]
+    return [x for x in bodies if isinstance(x, dict)], skipped
+
+
+def to_columns(bodies):
+    """Columns of movement message bodies"""
+    variation = np.array([x.get('timetable_variation') or '0' for x in bodies], 'U6').astype(np.int16)
+    status = np.array([statuses.get(x.get('variation_status'), 'R') for x in bodies], 'S1')
+    variation[status == b'E'] *= -1
+    return {
+        'train_id': np.array([x.get('train_id') or '' for x in bodies], 'S10'),
+        'stanox': np.array([x.get('loc_stanox') or '-1' for x in bodies], 'U8').astype(np.int32),
+        'toc': np.array([x.get('toc_id') or '' for x in bodies], 'S2'),
+        'event': np.array([(x.get('event_type') or ' ')[0] for x in bodies], 'S1'),
+        'planned': np.array([x.get('planned_timestamp') or '-1' for x in bodies], 'U14').astype(np.int64),
+        'actual': np.array([x.get('actual_timestamp') or '-1' for x in bodies], 'U14').astype(np.int64),
+        'variation': variation,
+        'status': status,
+    }
+
+
+def get_sources(filepaths):
+    """How the archived files of a day are recorded in its table (to detect changes)"""
+    return {x: os.path.getsize(x) for x in filepaths}
+
+
+def decode_day(filepaths, path, fname="a51_trust", cfg=None, batch_bytes=BATCH_BYTES):
+    """Decodes the movements of archived TRUST files into a table
+
+       Args:
+           filepaths: Archived files of the day
+           path: Directory of the table
+           fname: Name of the flow (a51_trust)
+           cfg: Block of the flow, to read decompressed copies in the cache if enabled
+           batch_bytes: Bytes of lines decoded at once
+
+       Returns: number of movements
+    """
+    skipped = 0
+    with TableWriter(path, columns) as table:
+        for filepath in filepaths:
+            for member in iter_members(filepath, fname, cfg):
+                for data in iter_lines(member, batch_bytes):
+                    bodies, bad = get_messages(data.splitlines())
+                    skipped += bad
+                    if bodies:
+                        table.append(**to_columns(bodies))
+        table.meta['sources'] = get_sources(filepaths)
+        table.meta['skipped_lines'] = skipped
+    return table.rows
+
+
+def get_movements(cfg, year, mon, day, fname="a51_trust", refresh=False):
+    """Movements of a day, decoded from the archived files unless already cached
+
+       Args:
+           cfg: Block of the flow
+           year / mon / day: Zero padded strings of the date
+           fname: Name of the flow (a51_trust)
+           refresh: Decode the day even if its cache is up to date
+
+       Returns: Movements, or None if nothing is archived for the day
+    """
+    filepaths = get_day_files(fname, cfg, year, mon, day)
+    if not filepaths:
+        return None
+    path = get_store_path(cfg, fname, f"{year}-{mon}-{day}")
+    if not refresh and os.path.exists(path):
+        movements = Movements(path)
+        if movements.meta.get('sources') == get_sources(filepaths):
+            return movements
+    decode_day(filepaths, path, fname, cfg)
+    return Movements(path)
+
+
+class Movements(Table):
+    """Table of the movements of a day with vectorised delay analyses
+
+       The analyses take a mask (boolean array, see mask()) of the movements to include
+       and "by", a column to group the movements by (e.g. stanox or toc), in which case
+       they return the key of each group along with the results of each.
+    """
+
+    def mask(self, event=None, stanox=None, toc=None, start=None, end=None, planned=True):
+        """Movements of an event type (A or D), location, operator and time range
+
+           Args:
+               start / end: Actual times as milliseconds since the epoch (end excluded)
+               planned: Only the movements with a planned time (not off route)
+        """
+        selected = np.ones(self.rows, bool)
+        if event is not None:
+            selected &= self['event'] == (event.encode() if isinstance(event, str) else event)
+        if stanox is not None:
+            selected &= self['stanox'] == int(stanox)
+        if toc is not None:
+            selected &= self['toc'] == (toc.encode() if isinstance(toc, str) else toc)
+        if start is not None:
+            selected &= self['actual'] >= start
+        if end is not None:
+            selected &= self['actual'] < end
+        if planned:
+            selected &= self['planned'] >= 0
+        return selected
+
+    def group(self, by, mask=None):
+        """Groups the movements by the values of a column
+
+           Returns: (keys of the groups, group of each movement, variations of the movements)
+        """
+        selected = self.mask() if mask is None else mask
+        variation = np.asarray(self['variation'])[selected]
+        if by is None:
+            return None, np.zeros(len(variation), np.intp), variation
+        keys, groups = np.unique(np.asarray(self[by])[selected], return_inverse=True)
+        return keys, groups.reshape(-1), variation
+
+    def on_time(self, by=None, tolerance=0, mask=None):
+        """Percentage of movements at most tolerance minutes late (early ones are on time)
+
+           Returns: percentage, or (keys, count and percentage of each group) with by
+        """
+        keys, groups, variation = self.group(by, mask)
+        ngroups = 1 if keys is None else len(keys)
+        counts = np.bincount(groups, minlength=ngroups)
+        punctual = np.bincount(groups, weights=variation <= tolerance, minlength=ngroups)
+        percent = np.divide(punctual * 100, counts, out=np.full(ngroups, np.nan), where=counts > 0)
+        if keys is None:
+            return float(percent[0])
+        return keys, counts, percent
+
+    def delay_distribution(self, by=None, edges=DELAY_EDGES, mask=None):
+        """Histogram of the minutes late, bin i counting edges[i-1] <= variation < edges[i]
+
+           Returns: (keys, counts) where counts has a row per group (one without by)
+                    and len(edges) + 1 columns
+        """
+        keys, groups, variation = self.group(by, mask)
+        ngroups = 1 if keys is None else len(keys)
+        bins = np.searchsorted(np.asarray(edges), variation, side='right')
+        counts = np.bincount(groups * (len(edges) + 1) + bins, minlength=ngroups * (len(edges) + 1))
+        return keys, counts.reshape(ngroups, len(edges) + 1)
+
+    def delay_percentiles(self, by=None, percentiles=(50, 90, 99), mask=None):
+        """Percentiles of the minutes late (the lower value, as numpy.percentile method="lower")
+
+           Returns: (keys, counts, values) where values has a row per group and a column
+                    per percentile
+        """
+        keys, groups, variation = self.group(by, mask)
+        ngroups = 1 if keys is None else len(keys)
+        order = np.lexsort((variation, groups))
+        counts = np.bincount(groups, minlength=ngroups)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        positions = starts[:, None] + ((counts[:, None] - 1) * np.asarray(percentiles) / 100).astype(np.intp)
+        values = np.zeros(positions.shape, variation.dtype)
+        if len(order):
+            values = variation[order][np.minimum(positions, len(order) - 1)]
+            values[counts == 0] = 0
+        return keys, counts, values
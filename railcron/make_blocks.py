@@ -9,22 +9,10 @@ import os
 import yaml
 import pdb
 
-from flows.utils.blocks import *
+from flows.utils.blocks import block_types, get_block_class
 from flows.utils.misc import load_config
 
 
-# dynamically generate from utils.block introspection?
-block_classes = {
-    'hda': 'hda',
-    'nrdp': 'nrdfs3',
-    'atoc': 'opendata',
-    'incidents': 'opendata',
-    'sched': 'nrdatafeeds',
-    'data': 'nrdatafeeds',
-    'a51': 'a51',
-    'settings': 'railcron'
-}
-
 if __name__ == "__main__":
     config_file = os.getenv('RAILCRON_CFG', '.') + "/railcron.yml"
     with open(config_file, mode="rb") as file:
@@ -35,8 +23,8 @@ if __name__ == "__main__":
             continue
         print(f"Processing {block_name}")
         prefix = block_name.split('_')
-        block_type = block_classes[prefix[0]]
-        block_class = globals()[block_type.capitalize() + "Block"]
+        block_type = block_types[prefix[0]]
+        block_class = get_block_class(block_type.capitalize() + "Block")
         # this ensures variable substitution etc
         cfg = load_config(config_file, block_name)
         new_block = block_class(**cfg)
@@ -9,18 +9,30 @@ if [ -z "$1" ] ; then
 
 prefect deployment build flows/opendata.py:atoc_timetable -n ATOC_TT -t daily -t ATOC -t timetable --output deployments/atoc.yaml
 prefect deployment build flows/opendata.py:incidents -n INCIDENTS -t daily -t Incidents -t XML --output deployments/incidents.yaml
+prefect deployment build flows/timetable.py:atoc_store -n ATOC_STORE -t ATOC -t timetable -t process --output deployments/atoc_store.yaml
 
 prefect deployment build flows/hda_data.py:hda_data -n HDA_DATA -t daily -t NR -t HDA --output deployments/hda.yaml
 
+prefect deployment build flows/coverage.py:archive_coverage -n COVERAGE -t daily -t report --output deployments/coverage.yaml
+prefect deployment build flows/poller.py:upstream_poller -n POLLER -t daily -t poll --output deployments/poller.yaml
+prefect deployment build flows/scrub.py:archive_scrub -n SCRUB -t daily -t maintenance --output deployments/scrub.yaml
+prefect deployment build flows/dedup.py:dedup_report -n DEDUP -t daily -t maintenance -t report --output deployments/dedup.yaml
+prefect deployment build flows/recompact.py:archive_recompact -n RECOMPACT -t weekly -t maintenance --output deployments/recompact.yaml
+prefect deployment build flows/pack.py:archive_pack -n PACK -t daily -t maintenance --output deployments/pack.yaml
+prefect deployment build flows/alerts.py:alert_digest -n ALERTS -t maintenance -t alerts --output deployments/alerts.yaml
+
 prefect deployment build flows/a51_archive.py:a51_td -n A51_TD -t daily -t A51 -t TD  --output deployments/a51_td.yaml
 prefect deployment build flows/a51_archive.py:a51_trust -n A51_TRUST -t daily -t A51 -t TRUST  --output deployments/a51_trust.yaml
 prefect deployment build flows/a51_archive.py:a51_darwin -n A51_DARWIN -t daily -t A51 -t DARWIN --output deployments/a51_darwin.yaml
+prefect deployment build flows/trust.py:trust_movements -n TRUST_MOVEMENTS -t A51 -t TRUST -t process --output deployments/trust_movements.yaml
+prefect deployment build flows/td.py:td_steps -n TD_STEPS -t A51 -t TD -t process --output deployments/td_steps.yaml
 
 prefect deployment build flows/nrdp_data.py:nrdp_darwin_timetable -n DARWIN_TT -t daily -t NRDP -t DARWIN -t timetable --output deployments/nrdp_darwin.yaml
 prefect deployment build flows/nrdp_data.py:nrdp_location -n LOCATIONS -t daily -t NRDP -t reference -t location --output deployments/nrdp_loc.yaml
 prefect deployment build flows/nrdp_data.py:nrdp_ref -n NRDP_REF -t daily -t NRDP -t reference --output deployments/nrdp_ref.yaml
 prefect deployment build flows/nrdp_data.py:nrdp_timetable -n NRDP_TT  -t daily -t NRDP -t timetable --output deployments/nrdp_timetable.yaml
 prefect deployment build flows/nrdp_data.py:nrdp_logs -n NRDP_LOGS -t daily -t NRDP -t DARWIN -t logs --output deployments/nrdp_logs.yaml
+prefect deployment build flows/pushport.py:pushport_ingest -n PP_INGEST -t NRDP -t DARWIN -t logs -t process --output deployments/pushport_ingest.yaml
 
 prefect deployment build flows/singlefile.py:data_smart -n SMART -t daily -t SMART -t reference  --output deployments/smart.yaml
 prefect deployment build flows/singlefile.py:data_corpus -n CORPUS -t daily -t CORPUS -t reference --output deployments/corpus.yaml
@@ -0,0 +1,75 @@
+"""
+Tests of the emails of the errors of the flows (flows/utils/alerts.py)
+
+    python -m pytest railcron/tests
+"""
+import asyncio
+import os
+import stat
+import sys
+from types import SimpleNamespace
+
+from prefect import flow
+from prefect.testing.utilities import prefect_test_harness
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flows"))
+
+from utils.misc import email_message  # noqa: E402
+
+
+@pytest.fixture(scope="module", autouse=True)
+def prefect_db():
+    with prefect_test_harness():
+        yield
+
+
+@pytest.fixture
+def mail_command(tmp_path, monkeypatch):
+    """A mail command on the PATH writing its arguments and stdin to files"""
+    script = tmp_path / "mail"
+    script.write_text(f"#!/bin/sh\necho \"$@\" > {tmp_path}/args\ncat > {tmp_path}/body\necho queued\n")
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    return tmp_path
+
+
+def make_cfg(**settings):
+    values = {'MAIL_FROM': "railcron@example.com", 'MAIL_TO': "ops@example.com", 'MAIL_CC': None,
+              'MAIL_BCC': None, 'MAIL_SRV': None, 'alert_window': 0}
+    values.update(settings)
+    return SimpleNamespace(settings=SimpleNamespace(**values))
+
+
+def test_mail_command_from_async_flow(mail_command):
+    msg = 'Traceback<br/>  File "x.py", line 1, in $HOME `id`<br/>Exception: "failed"'
+
+    @flow
+    async def failing_flow():
+        return email_message(make_cfg(MAIL_CC="cc@example.com"), "Error in Prefect Flow a51_td", msg)
+
+    assert asyncio.run(failing_flow()) == "queued\n"
+    assert (mail_command / "args").read_text().split() == [
+        "-r", "railcron@example.com", "-s", "Error", "in", "Prefect", "Flow", "a51_td",
+        "-c", "cc@example.com", "ops@example.com"]
+    assert (mail_command / "body").read_text() == msg + "\n"
+
+
+def test_mail_command_from_sync_flow(mail_command):
+
+    @flow
+    def failing_flow():
+        return email_message(make_cfg(MAIL_SRV="sendmail"), "Error in Prefect Flow incidents", "failed")
+
+    assert failing_flow() == "queued\n"
+    assert (mail_command / "body").read_text() == "failed\n"
+
+
+def test_mail_command_failure_is_not_raised(mail_command):
+    (mail_command / "mail").write_text("#!/bin/sh\nexit 1\n")
+
+    @flow
+    async def failing_flow():
+        return email_message(make_cfg(), "Error in Prefect Flow nrdp_logs", "failed")
+
+    assert asyncio.run(failing_flow()) == ""
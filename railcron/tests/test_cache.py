@@ -0,0 +1,62 @@
+"""
+Tests of reading archived files through the decompressed cache (flows/utils/cache.py)
+
+    python -m pytest railcron/tests
+"""
+import io
+import os
+import sys
+import tarfile
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flows"))
+
+from utils import cache  # noqa: E402
+from utils.reader import iter_members  # noqa: E402
+
+
+members = {"0700.json": b'{"hour":7}\n' * 100, "0800.json": b'{"hour":8}\n' * 100}
+
+
+@pytest.fixture
+def a51_day(tmp_path):
+    """An A51 day (DD.tbz2 of two members) and a Block with the cache enabled"""
+    archive_path = tmp_path / "a51"
+    daypath = archive_path / "2022" / "10"
+    daypath.mkdir(parents=True)
+    filepath = daypath / "16.tbz2"
+    with tarfile.open(filepath, 'w:bz2') as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    cfg = SimpleNamespace(archive_path=str(archive_path),
+                          settings=SimpleNamespace(cache_dir=str(tmp_path / "cache"), cache_gb=1))
+    return cfg, str(filepath)
+
+
+def test_iter_members_from_cache(a51_day):
+    cfg, filepath = a51_day
+    for _ in range(2):
+        assert [fd.read() for fd in iter_members(filepath, "a51_trust", cfg)] == list(members.values())
+    assert os.path.exists(cache.get_entry_path(cfg, filepath))
+
+
+def test_iter_members_of_evicted_entry(a51_day, monkeypatch):
+    cfg, filepath = a51_day
+    cached_path = cache.cached_path
+    calls = []
+
+    def evicted_once(*args):
+        # the entry is evicted by another process before it is opened the first time
+        entry = cached_path(*args)
+        calls.append(entry)
+        if len(calls) == 1:
+            os.unlink(entry)
+        return entry
+
+    monkeypatch.setattr(cache, 'cached_path', evicted_once)
+    assert [fd.read() for fd in iter_members(filepath, "a51_trust", cfg)] == list(members.values())
+    assert len(calls) == 2
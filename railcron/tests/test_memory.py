@@ -0,0 +1,39 @@
+"""
+Tests of the peak memory of the archive and hashing paths (bench/memory_bench.py)
+
+Every path is run on small inputs, each in its own process: a path that reads a whole
+file, response or S3 object into memory grows with its input by about the difference
+of their sizes. bench/memory_bench.py runs the same check on inputs of up to GBs.
+
+    python -m pytest railcron/tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"))
+
+import memory_bench  # noqa: E402
+
+
+# MB of the inputs, and that a path may grow by between them (less than the difference)
+SIZES = [1, 16]
+GROWTH = 8
+
+
+@pytest.fixture(scope="module")
+def standins(tmp_path_factory):
+    """Inputs of every path and the stand-ins serving them"""
+    inputs = memory_bench.make_inputs(memory_bench.paths, SIZES, str(tmp_path_factory.mktemp("inputs")))
+    proc, base_url = memory_bench.start_standins(inputs)
+    yield inputs, base_url
+    proc.terminate()
+
+
+@pytest.mark.parametrize("path", list(memory_bench.paths))
+def test_peak_memory(standins, path):
+    inputs, base_url = standins
+    runs = {size: memory_bench.measure(path, inputs[(memory_bench.paths[path], size)], base_url)
+            for size in SIZES}
+    assert memory_bench.check({path: runs}, SIZES, memory_bench.CEILING, GROWTH) == []
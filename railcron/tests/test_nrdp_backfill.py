@@ -0,0 +1,60 @@
+"""
+Tests of the bucketing of S3 objects into the days of a backfill (flows/nrdp_data.py)
+
+    python -m pytest railcron/tests
+"""
+import asyncio
+from datetime import datetime
+import logging
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flows"))
+
+import nrdp_data  # noqa: E402
+
+
+def run_backfill(monkeypatch, tmp_path, objects, filt, date_in_key=False):
+    """Days each object is fetched for by a backfill of 2022-07-01 to 2022-07-03"""
+    fetched = []
+
+    async def list_objects(**kwargs):
+        return [x for x in objects if x['Key'].startswith(kwargs['prefix'])]
+
+    async def fetch(func, nrdf, obj, prefi, year, mon, day):
+        fetched.append((obj['Key'], f"{year}-{mon}-{day}"))
+        return obj['Key']
+
+    monkeypatch.setattr(nrdp_data, 's3_list_objects', list_objects)
+    monkeypatch.setattr(nrdp_data, 'async_retry_corrupt', fetch)
+    monkeypatch.setattr(nrdp_data, 'get_run_logger', lambda: logging.getLogger(__name__))
+    nrdf = SimpleNamespace(filter=filt, key="logs/", date_in_key=date_in_key, bucket="bucket",
+                           archive_path=str(tmp_path), get_client_parameters=lambda: None,
+                           get_filepath_prefix=lambda y, m, d: os.path.join(tmp_path, y, m, d))
+    asyncio.run(nrdp_data.fetch_range(nrdf, None, [2022, 7, 1], [2022, 7, 3]))
+    return sorted(fetched)
+
+
+def make_object(key, *modified):
+    return {'Key': key, 'LastModified': datetime(*modified), 'ETag': '"0"', 'Size': 0}
+
+
+def test_filter_buckets_by_last_modified(monkeypatch, tmp_path):
+    objects = [make_object("logs/2022/202207/a", 2022, 7, 2, 1), make_object("logs/2022/202207/b", 2022, 7, 9, 1),
+               make_object("logs/2022/202207/", 2022, 7, 2, 1)]
+    assert run_backfill(monkeypatch, tmp_path, objects, "yesterdays", True) == [("logs/2022/202207/a", "2022-07-02")]
+
+
+def test_without_filter_each_object_is_fetched_once(monkeypatch, tmp_path):
+    objects = [make_object("logs/a", 2022, 7, 2, 1), make_object("logs/b", 2022, 6, 3, 1),
+               make_object("logs/c", 2022, 8, 1, 1)]
+    assert run_backfill(monkeypatch, tmp_path, objects, None) == [
+        ("logs/a", "2022-07-02"), ("logs/b", "2022-07-03"), ("logs/c", "2022-07-03")]
+
+
+def test_days_already_archived_are_skipped(monkeypatch, tmp_path):
+    os.makedirs(tmp_path / "2022" / "07" / "03")
+    (tmp_path / "2022" / "07" / "03" / "x").write_bytes(b"x")
+    objects = [make_object("logs/a", 2022, 7, 3, 1), make_object("logs/b", 2022, 6, 3, 1)]
+    assert run_backfill(monkeypatch, tmp_path, objects, None) == [("logs/a", "2022-07-02"), ("logs/b", "2022-07-02")]
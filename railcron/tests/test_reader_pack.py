@@ -0,0 +1,72 @@
+"""
+Tests of reading days packed into containers (flows/utils/reader.py, flows/utils/pack.py)
+
+    python -m pytest railcron/tests
+"""
+import gzip
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flows"))
+
+from utils import reader  # noqa: E402
+from utils.pack import get_pack_path, pack_day  # noqa: E402
+
+
+def hour_data(hour):
+    return b"".join(b'{"ts":"2022-10-16T%02d:%02d:00","incident":%d}\n' % (hour, minute, minute)
+                    for minute in range(60))
+
+
+@pytest.fixture
+def packed_day(tmp_path, monkeypatch):
+    """An incidents day of three hourly files packed into 16.pack.tar, and the Block of the flow"""
+    archive_path = tmp_path / "incidents"
+    daypath = archive_path / "2022" / "10" / "16"
+    daypath.mkdir(parents=True)
+    for hour in (7, 8, 9):
+        (daypath / f"{hour:02d}.incidents.json.gz").write_bytes(gzip.compress(hour_data(hour)))
+    assert pack_day(str(archive_path), str(daypath)) == get_pack_path(str(daypath))
+    assert not daypath.exists()
+    cfg = SimpleNamespace(archive_path=str(archive_path), settings=SimpleNamespace(cache_dir=None))
+    monkeypatch.setattr(reader, 'load_block', lambda block_type, name: cfg)
+    return cfg
+
+
+def test_get_day_sources_of_packed_day(packed_day):
+    sources = reader.get_day_sources("incidents", packed_day, "2022", "10", "16")
+    packpath = get_pack_path(os.path.join(packed_day.archive_path, "2022", "10", "16"))
+    assert sources == [(packpath, f"{hour:02d}.incidents.json.gz") for hour in (7, 8, 9)]
+
+
+def test_iter_archive_of_packed_day(packed_day):
+    data = b"".join(chunk for _, chunk in reader.iter_archive("incidents", ("2022-10-16", "2022-10-16")))
+    assert data == hour_data(7) + hour_data(8) + hour_data(9)
+
+
+def test_open_range_of_packed_day(packed_day):
+    with reader.open_range("incidents", "2022-10-16", "08:00", "08:59") as fd:
+        data = fd.read()
+    # members of packed days are read whole
+    assert data == hour_data(7) + hour_data(8) + hour_data(9)
+
+
+def test_open_range_of_seekable_day(tmp_path, monkeypatch):
+    from utils.seekable import write_seekable
+
+    daypath = tmp_path / "incidents" / "2022" / "10" / "16"
+    daypath.mkdir(parents=True)
+    source = tmp_path / "day.json"
+    source.write_bytes(b"".join(hour_data(hour) for hour in range(24)))
+    write_seekable(str(source), str(daypath / "00.incidents.json.zst"), frame_size=512)
+    cfg = SimpleNamespace(archive_path=str(tmp_path / "incidents"), settings=SimpleNamespace(cache_dir=None))
+    monkeypatch.setattr(reader, 'load_block', lambda block_type, name: cfg)
+    with reader.open_range("incidents", "2022-10-16", "08:00", "08:59") as fd:
+        data = fd.read()
+    assert hour_data(8) in data
+    # only whole frames are read, so a little of the hours around
+    assert b"T06:" not in data and b"T10:" not in data
+    assert len(data) < len(hour_data(8)) * 2
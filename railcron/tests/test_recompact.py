@@ -0,0 +1,39 @@
+"""
+Tests that recompacted files can be read back and scrubbed (flows/utils/recompact.py)
+
+    python -m pytest railcron/tests
+"""
+import gzip
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flows"))
+
+from utils import codec, scrub  # noqa: E402
+from utils.recompact import recompact_file, tiers  # noqa: E402
+
+
+DATA = b"".join(b'{"time":"%d","train":"1A%02d"}\n' % (1665878400000 + i * 1000, i % 100) for i in range(50000))
+
+
+@pytest.mark.parametrize("name", [x[0] for x in tiers])
+@pytest.mark.parametrize("module", [True, False], ids=["zstandard", "command"])
+def test_recompact_then_scrub(tmp_path, monkeypatch, name, module):
+    if shutil.which(name) is None:
+        pytest.skip(f"{name} is not installed")
+    if not module:
+        # as without the zstandard module
+        monkeypatch.setattr(codec, 'zstandard', None)
+        monkeypatch.setattr(scrub, 'zstandard', None)
+    filepath = tmp_path / "16.json.gz"
+    filepath.write_bytes(gzip.compress(DATA))
+    _, newpath, _ = recompact_file(str(filepath), [x for x in tiers if x[0] == name][0])
+    assert not filepath.exists()
+    result = scrub.test_file(newpath)
+    assert result['error'] is None
+    assert result['size'] == os.path.getsize(newpath)
+    with codec.open_file(newpath) as fd:
+        assert fd.read() == DATA
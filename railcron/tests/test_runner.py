@@ -0,0 +1,27 @@
+"""
+Tests of running external commands (flows/utils/runner.py)
+
+    python -m pytest railcron/tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flows"))
+
+from utils import runner  # noqa: E402
+
+
+def test_commands_outside_flow_runs_are_not_kept():
+    result = runner.run_command("echo outside")
+    assert result.returncode == 0 and result.output == "outside"
+    assert runner._results == {}
+    assert runner.get_command_summary()['commands'] == 0
+
+
+def test_command_summary_of_flow_run(monkeypatch):
+    monkeypatch.setattr(runner, 'get_run_id', lambda: "run-1")
+    runner.run_command("true")
+    runner.run_command("false", check=False)
+    summary = runner.get_command_summary()
+    assert (summary['commands'], summary['failed']) == (2, 1)
+    assert runner._results == {}
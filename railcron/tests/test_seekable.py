@@ -0,0 +1,60 @@
+"""
+Tests of the frame selection of seekable zstd files (flows/utils/seekable.py)
+
+    python -m pytest railcron/tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flows"))
+
+from utils.seekable import get_timestamp, select_frames  # noqa: E402
+
+
+def make_frames(*stamps):
+    """Frames of 100 bytes each starting at the given timestamps"""
+    return [[idx * 10, 10, idx * 100, 100, stamp] for idx, stamp in enumerate(stamps)]
+
+
+def day(hhmm):
+    return f"2022-10-16T{hhmm}:00"
+
+
+def test_file_before_range_gives_no_frames():
+    frames = make_frames(*[day(f"01:{m}0") for m in range(6)])
+    assert select_frames(frames, day("08:00"), day("09:00")) == []
+    assert select_frames(frames, day("08:00"), day("09:00"), last=day("01:59")) == []
+
+
+def test_file_after_range_gives_no_frames():
+    frames = make_frames(day("10:00"), day("10:30"))
+    assert select_frames(frames, day("08:00"), day("09:00"), last=day("10:59")) == []
+
+
+def test_frames_covering_range():
+    frames = make_frames(day("07:00"), day("07:40"), day("08:20"), day("09:10"), day("09:50"))
+    assert select_frames(frames, day("08:00"), day("09:00")) == frames[1:3]
+    # the frame before is still needed when the next starts exactly at start
+    assert select_frames(frames, day("08:20"), day("09:00")) == frames[1:3]
+
+
+def test_last_frame_extends_to_last_timestamp():
+    frames = make_frames(day("07:00"), day("07:30"))
+    assert select_frames(frames, day("07:45"), day("08:00"), last=day("07:59")) == frames[1:]
+    # without the last timestamp of the file only the start of the last frame is known
+    assert select_frames(frames, day("07:45"), day("08:00")) == []
+    assert select_frames(frames, day("07:15"), day("08:00")) == frames
+
+
+def test_frames_without_timestamp():
+    frames = make_frames(None, day("08:10"), None, day("09:30"))
+    assert select_frames(frames, day("08:00"), day("09:00")) == frames[:3]
+    assert select_frames(make_frames(None, None), day("08:00"), day("09:00")) == make_frames(None, None)
+    assert select_frames([], day("08:00"), day("09:00")) == []
+
+
+def test_get_timestamp_first_and_last():
+    data = b'{"time":"1665878401000"}\n{"time":"1665882001000"}\n'
+    assert get_timestamp(data) == "2022-10-16T00:00:01"
+    assert get_timestamp(data, last=True) == "2022-10-16T01:00:01"
+    assert get_timestamp(b"no time here\n", last=True) is None